@@ -13,13 +13,24 @@ import logging
 logger = logging.getLogger(__name__)
 import re
 
+NATURAL_SORT_SPLIT = re.compile('([0-9]+)')
+
+def natural_sort_key( text ):
+    """Key for sorting strings in the way that humans expect.
+    
+    >>> natural_sort_key('ddr-test-123-10')
+    ['ddr-test-', 123, '-', 10, '']
+    
+    @param text: str
+    @returns: list
+    """
+    return [int(c) if c.isdigit() else c for c in NATURAL_SORT_SPLIT.split(text)]
+
 def natural_sort( l ):
     """Sort the given list in the way that humans expect.
     src: http://www.codinghorror.com/blog/2007/12/sorting-for-humans-natural-sort-order.html
     """
-    convert = lambda text: int(text) if text.isdigit() else text
-    alphanum_key = lambda key: [ convert(c) for c in re.split('([0-9]+)', key) ]
-    l.sort( key=alphanum_key )
+    l.sort( key=natural_sort_key )
     return l
 
 def natural_order_string( id ):
@@ -0,0 +1,387 @@
+# Benchmarks for indexing and related code, using synthetic collections
+#
+#     from DDR import benchmark
+#     path = benchmark.generate_collection('/var/www/media/bench', 'ddr-bench-1', entities=100, files=5)
+#     server = benchmark.start_stub_server()
+#     results = benchmark.run(path, benchmark.stub_hosts(server))
+#     print('\n'.join(benchmark.format_results(results)))
+#     benchmark.stop_stub_server(server)
+
+import BaseHTTPServer
+import hashlib
+import imp
+import json
+import logging
+logger = logging.getLogger(__name__)
+import os
+import resource
+import SocketServer
+import sys
+import threading
+import time
+
+from DDR import docstore
+from DDR import models
+
+
+BIN_DIR = os.path.join(os.path.dirname(models.MODULE_PATH), 'bin')
+
+# First field of every DDR metadata file: info about the software that wrote it.
+APP_FIELD = {
+    'application': 'https://github.com/densho/ddr-local.git',
+    'app_commit': '0000000000000000000000000000000000000000  (HEAD) 1970-01-01 00:00:00 +0000',
+    'app_release': '0.0',
+    'models_commit': '0000000000000000000000000000000000000000  (HEAD) 1970-01-01 00:00:00 +0000',
+    'git_version': 'git version 1.7.10.4; git-annex version: 3.20120629',
+}
+
+LOREM = 'Lorem ipsum dolor sit amet, consectetur adipisicing elit, sed do eiusmod tempor incididunt ut labore et dolore magna aliqua.'
+
+
+# synthetic collections ------------------------------------------------
+
+def _field_value( field, object_id, n ):
+    """Makes a plausible value for a model field.
+
+    @param field: Field dict from DDR/models/*.json
+    @param object_id: ID of the object being generated.
+    @param n: Number of the object within its parent; used to vary values.
+    @returns: value
+    """
+    name = field['name']
+    if name == 'id':
+        return object_id
+    if name == 'status':
+        return 'completed'
+    if name == 'public':
+        return '1'
+    if name in ['record_created', 'record_lastmod', 'digitize_date']:
+        return '2014-01-%02dT12:00:00' % ((n % 28) + 1)
+    if name == 'creators':
+        return 'Lastname%s, Firstname: photographer' % n
+    if name == 'topics':
+        return ['Topic %s [%s]' % (n % 50, n % 50)]
+    if name == 'facility':
+        return ['Facility %s [%s]' % (n % 10, n % 10)]
+    if name == 'parent':
+        return models.parent_id(object_id)
+    if name == 'sort':
+        return n
+    if name in ['files', 'links']:
+        return []
+    choices = field.get('form', {}).get('choices', None)
+    if choices:
+        return choices[n % len(choices)][0]
+    return '%s %s. %s' % (name, object_id, LOREM)
+
+def make_document( model_fields, object_id, n, extra={} ):
+    """Makes a DDR list-of-dicts document for an object.
+
+    @param model_fields: Contents of DDR/models/MODEL.json
+    @param object_id: Object ID
+    @param n: Number of the object within its parent.
+    @param extra: dict of fields to add that are not in the model.
+    @returns: list of dicts
+    """
+    document = [APP_FIELD]
+    for field in model_fields:
+        document.append( {field['name']: _field_value(field, object_id, n)} )
+    for key,val in extra.iteritems():
+        document.append( {key: val} )
+    return document
+
+def _write_document( document, path ):
+    with open(path, 'w') as f:
+        f.write(json.dumps(document, indent=4, separators=(',', ': '), sort_keys=True))
+
+def generate_collection( basedir, collection_id='ddr-bench-1', entities=10, files=5, access=True, models_dir=models.MODELS_DIR ):
+    """Writes a synthetic collection with the specified number of entities and files.
+
+    Metadata is made from the model definitions in models_dir.  Files
+    alternate between master and mezzanine roles.  No binaries are
+    written, only metadata and (optionally) empty access files.
+
+    IMPORTANT: basedir must not be inside a directory that
+    models.walk_metadata_files skips (e.g. /tmp).
+
+    @param basedir: Absolute path to directory in which to write collection.
+    @param collection_id: ID of the collection.
+    @param entities: Number of entities.
+    @param files: Number of files per entity.
+    @param access: Write empty access files.
+    @param models_dir: Absolute path to directory containing model JSON files.
+    @returns: Absolute path to collection.
+    """
+    for name in os.path.abspath(basedir).split(os.sep):
+        if name in models.METADATA_EXCLUDE_DIRS:
+            raise Exception('Metadata files in "%s" directories are ignored: %s' % (name, basedir))
+    modelfields = models.model_definitions(models_dir, models.MODELS)
+    collection_path = os.path.join(basedir, collection_id)
+    os.makedirs(collection_path)
+    _write_document(
+        make_document(modelfields['collection'], collection_id, 0),
+        os.path.join(collection_path, 'collection.json'))
+    for e in range(1, entities + 1):
+        entity_id = '%s-%s' % (collection_id, e)
+        entity_path = os.path.join(collection_path, 'files', entity_id)
+        files_path = os.path.join(entity_path, 'files')
+        os.makedirs(files_path)
+        _write_document(
+            make_document(modelfields['entity'], entity_id, e),
+            os.path.join(entity_path, 'entity.json'))
+        for f in range(files):
+            role = ['master', 'mezzanine'][f % 2]
+            sha1 = hashlib.sha1('%s-%s' % (entity_id, f)).hexdigest()
+            file_id = '%s-%s-%s' % (entity_id, role, sha1[:10])
+            document = make_document(
+                modelfields['file'], file_id, f,
+                {'path_rel': '%s.tif' % file_id}
+            )
+            _write_document(document, os.path.join(files_path, '%s.json' % file_id))
+            if access:
+                open(os.path.join(files_path, '%s-a.jpg' % file_id), 'w').close()
+    return collection_path
+
+
+# stub Elasticsearch ---------------------------------------------------
+
+class StubElasticsearchHandler( BaseHTTPServer.BaseHTTPRequestHandler ):
+    """Answers Elasticsearch requests just well enough for docstore.index().
+
+    Documents are not stored: bulk and index requests succeed,
+    gets find nothing.
+    """
+    protocol_version = 'HTTP/1.1'
+    # send each response in one write, or keep-alive requests stall on delayed ACKs
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message( self, format, *args ):
+        pass
+
+    def _respond( self, status, data=None ):
+        body = ''
+        if data is not None:
+            body = json.dumps(data)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _body( self ):
+        length = int(self.headers.getheader('content-length') or 0)
+        body = ''
+        if length:
+            body = self.rfile.read(length)
+        self.server.requests += 1
+        self.server.bytes += length
+        return body
+
+    def _path_parts( self ):
+        return [part for part in self.path.split('?')[0].split('/') if part]
+
+    def _bulk( self, body ):
+        items = []
+        lines = [line for line in body.split('\n') if line.strip()]
+        n = 0
+        while n < len(lines):
+            action = json.loads(lines[n])
+            op = action.keys()[0]
+            meta = action[op]
+            n += 1
+            if op in ['index', 'create', 'update']:
+                n += 1
+            status = 201
+            if op == 'delete':
+                status = 200
+            items.append({op: {
+                '_index': meta.get('_index', None), '_type': meta.get('_type', None),
+                '_id': meta.get('_id', None), '_version': 1, 'status': status,
+            }})
+        self.server.documents += len(items)
+        return {'took': 1, 'errors': False, 'items': items}
+
+    def _mget( self, body ):
+        docs = []
+        if body:
+            docs = json.loads(body).get('docs', [])
+        return {'docs': [
+            {'_index': doc.get('_index', None), '_type': doc.get('_type', None),
+             '_id': doc.get('_id', None), 'found': False}
+            for doc in docs
+        ]}
+
+    def do_HEAD( self ):
+        self._body()
+        self._respond(404)
+
+    def do_GET( self ):
+        body = self._body()
+        parts = self._path_parts()
+        if parts and (parts[-1] == '_mget'):
+            self._respond(200, self._mget(body))
+        elif len(parts) == 3:
+            self._respond(404, {'_index':parts[0], '_type':parts[1], '_id':parts[2], 'found':False})
+        else:
+            self._respond(200, {'ok': True})
+
+    def do_PUT( self ):
+        body = self._body()
+        parts = self._path_parts()
+        if parts and (parts[-1] == '_bulk'):
+            self._respond(200, self._bulk(body))
+        elif parts and (parts[-1] == '_mget'):
+            self._respond(200, self._mget(body))
+        elif len(parts) == 3:
+            self.server.documents += 1
+            self._respond(201, {'_index':parts[0], '_type':parts[1], '_id':parts[2], '_version':1, 'created':True})
+        else:
+            self._respond(200, {'ok': True, 'acknowledged': True})
+
+    do_POST = do_PUT
+
+    def do_DELETE( self ):
+        self._body()
+        parts = self._path_parts()
+        self._respond(200, {'found':True, '_id':parts[-1], '_version':2})
+
+
+class StubElasticsearchServer( SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer ):
+    daemon_threads = True
+    requests = 0
+    bytes = 0
+    documents = 0
+
+def start_stub_server( host='127.0.0.1', port=0 ):
+    """Starts a stub Elasticsearch HTTP server in a background thread.
+
+    @param host: Interface to listen on.
+    @param port: Port to listen on; 0 picks a free port.
+    @returns: StubElasticsearchServer (call shutdown() when done)
+    """
+    server = StubElasticsearchServer((host, port), StubElasticsearchHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def stop_stub_server( server ):
+    """Closes docstore's connections to a stub server and shuts it down.
+    """
+    docstore.close_connections(stub_hosts(server))
+    server.shutdown()
+    server.server_close()
+
+def stub_hosts( server ):
+    """Returns docstore hosts list for a stub server.
+    """
+    host,port = server.server_address
+    return [{'host':host, 'port':port}]
+
+
+# timings --------------------------------------------------------------
+
+def peak_memory():
+    """Peak resident memory of this process so far, in kilobytes (Linux).
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+class _Quiet( object ):
+    def write( self, text ):
+        pass
+
+def _phase( results, name, function, *args, **kwargs ):
+    """Runs function, appends timing info to results, returns function's output.
+
+    The function's output must be sized or be a dict with a 'total'.
+    """
+    stdout = sys.stdout
+    sys.stdout = _Quiet()
+    try:
+        start = time.time()
+        output = function(*args, **kwargs)
+        elapsed = time.time() - start
+    finally:
+        sys.stdout = stdout
+    if isinstance(output, dict) and ('total' in output):
+        items = output['total']
+    else:
+        items = len(output)
+    rate = 0
+    if elapsed:
+        rate = items / elapsed
+    results.append({
+        'phase': name,
+        'elapsed': elapsed,
+        'items': items,
+        'rate': rate,
+        'peak_kb': peak_memory(),
+    })
+    logger.debug('%s: %s items in %0.3fs' % (name, items, elapsed))
+    return output
+
+def _transform_documents( records, transforms ):
+    default = docstore.make_transform()
+    return [
+        transforms.get(record['model'], default)(record['document'])
+        for record in records
+    ]
+
+def _publishable( records, parents ):
+    successful,bad = docstore._publishable_or_not(records, parents)
+    return successful
+
+def _load_ddrfilter():
+    path = os.path.join(BIN_DIR, 'ddrfilter')
+    if os.path.exists(path):
+        return imp.load_source('ddrfilter', path)
+    return None
+
+def run( path, hosts, index='benchmark', bulk=True, models_dir=models.MODELS_DIR ):
+    """Times each phase of indexing a collection, then the whole thing.
+
+    Phases are run one after another on the same data, the way
+    docstore.index() runs them.  Peak memory is the process high-water
+    mark at the end of each phase, so it only ever goes up.
+    ddrfilter.make_exclusion_list is timed as well if the ddrfilter
+    script is available.
+
+    @param path: Absolute path to collection.
+    @param hosts: list of dicts containing host information (see stub_hosts).
+    @param index: Name of the index to use.
+    @param bulk: Use the ElasticSearch _bulk API.
+    @param models_dir: Absolute path to directory containing model JSON files.
+    @returns: list of dicts (phase, elapsed, items, rate, peak_kb)
+    """
+    results = []
+    paths = _phase(results, 'metadata_files', models.metadata_files,
+                   path, recursive=True, files_first=True, force_read=True)
+    records = _phase(results, 'load_metadata', docstore._load_metadata, paths)
+    parents = docstore._parents_status(records)
+    successful = _phase(results, 'publishable', _publishable, records, parents)
+    _phase(results, 'signatures', docstore._choose_signatures, successful)
+    public_fields = models.public_fields(models_dir, models.MODELS)
+    transforms = dict([
+        (model, docstore.make_transform(fields)) for model,fields in public_fields.iteritems()
+    ])
+    _phase(results, 'transform', _transform_documents, successful, transforms)
+    _phase(results, 'index', docstore.index,
+           hosts, index, path, models_dir=models_dir, recursive=True, bulk=bulk)
+    ddrfilter = _load_ddrfilter()
+    if ddrfilter:
+        _phase(results, 'make_exclusion_list', ddrfilter.make_exclusion_list, path)
+    return results
+
+def format_results( results ):
+    """Formats output of run() as a table.
+
+    @param results: list
+    @returns: list of lines
+    """
+    lines = ['%-20s %10s %10s %12s %10s' % ('phase', 'seconds', 'items', 'items/sec', 'peak KB')]
+    for r in results:
+        lines.append('%-20s %10.3f %10d %12.1f %10d' % (
+            r['phase'], r['elapsed'], r['items'], r['rate'], r['peak_kb']))
+    return lines
@@ -14,6 +14,8 @@ from DDR import CONFIG_FILES, NoConfigError
 from DDR import storage
 from DDR import dvcs
 from DDR.models import Collection as DDRCollection, Entity as DDREntity
+from DDR.models import HASH_WORKERS, HASH_IO_LIMIT
+from DDR.fixity import audit as fixity_audit, write_report as write_fixity_report
 from DDR.changelog import write_changelog_entry
 from DDR.organization import group_repo_level, repo_level, repo_annex_get, read_group_file
 
@@ -85,6 +87,7 @@ OPERATIONS = [
     'eadd',
     'pull',
     'push',
+    'fixity',
     ]
 
 
@@ -633,7 +636,7 @@ def entity_destroy(user_name, user_mail, collection_path, entity_uid, agent=''):
 
 @command
 @local_only
-def file_destroy(user_name, user_mail, collection_path, entity_uid, rm_files, updated_files, agent=''):
+def file_destroy(user_name, user_mail, collection_path, entity_uid, rm_files, updated_files, agent='', verify=False):
     """Command-line function for creating an entity and adding it to the collection.
     
     - check that paths exist, etc
@@ -649,6 +652,7 @@ def file_destroy(user_name, user_mail, collection_path, entity_uid, rm_files, up
     @param rm_files: List of paths to files to delete (relative to entity files dir).
     @param updated_files: List of paths to updated file(s), relative to entitys.
     @param agent: (optional) Name of software making the change.
+    @param verify: (optional) Rehash all payload files instead of using checksum cache.
     @return: message ('ok' if successful)
     """
     collection = DDRCollection(collection_path)
@@ -674,7 +678,7 @@ def file_destroy(user_name, user_mail, collection_path, entity_uid, rm_files, up
     
     # update entity control
     econtrol = entity.control()
-    econtrol.update_checksums(entity)
+    econtrol.update_checksums(entity, verify=verify)
     econtrol.write()
     git_files.append(econtrol.path_rel)
     
@@ -745,7 +749,7 @@ def entity_update(user_name, user_mail, collection_path, entity_uid, updated_fil
 
 @command
 @local_only
-def entity_annex_add(user_name, user_mail, collection_path, entity_uid, updated_files, new_annex_files, agent='', entity=None):
+def entity_annex_add(user_name, user_mail, collection_path, entity_uid, updated_files, new_annex_files, agent='', entity=None, verify=False):
     """Command-line function for git annex add-ing a file and updating metadata.
     
     All this function does is git annex add the file, update changelog and
@@ -767,6 +771,7 @@ def entity_annex_add(user_name, user_mail, collection_path, entity_uid, updated_
     @param new_annex_files: List of paths to new files (relative to entity files dir).
     @param agent: (optional) Name of software making the change.
     @param entity: (optional) Entity object (see above)
+    @param verify: (optional) Rehash all payload files instead of using checksum cache.
     @return: message ('ok' if successful)
     """
     collection = DDRCollection(collection_path)
@@ -808,7 +813,7 @@ def entity_annex_add(user_name, user_mail, collection_path, entity_uid, updated_
     
     # update entity control
     econtrol = entity.control()
-    econtrol.update_checksums(entity)
+    econtrol.update_checksums(entity, verify=verify)
     econtrol.write()
     git_files.append(econtrol.path_rel)
     
@@ -918,6 +923,38 @@ def annex_pull(collection_path, file_path_rel):
     return 0,'ok'
 
 
+@command
+@local_only
+def fixity(collection_path, report_path=None, journal_path=None, restart=False, workers=HASH_WORKERS, io_limit=HASH_IO_LIMIT, keys=False):
+    """Command-line function for verifying payload files against entity control files.
+    
+    Reads every payload file in the collection and compares its size and
+    SHA1, SHA256, and MD5 checksums with the Checksums-SHA1, Checksums-SHA256,
+    and Files sections of its entity control file.
+    Writes a JSON report of mismatched, missing, and untracked files,
+    errors, and throughput.
+    Progress is journaled so an interrupted audit resumes where it stopped.
+    With keys, annexed files are checked against the hash and size in their
+    git-annex keys and only read if the key has no usable hash (WORM, URL).
+    
+    @param collection_path: Absolute path to collection repo.
+    @param report_path: (optional) Absolute path to report file; default is stdout.
+    @param journal_path: (optional) Absolute path to journal file; default is in .git/ddr.
+    @param restart: (optional) Ignore journal of an interrupted audit and start over.
+    @param workers: (optional) Number of hashing threads.
+    @param io_limit: (optional) Max number of files read at once (0: no limit).
+    @param keys: (optional) Check annexed files using git-annex keys instead of reading them.
+    @return: message ('ok' if successful)
+    """
+    report = fixity_audit(collection_path, journal=journal_path, restart=restart,
+                          workers=workers, io_limit=io_limit, keys=keys)
+    write_fixity_report(report, report_path)
+    if not report['ok']:
+        return 1,'{} mismatched, {} missing, {} errors'.format(
+            len(report['mismatches']), len(report['missing']), len(report['errors']))
+    return 0,'ok'
+
+
 @command
 @local_only
 def sync_group(groupfile, local_base, local_name, remote_base, remote_name):
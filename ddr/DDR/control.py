@@ -84,31 +84,35 @@ class EntityControlFile( ControlFile ):
             f.write(t.format(cid=collection_uid, eid=entity_uid))
     
     CHECKSUMS = ['sha1', 'sha256', 'files']
-    def update_checksums( self, entity ):
+    def update_checksums( self, entity, verify=False ):
+        """Rewrites the checksum sections from the entity's payload files.
+        
+        @param entity: models.Entity
+        @param verify: boolean Ignore cached checksums and rehash files.
+        """
         # return relative path to payload
         def relative_path(prefix_path, payload_file):
             if prefix_path[-1] != '/':
                 prefix_path = '{}/'.format(prefix_path)
             return payload_file.replace(prefix_path, '')
         
+        # read each payload file once for all three sections
+        file_hashes = entity.file_hashes(verify=verify)
+        
         self._config.remove_section('Checksums-SHA1')
         self._config.add_section('Checksums-SHA1')
-        for sha1,path in entity.checksums('sha1'):
+        for path,hashes in file_hashes:
             path = relative_path(entity.files_path, path)
-            self._config.set('Checksums-SHA1', sha1, path)
+            self._config.set('Checksums-SHA1', hashes['sha1'], path)
         #
         self._config.remove_section('Checksums-SHA256')
         self._config.add_section('Checksums-SHA256')
-        for sha256,path in entity.checksums('sha256'):
+        for path,hashes in file_hashes:
             path = relative_path(entity.files_path, path)
-            self._config.set('Checksums-SHA256', sha256, path)
+            self._config.set('Checksums-SHA256', hashes['sha256'], path)
         #
         self._config.remove_section('Files')
         self._config.add_section('Files')
-        for md5,path in entity.checksums('md5'):
-            try:
-                size = os.path.getsize(path)
-            except:
-                size = 'UNKNOWNSIZE'
+        for path,hashes in file_hashes:
             path = relative_path(entity.files_path, path)
-            self._config.set('Files', md5, '{} ; {}'.format(size,path))
+            self._config.set('Files', hashes['md5'], '{} ; {}'.format(hashes['size'],path))
@@ -31,16 +31,28 @@ docstore.index(HOSTS, INDEX, PATH, recursive=True, public=True )
 """
 from __future__ import print_function
 import ConfigParser
+from collections import OrderedDict
+import copy
 from datetime import datetime
+import functools
+import hashlib
+import heapq
+import inspect
 import json
 import logging
 logger = logging.getLogger(__name__)
+import multiprocessing
 import os
+import tempfile
+import threading
+import time
 
 from elasticsearch import Elasticsearch
+from elasticsearch.exceptions import NotFoundError
 
 from DDR import CONFIG_FILES, NoConfigError
-from DDR import natural_sort
+from DDR import natural_sort, natural_sort_key
+from DDR import dvcs
 from DDR import models
 
 config = ConfigParser.ConfigParser()
@@ -53,11 +65,36 @@ FACETS_PATH = config.get('cmdln','vocab_facets_path')
 
 MAX_SIZE = 1000000
 DEFAULT_PAGE_SIZE = 20
+# scan/scroll: hits per shard per batch, and how long ES keeps the context
+SCROLL_SIZE = 500
+SCROLL_TIMEOUT = '5m'
 
 SUCCESS_STATUSES = [200, 201]
+BULK_CHUNK_SIZE = 500
+BULK_CHUNK_BYTES = 10 * 1024 * 1024
+MGET_CHUNK_SIZE = 500
 STATUS_OK = ['completed']
 PUBLIC_OK = [1,'1']
 
+# Connections per Elasticsearch node, and request timeout (seconds)
+ES_MAXSIZE = 10
+ES_TIMEOUT = 10
+if config.has_option('cmdln', 'elasticsearch_maxsize'):
+    ES_MAXSIZE = config.getint('cmdln', 'elasticsearch_maxsize')
+if config.has_option('cmdln', 'elasticsearch_timeout'):
+    ES_TIMEOUT = config.getint('cmdln', 'elasticsearch_timeout')
+
+# Elasticsearch clients, see _get_connection
+_CONNECTIONS = {}
+
+# Query cache for get/search/facet_terms: max entries (0 disables), TTL (seconds)
+QUERY_CACHE_SIZE = 0
+QUERY_CACHE_TTL = 300
+if config.has_option('cmdln', 'query_cache_size'):
+    QUERY_CACHE_SIZE = config.getint('cmdln', 'query_cache_size')
+if config.has_option('cmdln', 'query_cache_ttl'):
+    QUERY_CACHE_TTL = config.getint('cmdln', 'query_cache_ttl')
+
 """
 ddr-local
 
@@ -77,10 +114,187 @@ results = elasticsearch.facet_terms(settings.ELASTICSEARCH_HOST_PORT,
 """
 
 
-def _get_connection( hosts ):
-    es = Elasticsearch(hosts)
+def _hosts_key( hosts ):
+    """Makes a hashable key from a list of hosts.
+    
+    >>> _hosts_key([{'host':'127.0.0.1', 'port':9200}])
+    ((('host', '127.0.0.1'), ('port', 9200)),)
+    >>> _hosts_key('127.0.0.1:9200')
+    ('127.0.0.1:9200',)
+    
+    @param hosts: list of dicts containing host information.
+    @returns: tuple
+    """
+    if not isinstance(hosts, (list, tuple)):
+        hosts = [hosts]
+    key = []
+    for host in hosts:
+        if isinstance(host, dict):
+            host = tuple(sorted(host.items()))
+        key.append(host)
+    return tuple(key)
+
+def _get_connection( hosts, maxsize=ES_MAXSIZE, timeout=ES_TIMEOUT ):
+    """Returns an Elasticsearch client for the hosts.
+    
+    Clients are cached, so connections are pooled and kept alive between
+    calls instead of being set up for every request.
+    Clients are not shared across processes: the cache is keyed by
+    process ID so that forked workers get their own sockets.
+    
+    @param hosts: list of dicts containing host information.
+    @param maxsize: Maximum number of connections to keep per host.
+    @param timeout: Request timeout in seconds.
+    @returns: Elasticsearch
+    """
+    key = (os.getpid(), _hosts_key(hosts), maxsize, timeout)
+    es = _CONNECTIONS.get(key, None)
+    if not es:
+        es = Elasticsearch(hosts, maxsize=maxsize, timeout=timeout)
+        _CONNECTIONS[key] = es
     return es
 
+def close_connections( hosts=None ):
+    """Closes cached Elasticsearch clients and removes them from the cache.
+    
+    @param hosts: (optional) Only close clients for these hosts.
+    """
+    for key in _CONNECTIONS.keys():
+        pid,hosts_key,maxsize,timeout = key
+        if (hosts is not None) and (hosts_key != _hosts_key(hosts)):
+            continue
+        es = _CONNECTIONS.pop(key)
+        if pid != os.getpid():
+            # inherited from parent process; not ours to close
+            continue
+        for connection in es.transport.connection_pool.connections:
+            pool = getattr(connection, 'pool', None)
+            if pool:
+                pool.close()
+
+def reset_connections():
+    """Forgets all cached Elasticsearch clients without closing them.
+    """
+    _CONNECTIONS.clear()
+
+class QueryCache( object ):
+    """In-process LRU cache of query results with a time-to-live.
+    
+    Entries are keyed on the normalized arguments of the query and on a
+    generation number for the ElasticSearch cluster (see invalidate).
+    Values are deep-copied going in and coming out, so callers can
+    modify results without corrupting the cache.
+    
+    @param maxsize: int Maximum number of entries; 0 disables the cache.
+    @param ttl: int Seconds before an entry expires.
+    """
+    
+    def __init__( self, maxsize=QUERY_CACHE_SIZE, ttl=QUERY_CACHE_TTL ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+    
+    def key( self, name, hosts_key, args ):
+        """Makes a cache key for the named query
+        
+        @param name: str Name of the query function
+        @param hosts_key: Output of _hosts_key
+        @param args: dict Arguments of the query, minus hosts
+        @returns: str
+        """
+        generation = self._generations.get(hosts_key, 0)
+        return json.dumps(
+            [name, hosts_key, generation, args], sort_keys=True, default=repr)
+    
+    def get( self, key ):
+        """
+        @param key: Output of QueryCache.key
+        @returns: (hit,value) hit is True if key was found and not expired
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry and (time.time() < entry[0]):
+                self._entries[key] = entry
+                self.hits += 1
+                return True,copy.deepcopy(entry[1])
+            self.misses += 1
+            return False,None
+    
+    def set( self, key, value ):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl, copy.deepcopy(value))
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+    
+    def invalidate( self, hosts ):
+        """Makes all entries for the hosts' cluster unreachable.
+        
+        Queries may name an index directly or through an alias, so a write
+        to any index invalidates every query against the cluster.  Stale
+        entries are never looked up again and fall off the end of the LRU.
+        
+        @param hosts: list of dicts containing host information.
+        """
+        hosts_key = _hosts_key(hosts)
+        with self._lock:
+            self._generations[hosts_key] = self._generations.get(hosts_key, 0) + 1
+    
+    def clear( self ):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+    
+    def stats( self ):
+        """
+        @returns: dict with hits, misses, size, maxsize, ttl
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'ttl': self.ttl,
+        }
+
+QUERY_CACHE = QueryCache()
+
+def configure_query_cache( maxsize, ttl=QUERY_CACHE_TTL ):
+    """Enables (maxsize > 0) or disables the query cache and empties it.
+    
+    @param maxsize: int Maximum number of entries; 0 disables the cache.
+    @param ttl: int Seconds before an entry expires.
+    """
+    QUERY_CACHE.maxsize = maxsize
+    QUERY_CACHE.ttl = ttl
+    QUERY_CACHE.clear()
+
+def _cached_query( func ):
+    """Decorator: serve results of func from QUERY_CACHE if enabled.
+    
+    func's first argument must be hosts.
+    """
+    @functools.wraps(func)
+    def wrapper( *args, **kwargs ):
+        if QUERY_CACHE.maxsize <= 0:
+            return func(*args, **kwargs)
+        callargs = inspect.getcallargs(func, *args, **kwargs)
+        hosts_key = _hosts_key(callargs.pop('hosts'))
+        key = QUERY_CACHE.key(func.__name__, hosts_key, callargs)
+        hit,value = QUERY_CACHE.get(key)
+        if hit:
+            return value
+        value = func(*args, **kwargs)
+        QUERY_CACHE.set(key, value)
+        return value
+    return wrapper
+
+
 def make_index_name( text ):
     """Takes input text and generates a legal Elasticsearch index name.
     
@@ -158,12 +372,20 @@ def set_alias( hosts, alias, index, remove=False ):
     es = _get_connection(hosts)
     if not index_exists(hosts, index):
         create_index(hosts, index)
-    # delete existing aliases
-    for i,a in _parse_cataliases(es.cat.aliases(h=['index','alias'])):
-        es.indices.delete_alias(index=i, name=a)
+    # delete existing aliases and set the new one in a single atomic
+    # request so searches never see the alias missing
+    actions = [
+        {'remove': {'index':i, 'alias':a}}
+        for i,a in _parse_cataliases(es.cat.aliases(h=['index','alias']))
+    ]
     if not remove:
-        # set the alias
-        es.indices.put_alias(index=index, name=alias, body='')
+        actions.append({'add': {'index':index, 'alias':alias}})
+    try:
+        if actions:
+            es.indices.update_aliases(body={'actions':actions})
+    finally:
+        # after the write, so queries made meanwhile aren't cached as current
+        QUERY_CACHE.invalidate(hosts)
 
 def target_index( hosts, alias ):
     """Get the name of the index to which the alias points
@@ -209,7 +431,10 @@ def delete_index( hosts, index ):
     logger.debug('_delete_index(%s, %s)' % (hosts, index))
     es = _get_connection(hosts)
     if index_exists( hosts, index ):
-        status = es.indices.delete(index=index)
+        try:
+            status = es.indices.delete(index=index)
+        finally:
+            QUERY_CACHE.invalidate(hosts)
         return status
     return '{"status":500, "message":"Index does not exist"}'
 
@@ -246,39 +471,54 @@ def _make_mappings( mappings_path, index, models_dir ):
     ['elasticsearch']['properties']
     The contents of this field will be inserted directly into the mappings document.  See ElasticSearch documentation for more information: http://www.elasticsearch.org/guide/en/elasticsearch/reference/current/mapping.html
     
+    Mappings are made once and remade only when the mappings file or
+    a model file changes (see models.derived_from_models).
+    
     @param mappings_path: Absolute path to JSON mappings file
     @param index: Name of the target index.
     @param models_dir: Absolute path to directory containing model files
     @return: List of mappings dicts.
     """
-    with open(mappings_path, 'r') as f:
-        mappings = json.loads(f.read())
+    mappings = models.derived_from_models(
+        'mappings:%s' % mappings_path,
+        lambda definitions: _add_model_mappings(mappings_path, definitions),
+        models_dir, models.MODELS, paths=[mappings_path])
     if 'documents' in index:
-        ID_PROPERTIES = {'type':'string', 'index':'not_analyzed', 'store':True}
-        for mapping in mappings['documents']:
-            model = mapping.keys()[0]
-            json_path = os.path.join(models_dir, '%s.json' % model)
-            if os.path.exists(json_path):
-                with open(json_path, 'r') as f:
-                    data = json.loads(f.read())
-                for field in data:
-                    fname = field['name']
-                    mapping[model]['properties'][fname] = field['elasticsearch']['properties']
-                # mappings for parent_id, etc
-                if model == 'collection':
-                    mapping[model]['properties']['parent_id'] = ID_PROPERTIES
-                elif model == 'entity':
-                    mapping[model]['properties']['parent_id'] = ID_PROPERTIES
-                    mapping[model]['properties']['collection_id'] = ID_PROPERTIES
-                elif model == 'file':
-                    mapping[model]['properties']['parent_id'] = ID_PROPERTIES
-                    mapping[model]['properties']['collection_id'] = ID_PROPERTIES
-                    mapping[model]['properties']['entity_id'] = ID_PROPERTIES
         return mappings
     elif 'meta' in index:
         return mappings['meta']
     return []
 
+def _add_model_mappings( mappings_path, definitions ):
+    """Loads mappings file and adds properties of model fields to documents mappings.
+    
+    @param mappings_path: Absolute path to JSON mappings file
+    @param definitions: Output of models.model_definitions
+    @returns: dict
+    """
+    with open(mappings_path, 'r') as f:
+        mappings = json.loads(f.read())
+    ID_PROPERTIES = {'type':'string', 'index':'not_analyzed', 'store':True}
+    for mapping in mappings['documents']:
+        model = mapping.keys()[0]
+        data = definitions.get(model, None)
+        if data is not None:
+            for field in data:
+                fname = field['name']
+                mapping[model]['properties'][fname] = field['elasticsearch']['properties']
+            # mappings for parent_id, etc
+            mapping[model]['properties']['content_hash'] = ID_PROPERTIES
+            if model == 'collection':
+                mapping[model]['properties']['parent_id'] = ID_PROPERTIES
+            elif model == 'entity':
+                mapping[model]['properties']['parent_id'] = ID_PROPERTIES
+                mapping[model]['properties']['collection_id'] = ID_PROPERTIES
+            elif model == 'file':
+                mapping[model]['properties']['parent_id'] = ID_PROPERTIES
+                mapping[model]['properties']['collection_id'] = ID_PROPERTIES
+                mapping[model]['properties']['entity_id'] = ID_PROPERTIES
+    return mappings
+
 def put_mappings( hosts, index, mappings_path, models_dir ):
     """Puts mappings from file into ES.
     
@@ -331,6 +571,7 @@ def put_facets( hosts, index, path=FACETS_PATH ):
 def list_facets( path=FACETS_PATH ):
     return [filename.replace('.json', '') for filename in os.listdir(path)]
 
+@_cached_query
 def facet_terms( hosts, index, facet, order='term', all_terms=True, model=None ):
     """Gets list of terms for the facet.
     
@@ -391,6 +632,104 @@ def facet_terms( hosts, index, facet, order='term', all_terms=True, model=None )
     results = es.search(index=index, doc_type=model, body=payload)
     return results['facets']['results']
 
+# facet_terms order -> terms aggregation order
+FACET_AGGS_ORDER = {
+    'term': {'_term':'asc'},
+    'reverse_term': {'_term':'desc'},
+    'count': {'_count':'desc'},
+    'reverse_count': {'_count':'asc'},
+}
+
+def _facets_aggs( facets, order='term', all_terms=True ):
+    """Makes aggregations that count terms and missing values for each facet.
+    
+    @param facets: list of field names
+    @param order: term, count, reverse_term, reverse_count
+    @param all_terms: boolean Include terms that match no documents.
+    @returns: dict
+    """
+    aggs = {}
+    for facet in facets:
+        aggs[facet] = {
+            'terms': {
+                'field': facet,
+                'size': 0, # all terms
+                'order': FACET_AGGS_ORDER[order],
+                'min_doc_count': 0 if all_terms else 1,
+            }
+        }
+        aggs['%s__missing' % facet] = {'missing': {'field': facet}}
+    return aggs
+
+def _aggs_facet( aggregations, facet ):
+    """Converts a facet's aggregations into facet_terms() output.
+    
+    @param aggregations: dict The 'aggregations' part of ES results.
+    @param facet: Name of field
+    @returns: dict with _type, missing, total, other, terms
+    """
+    buckets = aggregations[facet]['buckets']
+    terms = [{'term':bucket['key'], 'count':bucket['doc_count']} for bucket in buckets]
+    other = aggregations[facet].get('sum_other_doc_count', 0)
+    return {
+        '_type': 'terms',
+        'missing': aggregations['%s__missing' % facet]['doc_count'],
+        'total': sum([term['count'] for term in terms]) + other,
+        'other': other,
+        'terms': terms,
+    }
+
+@_cached_query
+def facets_terms( hosts, index, facets, order='term', all_terms=True, model=None, query='', term={}, filters={} ):
+    """Gets lists of terms for several facets in a single request.
+    
+    Counts can be limited to the documents matching a search by passing
+    the same query, term, and filters given to search().
+    
+    >>> facets_terms(HOSTS, 'ddr', list_facets(), model='entity', query='heart mountain')
+    {'genre': {'_type':'terms', 'missing':203, 'total':49, 'other':0, 'terms':[...]}, ...}
+    
+    @param hosts: list of dicts containing host information.
+    @param index: Name of the target index.
+    @param facets: list of field names
+    @param order: term, count, reverse_term, reverse_count
+    @param all_terms: boolean Include terms that match no documents.
+    @param model: (optional) Type of object ('collection', 'entity', 'file')
+    @param query: User's search text
+    @param term: dict
+    @param filters: dict
+    @returns: dict of facet_terms() outputs, keyed by facet name
+    """
+    if not facets:
+        return {}
+    # copy so the caller's dict isn't modified
+    filters = dict(filters or {})
+    _clean_dict(filters)
+    must = []
+    if query:
+        must.append({'query_string': {'query':query}})
+    if term:
+        must.append({'term':term})
+    if len(must) > 1:
+        q = {'bool': {'must':must}}
+    elif must:
+        q = must[0]
+    else:
+        q = {'match_all':{}}
+    if filters:
+        # filter the documents that are counted, not just the hits
+        q = {'filtered': {'query':q, 'filter':{'term':filters}}}
+    body = {
+        'query': q,
+        'aggs': _facets_aggs(facets, order, all_terms),
+    }
+    es = _get_connection(hosts)
+    results = es.search(index=index, doc_type=model, body=body, search_type='count')
+    return dict([
+        (facet, _aggs_facet(results['aggregations'], facet))
+        for facet in facets
+    ])
+
 def repo( hosts, index, path ):
     """Add or update base repository metadata.
     """
@@ -405,6 +744,7 @@ def repo( hosts, index, path ):
     doctype = 'repo'
     es = _get_connection(hosts)
     results = es.index(index=index, doc_type=doctype, id=document_id, body=data)
+    QUERY_CACHE.invalidate(hosts)
     return results
 
 def org( hosts, index, path, remove=False):
@@ -424,6 +764,7 @@ def org( hosts, index, path, remove=False):
         results = es.delete(index=index, doc_type=doctype, id=document_id)
     else:
         results = es.index(index=index, doc_type=doctype, id=document_id, body=data)
+    QUERY_CACHE.invalidate(hosts)
     return results
 
 
@@ -456,13 +797,21 @@ def _is_publishable( data ):
     @param data: Standard DDR list-of-dicts data structure.
     @returns: True/False
     """
-    publishable = False
     status = None
     public = None
     for field in data:
         fieldname = field.keys()[0]
         if   fieldname == 'status': status = field['status']
         elif fieldname == 'public': public = field['public']
+    return _publishable_values(status, public)
+
+def _publishable_values( status, public ):
+    """Determines if an object with these status,public values is publishable
+    
+    @param status: Value of object's status field or None (files).
+    @param public: Value of object's public field.
+    @returns: True/False
+    """
     # collections, entities
     if status and public and (status in STATUS_OK) and (public in PUBLIC_OK):
         return True
@@ -670,54 +1019,102 @@ def _clean_payload( data ):
             # rm null or empty fields
             _clean_dict(field)
 
-def post( hosts, index, document, public_fields=[], additional_fields={} ):
-    """Add a new document to an index or update an existing one.
+# Functions that normalize the contents of particular fields, by field name.
+FIELD_CLEANERS = {
+    'creators': _clean_creators,
+    'facility': _clean_facility,
+    'parent': _clean_parent,
+    'topics': _clean_topics,
+}
+
+# Extra transform stages.  Each is a function that takes the document dict
+# produced by make_transform and returns it (or a replacement).
+# Append your own; they are run in order on every publishable document.
+TRANSFORM_STAGES = []
+
+def make_transform( public_fields=[], cleaners=FIELD_CLEANERS, stages=None ):
+    """Compiles a function that turns a DDR list-of-dicts document into a dict.
+    
+    Does the same job as _is_publishable, _filter_payload, _clean_payload
+    and the list-of-dicts to dict restructuring, in a single pass through
+    the document's fields.  Public fields are looked up in a set and
+    cleaners in a dict, so make one transform per model and reuse it.
+    The document itself is not modified.
+    
+    >>> transform = make_transform(['id', 'public', 'topics'])
+    >>> data = transform([{'app_commit': 'abc'}, {'id': 'ddr-testing-123-1'}, {'secret': 'x'}, {'topics': 'Topics [123]'}, {'public': 1}])
+    >>> sorted(data.items())
+    [('app_commit', 'abc'), ('id', 'ddr-testing-123-1'), ('public', 1), ('topics', ['123'])]
+    >>> transform([{'app_commit': 'abc'}, {'id': 'ddr-testing-123-1'}, {'public': 0}])
     
-    This function can produce ElasticSearch documents in two formats:
-    - old-style list-of-dicts used in the DDR JSON files.
-    - normal dicts used by ddr-public.
-    
-    DDR metadata JSON files are structured as a list of fieldname:value dicts.
-    This is done so that the fields are always in the same order, making it
-    possible to easily see the difference between versions of a file.
-    
-    In ElasticSearch, documents are structured in a normal dict so that faceting
-    works properly.
-    
-    curl -XPUT 'http://localhost:9200/ddr/collection/ddr-testing-141' -d '{ ... }'
+    @param public_fields: List of field names; if present, fields not in list will be removed.
+    @param cleaners: dict of field name: function(value) returning cleaned value.
+    @param stages: List of functions(data) run after the field pass; default TRANSFORM_STAGES.
+    @returns: function(document) returning dict, or None if document is not publishable.
+    """
+    public = None
+    if public_fields:
+        public = frozenset(public_fields)
+    if stages is None:
+        stages = TRANSFORM_STAGES
+    def transform( document ):
+        data = {}
+        status = None
+        publicval = None
+        first = True
+        for field in document:
+            for key,value in field.iteritems():
+                if   key == 'status': status = value
+                elif key == 'public': publicval = value
+                # initial metadata field (DDR release, git-annex version, etc) passes as-is
+                if first:
+                    data[key] = value
+                    continue
+                if (public is not None) and (key not in public):
+                    continue
+                cleaner = cleaners.get(key, None)
+                if cleaner:
+                    value = cleaner(value)
+                # rm null or empty fields; ElasticSearch chokes on them
+                if value:
+                    data[key] = value
+            first = False
+        # die if document is public=False or status=incomplete
+        if not _publishable_values(status, publicval):
+            return None
+        for stage in stages:
+            data = stage(data)
+        return data
+    return transform
+
+def _prep_document( document, public_fields=[], additional_fields={}, transform=None ):
+    """Turns a DDR list-of-dicts document into the dict that gets POSTed.
+    
+    Used by post() and by the bulk indexer so that both send exactly the
+    same documents to ElasticSearch.
     
-    @param hosts: list of dicts containing host information.
-    @param index: 
     @param document: The object to post.
     @param public_fields: List of field names; if present, fields not in list will be removed.
     @param additional_fields: dict of fields added during indexing process
-    @returns: JSON dict with status code and response
+    @param transform: (optional) Output of make_transform(public_fields).
+    @returns: model,document_id,data,error (error is a status dict or None)
     """
-    logger.debug('post(%s, %s, %s, %s, %s)' % (hosts, index, document, public_fields, additional_fields))
-    
-    # die if document is public=False or status=incomplete
-    if not _is_publishable(document):
-        return {'status':403, 'response':'object not publishable'}
-    # remove non-public fields
-    _filter_payload(document, public_fields)
-    # normalize field contents
-    _clean_payload(document)
-    
-    # restructure from list-of-fields dict to straight dict used by ddr-public
-    data = {}
-    for field in document:
-        for k,v in field.iteritems():
-            data[k] = v
+    if not transform:
+        transform = make_transform(public_fields)
+    # filter, clean, and restructure from list-of-fields dict to straight dict used by ddr-public
+    data = transform(document)
+    if data is None:
+        return None,None,None,{'status':403, 'response':'object not publishable'}
     
     document_id = None
     model = models.model_from_dict(data)
     if model in ['collection', 'entity']:
         if not (data and data.get('id', None)):
-            return {'status':2, 'response':'no id'}
+            return model,None,None,{'status':2, 'response':'no id'}
         document_id = data['id']
     elif model in ['file']:
         if not (data and data.get('path_rel', None)):
-            return {'status':3, 'response':'no path_rel'}
+            return model,None,None,{'status':3, 'response':'no path_rel'}
         filename = None
         extension = None
         if data.get('path_rel',None):
@@ -742,12 +1139,191 @@ def post( hosts, index, document, public_fields=[], additional_fields={} ):
     # additional_fields
     for key,val in additional_fields.iteritems():
         data[key] = val
+    data['content_hash'] = content_hash(data)
+    
+    if not document_id:
+        return model,None,data,{'status':4, 'response':'unknown problem'}
+    return model,document_id,data,None
 
-    if document_id:
-        es = _get_connection(hosts)
-        status = es.index(index=index, doc_type=model, id=document_id, body=data)
-        return status
-    return {'status':4, 'response':'unknown problem'}
+def content_hash( data ):
+    """SHA1 of a prepared document, used to tell if the indexed copy is current.
+    
+    Any existing content_hash field is ignored.
+    
+    @param data: dict Document as prepared by _prep_document.
+    @returns: str
+    """
+    content = dict([(key,val) for key,val in data.iteritems() if key != 'content_hash'])
+    return hashlib.sha1(
+        json.dumps(content, sort_keys=True, separators=(',',':'))
+    ).hexdigest()
+
+def post( hosts, index, document, public_fields=[], additional_fields={}, transform=None ):
+    """Add a new document to an index or update an existing one.
+    
+    This function can produce ElasticSearch documents in two formats:
+    - old-style list-of-dicts used in the DDR JSON files.
+    - normal dicts used by ddr-public.
+    
+    DDR metadata JSON files are structured as a list of fieldname:value dicts.
+    This is done so that the fields are always in the same order, making it
+    possible to easily see the difference between versions of a file.
+    
+    In ElasticSearch, documents are structured in a normal dict so that faceting
+    works properly.
+    
+    curl -XPUT 'http://localhost:9200/ddr/collection/ddr-testing-141' -d '{ ... }'
+    
+    @param hosts: list of dicts containing host information.
+    @param index: 
+    @param document: The object to post.
+    @param public_fields: List of field names; if present, fields not in list will be removed.
+    @param additional_fields: dict of fields added during indexing process
+    @param transform: (optional) Output of make_transform(public_fields).
+    @returns: JSON dict with status code and response
+    """
+    logger.debug('post(%s, %s, %s, %s, %s)' % (hosts, index, document, public_fields, additional_fields))
+    model,document_id,data,error = _prep_document(document, public_fields, additional_fields, transform)
+    if error:
+        return error
+    es = _get_connection(hosts)
+    status = es.index(index=index, doc_type=model, id=document_id, body=data)
+    QUERY_CACHE.invalidate(hosts)
+    return status
+
+def _index_document( hosts, index, model, document_id, data ):
+    """Sends one prepared document; reports the result like bulk_post.
+    
+    @param hosts: list of dicts containing host information.
+    @param index: Name of the target index.
+    @param model: Type of object ('collection', 'entity', 'file')
+    @param document_id:
+    @param data: dict Output of _prep_document
+    @returns: (status, response) status is 201 if created, 200 if updated
+    """
+    es = _get_connection(hosts)
+    try:
+        response = es.index(index=index, doc_type=model, id=document_id, body=data)
+    except Exception as err:
+        return getattr(err, 'status_code', 500), str(err)
+    finally:
+        QUERY_CACHE.invalidate(hosts)
+    if response.get('created', False):
+        return 201, response
+    return 200, response
+
+def _indexed_hashes( hosts, index, documents ):
+    """Gets content_hash of the indexed copies of documents, in one request.
+    
+    @param hosts: list of dicts containing host information.
+    @param index: Name of the target index.
+    @param documents: list of (model,document_id) tuples
+    @returns: dict of content_hash by document_id; documents not found or without hash are omitted.
+    """
+    try:
+        found = mget(hosts, index, documents, fields=['content_hash'])
+    except Exception as err:
+        logger.error('could not get content hashes: %s' % err)
+        return {}
+    hashes = {}
+    for doc in found:
+        h = _unlist(doc.get('fields', {}).get('content_hash', None))
+        if h:
+            hashes[doc['_id']] = h
+    return hashes
+
+def _bulk_chunks( actions, chunk_size=BULK_CHUNK_SIZE, max_bytes=BULK_CHUNK_BYTES ):
+    """Groups bulk actions into chunks limited by document count and size.
+    
+    A chunk is closed when it holds chunk_size actions or when adding the
+    next action would push it over max_bytes.  An action larger than
+    max_bytes is sent in a chunk by itself.
+    
+    >>> actions = [('a', '{"index":{}}', '{}'), ('b', '{"index":{}}', '{}')]
+    >>> [[key for key,action,data in chunk] for chunk in _bulk_chunks(actions, chunk_size=1)]
+    [['a'], ['b']]
+    
+    @param actions: iterable of (key, action line, data line) tuples; data is None for deletes
+    @param chunk_size: int Maximum number of actions per chunk
+    @param max_bytes: int Maximum size of a chunk's request body in bytes
+    @returns: generator of lists of (key, action line, data line) tuples
+    """
+    chunk = []
+    size = 0
+    for key,action,data in actions:
+        action_size = len(action) + len(data or '') + 2 # newlines
+        if chunk and ((len(chunk) >= chunk_size) or (size + action_size > max_bytes)):
+            yield chunk
+            chunk = []
+            size = 0
+        chunk.append( (key,action,data) )
+        size += action_size
+    if chunk:
+        yield chunk
+
+def bulk_post( hosts, index, documents, chunk_size=BULK_CHUNK_SIZE, max_bytes=BULK_CHUNK_BYTES ):
+    """Add or update many documents using the ElasticSearch _bulk API.
+    
+    Documents must already be prepared (see _prep_document).  Each
+    document is tagged with a key (e.g. the path of its JSON file) which
+    is handed back with the per-document result.
+    
+    curl -XPOST 'http://localhost:9200/_bulk' --data-binary @requests
+    
+    @param hosts: list of dicts containing host information.
+    @param index: Name of the target index.
+    @param documents: iterable of (key, model, document_id, data) tuples
+    @param chunk_size: int Maximum number of documents per request
+    @param max_bytes: int Maximum size of a request body in bytes
+    @returns: generator of (key, status, response) tuples
+    """
+    logger.debug('bulk_post(%s, %s, %s, %s)' % (hosts, index, chunk_size, max_bytes))
+    def _actions():
+        for key,model,document_id,data in documents:
+            action = {'index': {'_index':index, '_type':model, '_id':document_id}}
+            yield key, json.dumps(action), json.dumps(data)
+    return _bulk_request(hosts, _actions(), chunk_size, max_bytes)
+
+def bulk_delete( hosts, index, documents, chunk_size=BULK_CHUNK_SIZE ):
+    """Delete many documents using the ElasticSearch _bulk API.
+    
+    Documents that are not in the index come back with status 404.
+    
+    @param hosts: list of dicts containing host information.
+    @param index: Name of the target index.
+    @param documents: iterable of (model, document_id) tuples
+    @param chunk_size: int Maximum number of documents per request
+    @returns: generator of (document_id, status, response) tuples
+    """
+    logger.debug('bulk_delete(%s, %s, %s)' % (hosts, index, chunk_size))
+    def _actions():
+        for model,document_id in documents:
+            action = {'delete': {'_index':index, '_type':model, '_id':document_id}}
+            yield document_id, json.dumps(action), None
+    return _bulk_request(hosts, _actions(), chunk_size, BULK_CHUNK_BYTES)
+
+def _bulk_request( hosts, actions, chunk_size, max_bytes ):
+    """Sends chunks of bulk actions, yields per-action results.
+    
+    @param hosts: list of dicts containing host information.
+    @param actions: iterable of (key, action line, data line) tuples; data is None for deletes
+    @param chunk_size: int Maximum number of actions per request
+    @param max_bytes: int Maximum size of a request body in bytes
+    @returns: generator of (key, status, response) tuples
+    """
+    es = _get_connection(hosts)
+    for chunk in _bulk_chunks(actions, chunk_size, max_bytes):
+        lines = []
+        for key,action,data in chunk:
+            lines.append(action)
+            if data is not None:
+                lines.append(data)
+        response = es.bulk(body='%s\n' % '\n'.join(lines))
+        QUERY_CACHE.invalidate(hosts)
+        for (key,action,data),item in zip(chunk, response['items']):
+            result = item.values()[0]
+            status = result.get('status', 500)
+            yield key, status, result.get('error', result)
 
 
 def exists( hosts, index, model, document_id ):
@@ -761,6 +1337,7 @@ def exists( hosts, index, model, document_id ):
     return es.exists(index=index, doc_type=model, id=document_id)
 
 
+@_cached_query
 def get( hosts, index, model, document_id, fields=None ):
     """
     @param hosts: list of dicts containing host information.
@@ -769,11 +1346,38 @@ def get( hosts, index, model, document_id, fields=None ):
     @param document_id:
     """
     es = _get_connection(hosts)
-    if exists(hosts, index, model, document_id):
+    try:
         if fields is not None:
             return es.get(index=index, doc_type=model, id=document_id, fields=fields)
         return es.get(index=index, doc_type=model, id=document_id)
-    return None
+    except NotFoundError:
+        return None
+
+def mget( hosts, index, documents, fields=None ):
+    """Gets multiple documents in a single request.
+    
+    >>> mget(HOSTS, 'ddr', [('entity','ddr-test-123-1'), ('file','ddr-test-123-1-master-a1b2c3')], fields=['id','title'])
+    
+    @param hosts: list of dicts containing host information.
+    @param index: Name of the target index.
+    @param documents: list of (model,document_id) tuples
+    @param fields: (optional) list of field names; [] returns only IDs and versions.
+    @returns: list of raw ElasticSearch documents that were found, in the order requested.
+    """
+    if not documents:
+        return []
+    docs = []
+    for model,document_id in documents:
+        doc = {'_type':model, '_id':document_id}
+        if fields is not None:
+            doc['fields'] = fields
+        docs.append(doc)
+    es = _get_connection(hosts)
+    try:
+        results = es.mget(index=index, body={'docs':docs})
+    except NotFoundError:
+        return []
+    return [doc for doc in results['docs'] if doc.get('found', False)]
 
 
 REPOSITORY_LIST_FIELDS = ['id', 'title', 'description', 'url',]
@@ -828,9 +1432,8 @@ class PageNotAnInteger(InvalidPage):
 class EmptyPage(InvalidPage):
     pass
 
-def _validate_number(number, num_pages):
-        """Validates the given 1-based page number.
-        see django.core.pagination.Paginator.validate_number
+def _validate_page(number):
+        """Validates type and lower bound of the given 1-based page number.
         """
         try:
             number = int(number)
@@ -838,6 +1441,13 @@ def _validate_number(number, num_pages):
             raise PageNotAnInteger('That page number is not an integer')
         if number < 1:
             raise EmptyPage('That page number is less than 1')
+        return number
+
+def _validate_number(number, num_pages):
+        """Validates the given 1-based page number.
+        see django.core.pagination.Paginator.validate_number
+        """
+        number = _validate_page(number)
         if number > num_pages:
             if number == 1:
                 pass
@@ -878,11 +1488,6 @@ def massage_query_results( results, thispage, page_size ):
     @param page_size: Number of objects per page
     @returns: list of hit dicts, with empty "hits" fore and aft of current page
     """
-    def unlistify(o, fieldname):
-        if o.get(fieldname, None):
-            if isinstance(o[fieldname], list):
-                o[fieldname] = o[fieldname][0]
-    
     objects = []
     if results and results['hits']:
         total = results['hits']['total']
@@ -893,22 +1498,100 @@ def massage_query_results( results, thispage, page_size ):
                  'id': hit['_id'],
                  'placeholder': True}
             if (n >= bottom) and (n < top):
-                # if we tell ES to only return certain fields, the object is in 'fields'
-                if hit.get('fields', None):
-                    o = hit['fields']
-                elif hit.get('_source', None):
-                    o = hit['_source']
-                # copy ES results info to individual object source
-                o['index'] = hit['_index']
-                o['type'] = hit['_type']
-                o['model'] = hit['_type']
-                o['id'] = hit['_id']
-                # ElasticSearch wraps field values in lists when you use a 'fields' array in a query
-                for fieldname in all_list_fields():
-                    unlistify(o, fieldname)
+                o = _hit_object(hit)
             objects.append(o)
     return objects
 
+def _hit_object( hit, list_fields=None ):
+    """Makes facsimile of original object from an ElasticSearch hit.
+    
+    @param hit: dict One item from ElasticSearch results['hits']['hits'].
+    @param list_fields: Output of all_list_fields()
+    @returns: dict
+    """
+    if list_fields is None:
+        list_fields = all_list_fields()
+    o = {}
+    # if we tell ES to only return certain fields, the object is in 'fields'
+    if hit.get('fields', None):
+        o = hit['fields']
+    elif hit.get('_source', None):
+        o = hit['_source']
+    # copy ES results info to individual object source
+    o['index'] = hit['_index']
+    o['type'] = hit['_type']
+    o['model'] = hit['_type']
+    o['id'] = hit['_id']
+    # ElasticSearch wraps field values in lists when you use a 'fields' array in a query
+    for fieldname in list_fields:
+        if o.get(fieldname, None) and isinstance(o[fieldname], list):
+            o[fieldname] = o[fieldname][0]
+    return o
+
+class SearchResults( object ):
+    """One page of search results, in a form Django's Paginator can use.
+    
+    Paginator needs the size of the whole result set (count() or len()),
+    and then slices out the objects for the current page.  Only the
+    requested page is fetched from ElasticSearch, and no placeholders are
+    made for the rest.  Slicing outside the fetched page runs another
+    query for just that range.
+    
+    >>> results = search_results(HOSTS, 'ddr', page=3, page_size=20, query='heart mountain')
+    >>> paginator = Paginator(results, 20)
+    >>> page = paginator.page(3)
+    
+    @param hosts: list of dicts containing host information.
+    @param index: Name of the target index.
+    @param search_args: dict of keyword arguments to search().
+    @param first: int Index of first object in results.
+    @param results: raw ElasticSearch query output
+    """
+    hosts = None
+    index = None
+    search_args = {}
+    first = 0
+    total = 0
+    objects = []
+    
+    def __init__( self, hosts, index, search_args, first, results ):
+        self.hosts = hosts
+        self.index = index
+        self.search_args = search_args
+        self.first = first
+        self.total = results['hits']['total']
+        list_fields = all_list_fields()
+        self.objects = [_hit_object(hit, list_fields) for hit in results['hits']['hits']]
+    
+    def count( self ):
+        return self.total
+    
+    def __len__( self ):
+        return self.total
+    
+    def __iter__( self ):
+        return iter(self.objects)
+    
+    def __getitem__( self, key ):
+        if isinstance(key, slice):
+            start,stop,step = key.indices(self.total)
+            return self._range(start, stop)[::step]
+        if key < 0:
+            key = self.total + key
+        if (key < 0) or (key >= self.total):
+            raise IndexError('search results index out of range')
+        return self._range(key, key + 1)[0]
+    
+    def _range( self, start, stop ):
+        last = self.first + len(self.objects)
+        if (start >= self.first) and (stop <= last):
+            return self.objects[start - self.first:stop - self.first]
+        if stop <= start:
+            return []
+        results = search(self.hosts, self.index, first=start, size=stop - start, **self.search_args)
+        list_fields = all_list_fields()
+        return [_hit_object(hit, list_fields) for hit in results['hits']['hits']]
+
 def _clean_sort( sort ):
     """Take list of [a,b] lists, return comma-separated list of a:b pairs
     
@@ -924,6 +1607,7 @@ def _clean_sort( sort ):
             cleaned = ','.join([':'.join(x) for x in sort])
     return cleaned
 
+@_cached_query
 def search( hosts, index, model='', query='', term={}, filters={}, sort=[], fields=[], first=0, size=MAX_SIZE ):
     """Run a query, get a list of zero or more hits.
     
@@ -959,6 +1643,7 @@ def search( hosts, index, model='', query='', term={}, filters={}, sort=[], fiel
             q=query,
             body=body,
             sort=sort_cleaned,
+            from_=first,
             size=size,
             fields=fields,
         )
@@ -968,29 +1653,227 @@ def search( hosts, index, model='', query='', term={}, filters={}, sort=[], fiel
             doc_type=model,
             body=body,
             sort=sort_cleaned,
+            from_=first,
             size=size,
             fields=fields,
         )
     return results
 
-def delete( hosts, index, document_id, recursive=False ):
+def search_results( hosts, index, page=1, page_size=DEFAULT_PAGE_SIZE, model='', query='', term={}, filters={}, sort=[], fields=[] ):
+    """Run a query, get one page of hits and the total number of hits.
+    
+    Unlike search() + massage_query_results(), only the requested page
+    is transferred from ElasticSearch.
+    
+    @param hosts: list of dicts containing host information.
+    @param index: Name of the target index.
+    @param page: int 1-based page number
+    @param page_size: int Number of objects per page
+    @param model: Type of object ('collection', 'entity', 'file')
+    @param query: User's search text
+    @param term: dict
+    @param filters: dict
+    @param sort: list of (fieldname,direction) tuples
+    @param fields: str
+    @returns: SearchResults
+    """
+    # upper bound can only be checked once we have a total
+    page = _validate_page(page)
+    first = (page - 1) * page_size
+    search_args = {
+        'model': model, 'query': query, 'term': term, 'filters': filters,
+        'sort': sort, 'fields': fields,
+    }
+    results = search(hosts, index, first=first, size=page_size, **search_args)
+    _page_bottom_top(results['hits']['total'], page, page_size)
+    return SearchResults(hosts, index, search_args, first, results)
+
+def _scan_filter( filters ):
+    """Makes a filter that matches all of the field values in filters.
+    
+    >>> _scan_filter({'entity_id': ['ddr-test-1-1', 'ddr-test-1-2']})
+    {'terms': {'entity_id': ['ddr-test-1-1', 'ddr-test-1-2']}}
+    
+    @param filters: dict of field:value; a list value matches any of its items.
+    @returns: dict
+    """
+    clauses = []
+    for field,value in sorted(filters.items()):
+        if isinstance(value, list):
+            clauses.append({'terms': {field:value}})
+        else:
+            clauses.append({'term': {field:value}})
+    if len(clauses) == 1:
+        return clauses[0]
+    return {'and': clauses}
+
+def scan( hosts, index, model='', query='', term={}, filters={}, fields=[], size=SCROLL_SIZE, scroll=SCROLL_TIMEOUT ):
+    """Iterate through every hit for a query, one batch at a time.
+    
+    Uses the scan/scroll API so that only one batch of hits is in memory
+    at once, no matter how large the index is.  Hits are not sorted.
+    The scroll context is cleared when the generator finishes or is closed.
+    
+    >>> for hit in scan(HOSTS, 'ddr', model='entity', fields=['id','title']):
+    ...     print(hit['_id'])
+    
+    @param hosts: list of dicts containing host information.
+    @param index: Name of the target index.
+    @param model: Type of object ('collection', 'entity', 'file')
+    @param query: User's search text
+    @param term: dict
+    @param filters: dict; a list value matches any of the values in it.
+    @param fields: list of field names; if empty, hits contain the whole _source.
+    @param size: int Number of hits per shard per batch.
+    @param scroll: str How long ES should keep the scroll context between batches.
+    @returns: generator of raw ElasticSearch hits
+    """
+    logger.debug('scan( hosts=%s, index=%s, model=%s, query=%s, term=%s, filters=%s, fields=%s, size=%s, scroll=%s' % (hosts, index, model, query, term, filters, fields, size, scroll))
+    body = {}
+    if term:
+        body['query'] = {'term':term}
+    if filters:
+        body['filter'] = _scan_filter(filters)
+    kwargs = {
+        'index': index,
+        'doc_type': model,
+        'body': body,
+        'search_type': 'scan',
+        'scroll': scroll,
+        'size': size,
+    }
+    if query:
+        kwargs['q'] = query
+    if fields:
+        kwargs['fields'] = ','.join(fields)
+    es = _get_connection(hosts)
+    # scan searches return no hits, just the ID of the first batch
+    results = es.search(**kwargs)
+    scroll_id = results.get('_scroll_id')
+    try:
+        while scroll_id:
+            results = es.scroll(scroll_id=scroll_id, scroll=scroll)
+            hits = results['hits']['hits']
+            if not hits:
+                break
+            for hit in hits:
+                yield hit
+            scroll_id = results.get('_scroll_id')
+    finally:
+        if scroll_id:
+            try:
+                es.clear_scroll(scroll_id=scroll_id)
+            except NotFoundError:
+                # context already expired
+                pass
+
+def dump( hosts, index, output, model='', fields=[], size=SCROLL_SIZE ):
+    """Write every document in an index to newline-delimited JSON.
+    
+    Each line is one raw ElasticSearch hit (_index, _type, _id, and
+    _source or fields).  Documents are streamed so memory use stays the
+    same no matter how large the index is.
+    
+    @param hosts: list of dicts containing host information.
+    @param index: Name of the target index.
+    @param output: File-like object.
+    @param model: Type of object ('collection', 'entity', 'file')
+    @param fields: list of field names; if empty, dump whole documents.
+    @param size: int Number of hits per shard per batch.
+    @returns: int Number of documents written
+    """
+    n = 0
+    for hit in scan(hosts, index, model=model, fields=fields, size=size):
+        hit.pop('_score', None)
+        output.write(json.dumps(hit))
+        output.write('\n')
+        n += 1
+    return n
+
+def _child_ids_from_path( path ):
+    """Lists (model,id) of the objects under a collection or entity directory.
+    
+    @param path: Absolute path to a collection or entity directory.
+    @returns: list of (model,document_id) tuples, files first
+    """
+    children = []
+    for json_path in models.metadata_files(path, recursive=True, files_first=True):
+        model = models.model_from_path(json_path)
+        if model and (os.path.dirname(json_path) != os.path.normpath(path)):
+            children.append( (model, models.id_from_path(json_path)) )
+    return children
+
+def _child_ids_from_index( hosts, index, document_id, chunk_size=BULK_CHUNK_SIZE ):
+    """Lists (model,id) of the descendants of a collection or entity in the index.
+    
+    Entities are found by collection_id.  Files are found by entity_id,
+    which file documents have always had, and by collection_id.
+    
+    @param hosts: list of dicts containing host information.
+    @param index: Name of the target index.
+    @param document_id: ID of a collection or entity.
+    @param chunk_size: int Number of entity IDs per files query.
+    @returns: list of (model,document_id) tuples, files first
+    """
+    model = models.split_object_id(document_id)[0]
+    entity_ids = []
+    file_ids = set()
+    if model == 'collection':
+        for hit in scan(hosts, index, model='entity,file', filters={'collection_id':document_id}, fields=['id']):
+            if hit['_type'] == 'entity':
+                entity_ids.append(hit['_id'])
+            elif hit['_type'] == 'file':
+                file_ids.add(hit['_id'])
+    elif model == 'entity':
+        entity_ids = [document_id]
+    for n in range(0, len(entity_ids), chunk_size):
+        chunk = entity_ids[n:n+chunk_size]
+        for hit in scan(hosts, index, model='file', filters={'entity_id':chunk}, fields=['id']):
+            file_ids.add(hit['_id'])
+    children = [('file',file_id) for file_id in sorted(file_ids)]
+    if model == 'collection':
+        children += [('entity',entity_id) for entity_id in entity_ids]
+    return children
+
+def delete( hosts, index, document_id, recursive=False, path=None ):
     """Delete a document and optionally its children.
     
+    Children are listed from the collection or entity directory if path
+    is given, otherwise from the index.  They are deleted with the bulk
+    API, files first, and the document itself last, so an interrupted
+    delete can simply be run again.
+    
     @param hosts: list of dicts containing host information.
     @param index:
     @param document_id:
     @param recursive: True or False
+    @param path: (optional) Absolute path to the object's directory.
+    @returns: ES response, or if recursive a dict with deleted, not_found, and bad counts.
     """
     model = models.split_object_id(document_id)[0]
     es = _get_connection(hosts)
-    if recursive:
-        if model == 'collection': doc_type = 'collection,entity,file'
-        elif model == 'entity': doc_type = 'entity,file'
-        elif model == 'file': doc_type = 'file'
-        query = 'id:"%s"' % document_id
-        return es.delete_by_query(index=index, doc_type=doc_type, q=query)
+    if not recursive:
+        try:
+            return es.delete(index=index, doc_type=model, id=document_id)
+        finally:
+            QUERY_CACHE.invalidate(hosts)
+    
+    # bulk_delete invalidates the query cache after each request
+    if model == 'file':
+        children = []
+    elif path:
+        children = _child_ids_from_path(path)
     else:
-        return es.delete(index=index, doc_type=model, id=document_id)
+        children = _child_ids_from_index(hosts, index, document_id)
+    results = {'deleted':0, 'not_found':0, 'bad':[]}
+    for object_id,status,response in bulk_delete(hosts, index, children + [(model,document_id)]):
+        if status in SUCCESS_STATUSES:
+            results['deleted'] += 1
+        elif status == 404:
+            results['not_found'] += 1
+        else:
+            results['bad'].append((object_id, status, str(response)))
+    return results
 
 
 # index ----------------------------------------------------------------
@@ -1002,13 +1885,7 @@ def _model_fields( basedir, model_names ):
     @param model_names: List of model names
     @return: Dict of models
     """
-    models = {}
-    for model_name in model_names:
-        json_path = os.path.join(basedir, '%s.json' % model_name)
-        with open(json_path, 'r') as f:
-            data = json.loads(f.read())
-        models[model_name] = data
-    return models
+    return models.model_definitions(basedir, model_names)
 
 def _public_fields( modelfields ):
     """Lists public fields for each model
@@ -1018,42 +1895,77 @@ def _public_fields( modelfields ):
     @param modelfields: Output of _model_fields
     @returns: Dict
     """
-    public_fields = {}
-    for model in modelfields.keys():
-        mfields = []
-        for field in modelfields[model]:
-            if field.get('elasticsearch',None) and field['elasticsearch'].get('public',None):
-                mfields.append(field['name'])
-        public_fields[model] = mfields
-    # add dynamically created fields
-    public_fields['file'].append('path_rel')
-    public_fields['file'].append('id')
-    return public_fields
-
-def _parents_status( paths ):
-    """Stores value of public,status for each collection,entity so entities,files can inherit.
+    return models._public_fields(modelfields)
+
+def _metadata_record( path, document=None, access=False ):
+    """Packages the information index() needs about a single metadata file.
+    
+    >>> r = _metadata_record('.../ddr-testing-123-1/entity.json', [{'id':'ddr-testing-123-1'}, {'public':'1'}])
+    >>> r['model'], r['id'], r['parent_ids'], r['public'], r['status']
+    ('entity', 'ddr-testing-123-1', ['ddr-testing-123'], '1', None)
     
-    @param paths
+    @param path: Absolute path to metadata JSON file.
+    @param document: Parsed contents of the file (see load_document_json).
+    @param access: Whether the file has a corresponding access file.
     @returns: dict
     """
-    parents = {}
-    def _make_coll_ent(path):
-        """Store values of id,public,status for a collection or entity.
-        """
-        p = {'id':None,
-             'public':None,
-             'status':None,}
-        with open(path, 'r') as f:
-            data = json.loads(f.read())
-        for field in data:
+    model = models.model_from_path(path)
+    record = {
+        'path': path,
+        'model': model,
+        'id': models.id_from_path(path),
+        'parent_ids': _file_parent_ids(model, path),
+        'public': None,
+        'status': None,
+        'access': access,
+        'document': document,
+    }
+    if document:
+        for field in document:
             fname = field.keys()[0]
-            if fname in p.keys():
-                p[fname] = field[fname]
-        return p
+            if fname in ['public', 'status']:
+                record[fname] = field[fname]
+    return record
+
+def _load_metadata( paths, parse=None ):
+    """Reads each metadata file once and returns a list of records.
+    
+    Records (see _metadata_record) are returned in the same order as paths.
+    Access files are looked up in a listing of each directory, rather than
+    with a stat() per file.
+    Files in paths but not in parse are listed but not read or parsed;
+    this is used when only some of the files are going to be posted.
+    
+    @param paths: Absolute paths to metadata JSON files.
+    @param parse: Paths to load; if None all paths are loaded.
+    @returns: list of dicts
+    """
+    listings = {}
+    records = []
     for path in paths:
-        if ('collection.json' in path) or ('entity.json' in path):
-            o = _make_coll_ent(path)
-            parents[o.pop('id')] = o
+        model = models.model_from_path(path)
+        document = None
+        if (parse is None) or (path in parse):
+            document = load_document_json(path, model, models.id_from_path(path))
+        access = False
+        if model == 'file':
+            dirname = os.path.dirname(path)
+            if dirname not in listings:
+                listings[dirname] = set(os.listdir(dirname))
+            access = _has_access_file(path, listing=listings[dirname])
+        records.append(_metadata_record(path, document, access))
+    return records
+
+def _parents_status( records ):
+    """Stores value of public,status for each collection,entity so entities,files can inherit.
+    
+    @param records: Output of _load_metadata
+    @returns: dict
+    """
+    parents = {}
+    for record in records:
+        if record['model'] in ['collection', 'entity']:
+            parents[record['id']] = {'public':record['public'], 'status':record['status'],}
     return parents
 
 def _file_parent_ids( model, path ):
@@ -1086,22 +1998,21 @@ def _file_parent_ids( model, path ):
         parent_ids.append( '-'.join([repo,org,cid]) )     # collection
     return parent_ids
 
-def _publishable_or_not( paths, parents ):
-    """Determines which paths represent publishable paths and which do not.
+def _publishable_or_not( records, parents ):
+    """Determines which records represent publishable paths and which do not.
     
-    @param paths
-    @param parents
-    @returns successful_paths,bad_paths
+    @param records: Output of _load_metadata
+    @param parents: Output of _parents_status
+    @returns successful_records,bad_paths
     """
-    successful_paths = []
+    successful_records = []
     bad_paths = []
-    for path in paths:
-        model = models.model_from_path(path)
+    for record in records:
+        path = record['path']
         # see if item's parents are incomplete or nonpublic
         # TODO Bad! Bad! Generalize this...
         UNPUBLISHABLE = []
-        parent_ids = _file_parent_ids(model, path)
-        for parent_id in parent_ids:
+        for parent_id in record['parent_ids']:
             parent = parents.get(parent_id, {})
             for x in parent.itervalues():
                 if (x not in STATUS_OK) and (x not in PUBLIC_OK):
@@ -1111,81 +2022,102 @@ def _publishable_or_not( paths, parents ):
             response = 'parent unpublishable: %s' % UNPUBLISHABLE
             bad_paths.append((path,403,response))
         if not UNPUBLISHABLE:
-            if path and index and model:
-                successful_paths.append(path)
+            if path and record['model']:
+                successful_records.append(record)
             else:
                 logger.error('missing information!: %s' % path)
-    return successful_paths,bad_paths
+    return successful_records,bad_paths
 
-def _has_access_file( path, suffix='-a.jpg' ):
+def _has_access_file( path, suffix='-a.jpg', listing=None ):
     """Determines whether the path has a corresponding access file.
     
     @param path: Absolute or relative path to JSON file.
     @param suffix: Suffix that is applied to File ID to get access file.
+    @param listing: (optional) set of filenames in the path's directory.
     @returns: True,False
     """
     base,ext = os.path.splitext(path)
     if ext == '.json':
         access = base + suffix
+        if listing is not None:
+            return os.path.basename(access) in listing
         if os.path.exists(access) or os.path.islink(access):
             return True
     return False
 
-def _store_signature_file( signatures, path, model, master_substitute ):
-    """Store signature file for collection,entity if it is "earlier" than current one.
+SIGNATURE_MASTER_SUBSTITUTE = 'zzzzzz'
+
+def _signature_key( file_id ):
+    """Natural-sort key for choosing signature files.
+    
+    'master' is replaced with something that sorts after 'mezzanine'
+    so that mezzanine files win.
     
-    IMPORTANT: remember to change 'zzzzzz' back to 'master'
+    @param file_id: File ID
+    @returns: list
     """
-    if _has_access_file(path):
-        thumbfile = models.id_from_path(path)
-        # replace 'master' with something so mezzanine wins in sort
-        thumbfile_mezzfirst = thumbfile.replace('master', master_substitute)
-        repo,org,cid,eid,role,sha1 = thumbfile.split('-')
-        collection_id = '-'.join([repo,org,cid])
-        entity_id = '-'.join([repo,org,cid,eid])
-        # # nifty little bit of code that extracts the sort field from file.json
-        # import re
-        # sort = ''
-        # with open(path, 'r') as f:
-        #     for line in f.readlines():
-        #         if '"sort":' in line:
-        #             sort = re.findall('\d+', line)[0]
-        
-        # if this entity_id is "earlier" than the existing one, add it
-        def _store( signatures, object_id, file_id ):
-            if signatures.get(object_id,None):
-                filenames = [signatures[object_id], file_id]
-                first = natural_sort(filenames)[0]
-                if file_id == first:
-                    signatures[object_id] = file_id
-            else:
-                signatures[object_id] = file_id
-        
-        _store(signatures, collection_id, thumbfile_mezzfirst)
-        _store(signatures, entity_id, thumbfile_mezzfirst)
+    return natural_sort_key(file_id.replace('master', SIGNATURE_MASTER_SUBSTITUTE))
 
-def _choose_signatures( paths ):
-    """Iterate through paths, storing signature_url for each collection, entity.
-    paths listed files first, then entities, then collections
+def select_signatures( file_ids ):
+    """Chooses a signature file for each collection and entity.
+    
+    The signature of a collection or entity is its "earliest" file in
+    natural sort order, with mezzanine files preferred over master files.
+    Each file's sort key is computed once and only the current minimum
+    for each collection and entity is kept.
     
-    @param paths
+    >>> sigs = select_signatures(['ddr-test-123-2-master-a1b2', 'ddr-test-123-10-mezzanine-c3d4', 'ddr-test-123-10-master-e5f6'])
+    >>> sigs['ddr-test-123'], sigs['ddr-test-123-10']
+    ('ddr-test-123-2-master-a1b2', 'ddr-test-123-10-mezzanine-c3d4')
+    
+    @param file_ids: IDs of files that have access files.
     @returns: dict signature_files
     """
-    SIGNATURE_MASTER_SUBSTITUTE = 'zzzzzz'
+    earliest = {}
+    for file_id in file_ids:
+        key = _signature_key(file_id)
+        repo,org,cid,eid,role,sha1 = file_id.split('-')
+        collection_id = '-'.join([repo,org,cid])
+        entity_id = '-'.join([repo,org,cid,eid])
+        for object_id in [collection_id, entity_id]:
+            current = earliest.get(object_id, None)
+            if (not current) or (key < current[0]):
+                earliest[object_id] = (key, file_id)
     signature_files = {}
-    for path in paths:
-        model = models.model_from_path(path)
-        if model == 'file':
-            # decide whether to store this as a collection/entity signature
-            _store_signature_file(signature_files, path, model, SIGNATURE_MASTER_SUBSTITUTE)
-        else:
-            # signature_urls will be waiting for collections,entities below
-            pass
-    # restore substituted roles
-    for key,value in signature_files.iteritems():
-        signature_files[key] = value.replace(SIGNATURE_MASTER_SUBSTITUTE, 'master')
+    for object_id,value in earliest.iteritems():
+        signature_files[object_id] = value[1]
     return signature_files
 
+def _choose_signatures( records ):
+    """Iterate through records, storing signature_url for each collection, entity.
+    
+    @param records: Output of _load_metadata
+    @returns: dict signature_files
+    """
+    return select_signatures(
+        [record['id'] for record in records if (record['model'] == 'file') and record['access']]
+    )
+
+def signatures( path ):
+    """Chooses signature files for the collection(s) in path without indexing.
+    
+    Files whose collection or entity is not publishable are skipped,
+    as in index().
+    
+    @param path: Absolute path to a collection or directory of collections.
+    @returns: dict signature_files
+    """
+    paths = []
+    parse = set()
+    for model,p in models.walk_metadata_files(path, recursive=True, files_first=True):
+        paths.append(p)
+        if model != 'file':
+            parse.add(p)
+    records = _load_metadata(paths, parse=parse)
+    parents = _parents_status(records)
+    successful_records,bad_paths = _publishable_or_not(records, parents)
+    return _choose_signatures(successful_records)
+
 def load_document_json( json_path, model, object_id ):
     """Load object from JSON and add some essential fields.
     """
@@ -1195,15 +2127,190 @@ def load_document_json( json_path, model, object_id ):
         document.append( {'id':object_id} )
     return document
 
-def index( hosts, index, path, models_dir=models.MODELS_DIR, recursive=False, public=True ):
+def _index_fields( record, public, public_fields, signature_files ):
+    """Gathers the per-document information index() passes to post().
+    
+    @param record: Record for the object metadata file (see _load_metadata).
+    @param public: For publication (fields not marked public will be ommitted).
+    @param public_fields: Output of _public_fields
+    @param signature_files: Output of _choose_signatures
+    @returns: model,object_id,publicfields,additional_fields
+    """
+    model = record['model']
+    object_id = record['id']
+    parent_id = models.parent_id(object_id)
+    
+    publicfields = []
+    if public and model:
+        publicfields = public_fields[model]
+    
+    additional_fields = {'parent_id': parent_id}
+    if model == 'collection': additional_fields['organization_id'] = parent_id
+    if model == 'entity': additional_fields['collection_id'] = parent_id
+    if model == 'file':
+        additional_fields['entity_id'] = parent_id
+        additional_fields['collection_id'] = models.parent_id(parent_id)
+    if model in ['collection', 'entity']:
+        additional_fields['signature_file'] = signature_files.get(object_id, '')
+    return model,object_id,publicfields,additional_fields
+
+def _indexed_commit_path( collection_path, index ):
+    return os.path.join(collection_path, '.git', 'ddr', 'index-%s' % index)
+
+def _read_indexed_commit( collection_path, index ):
+    """Returns SHA1 of the last commit of the collection that was indexed.
+    
+    @param collection_path: Absolute path to collection repo.
+    @param index: Name of the target index.
+    @returns: str or None
+    """
+    path = _indexed_commit_path(collection_path, index)
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            sha = f.read().strip()
+        if sha:
+            return sha
+    return None
+
+def _write_indexed_commit( collection_path, index, sha ):
+    """Records SHA1 of the collection commit that has just been indexed.
+    
+    @param collection_path: Absolute path to collection repo.
+    @param index: Name of the target index.
+    @param sha: SHA1 hash of commit
+    """
+    path = _indexed_commit_path(collection_path, index)
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write('%s\n' % sha)
+
+def _incremental_paths( collection_path, paths, changes, existing_signature=None ):
+    """Works out which metadata files have to be (re)posted after a commit.
+    
+    Changed files are reposted, along with the entity.json of each entity
+    whose files were added, changed, or removed, since its signature file
+    may have changed.  If an entity.json changed, all of its files are
+    reposted since they inherit its public/status values.
+    The collection signature is recomputed from the affected entities'
+    files plus the collection's current signature file; if the current
+    signature file is in an affected entity all files are used.
+    
+    A change to collection.json can affect every object in the collection,
+    so in that case this returns None and the caller must do a full index.
+    
+    @param collection_path: Absolute path to collection repo.
+    @param paths: Output of models.walk_metadata_files (files first)
+    @param changes: Output of dvcs.diff_name_status
+    @param existing_signature: ID of the collection's currently indexed signature file.
+    @returns: dict of post_paths, parent_paths, signature_paths, removed_ids; or None
+    """
+    changed = set()
+    removed_ids = []
+    entities = set()
+    entities_changed = set()
+    for status,relpath in changes:
+        if not relpath.endswith('.json'):
+            continue
+        abspath = os.path.join(collection_path, relpath)
+        model = models.model_from_path(abspath)
+        if model == 'collection':
+            return None
+        elif model == 'entity':
+            object_id = models.id_from_path(abspath)
+            entity_id = object_id
+            if status != 'D':
+                entities_changed.add(entity_id)
+        elif model == 'file':
+            object_id = models.id_from_path(abspath)
+            entity_id = models.parent_id(object_id)
+        else:
+            continue
+        entities.add(entity_id)
+        if status == 'D':
+            removed_ids.append(object_id)
+        else:
+            changed.add(abspath)
+    # the collection signature must be recalculated from scratch
+    # if the entity containing it was touched
+    all_signatures = (not existing_signature) or (models.parent_id(existing_signature) in entities)
+    post_paths = []
+    parent_paths = []
+    signature_paths = []
+    for path in paths:
+        model = models.model_from_path(path)
+        if model == 'file':
+            object_id = models.id_from_path(path)
+            entity_id = models.parent_id(object_id)
+            if (entity_id in entities) or all_signatures or (object_id == existing_signature):
+                signature_paths.append(path)
+            if (path in changed) or (entity_id in entities_changed):
+                post_paths.append(path)
+        elif model == 'entity':
+            entity_id = models.id_from_path(path)
+            if entity_id in entities:
+                post_paths.append(path)
+            if (entity_id in entities) or all_signatures:
+                parent_paths.append(path)
+        elif model == 'collection':
+            parent_paths.append(path)
+    return {
+        'post_paths': post_paths,
+        'parent_paths': parent_paths,
+        'signature_paths': signature_paths,
+        'removed_ids': removed_ids,
+    }
+
+def _existing_signature( hosts, index, collection_id ):
+    """Gets the signature_file of a collection from the index.
+    
+    @param hosts: list of dicts containing host information.
+    @param index: Name of the target index.
+    @param collection_id:
+    @returns: str or None
+    """
+    try:
+        existing = get(hosts, index, 'collection', collection_id, fields=['signature_file'])
+    except:
+        existing = None
+    if existing and existing.get('fields', None):
+        signature = existing['fields'].get('signature_file', None)
+        # ElasticSearch wraps field values in lists when you use 'fields'
+        if isinstance(signature, list):
+            signature = signature[0]
+        return signature
+    return None
+
+def _make_transforms( public_fields, public=True ):
+    """Compiles one document transform per model.
+    
+    @param public_fields: Output of models.public_fields
+    @param public: For publication (fields not marked public will be ommitted).
+    @returns: dict of make_transform() outputs, keyed by model
+    """
+    transforms = {}
+    for model,fields in public_fields.iteritems():
+        if public:
+            transforms[model] = make_transform(fields)
+        else:
+            transforms[model] = make_transform()
+    return transforms
+
+def index( hosts, index, path, models_dir=models.MODELS_DIR, recursive=False, public=True, bulk=False, chunk_size=BULK_CHUNK_SIZE, max_bytes=BULK_CHUNK_BYTES, incremental=False, force=False ):
     """(Re)index with data from the specified directory.
     
-    After receiving a list of metadata files, index() iterates through the list several times.  The first pass weeds out paths to objects that can not be published (e.g. object or its parent is unpublished).
+    After receiving a list of metadata files, index() reads and parses each file once, keeping the ID, model, public/status, parent IDs and whether an access file exists.  It then iterates through these records several times.  The first pass weeds out paths to objects that can not be published (e.g. object or its parent is unpublished).
     
     The second pass goes through the files and assigns a signature file to each entity or collection ID.
     There is some logic that tries to pick the first file of the first entity to be the collection signature, and so on.  Mezzanine files are preferred over master files.
     
     In the final pass, a list of public/publishable fields is chosen based on the model.  Additional fields not in the model (e.g. parent ID, parent organization/collection/entity ID, the signature file) are packaged.  Then everything is sent off to post().
+    
+    Before anything is sent, the content_hash of each prepared document is compared with that of the indexed copy (fetched with one mget per MGET_CHUNK_SIZE documents), and documents that have not changed are skipped.  Use force to send everything anyway.
+    
+    In bulk mode the prepared documents are sent to ElasticSearch in _bulk requests of up to chunk_size documents or max_bytes bytes, instead of one request per document.
+    
+    In incremental mode the SHA1 of the collection's HEAD commit is recorded after indexing.  On later runs only the metadata files that changed since that commit are posted (plus the entities and collection whose signatures they affect), and documents whose files were removed are deleted.  Path must be a collection repository.  If collection.json changed, or no commit was recorded, the whole collection is indexed.
 
     @param hosts: list of dicts containing host information.
     @param index: Name of the target index.
@@ -1211,31 +2318,89 @@ def index( hosts, index, path, models_dir=models.MODELS_DIR, recursive=False, pu
     @param models_dir: Absolute path to directory containing model JSON files.
     @param recursive: Whether or not to recurse into subdirectories.
     @param public: For publication (fields not marked public will be ommitted).
-    @param paths: Absolute paths to directory containing collections.
-    @returns: number successful,list of paths that didn't work out
+    @param bulk: Use the ElasticSearch _bulk API.
+    @param chunk_size: int Maximum number of documents per bulk request.
+    @param max_bytes: int Maximum size of a bulk request body in bytes.
+    @param incremental: Only index changes since the last indexed commit.
+    @param force: Post documents even if the indexed copy is identical.
+    @returns: dict with total, successful, created, updated, unchanged, and bad (list of paths that didn't work out)
     """
     logger.debug('index(%s, %s, %s)' % (hosts, index, path))
     
-    modelsfields = _model_fields(models_dir, models.MODELS)
-    public_fields = _public_fields(modelsfields)
+    public_fields = models.public_fields(models_dir, models.MODELS)
+    transforms = _make_transforms(public_fields, public)
     
     # process a single file if requested
     if os.path.isfile(path):
         paths = [path]
     else:
         # files listed first, then entities, then collections
-        paths = models.metadata_files(path, recursive, files_first=1)
+        # (streamed, so files are parsed while the walk continues)
+        paths = (p for model,p in models.walk_metadata_files(path, recursive, files_first=True))
+    
+    # incremental: only post what changed since the last indexed commit
+    head = None
+    plan = None
+    collection_path = path
+    collection_id = None
+    existing_signature = None
+    if incremental and os.path.isdir(os.path.join(path, '.git')):
+        paths = list(paths)
+        head = dvcs.head_sha(path)
+        last = _read_indexed_commit(path, index)
+        if last and (last == head):
+            logger.debug('no changes since %s' % head)
+            return _merge_results([])
+        elif last:
+            collection_id = os.path.basename(os.path.normpath(path))
+            existing_signature = _existing_signature(hosts, index, collection_id)
+            try:
+                changes = dvcs.diff_name_status(path, last, head)
+            except:
+                logger.error('could not diff %s..%s; indexing everything' % (last, head))
+                changes = None
+            if changes is not None:
+                plan = _incremental_paths(path, paths, changes, existing_signature)
+    # Read and parse each metadata file once.
+    if plan:
+        paths = plan['post_paths']
+        total = len(paths) + len(plan['removed_ids'])
+        load_paths = []
+        seen = set()
+        for p in plan['post_paths'] + plan['parent_paths'] + plan['signature_paths']:
+            if p not in seen:
+                load_paths.append(p)
+                seen.add(p)
+        records = _load_metadata(load_paths, parse=set(plan['post_paths'] + plan['parent_paths']))
+        by_path = dict([(record['path'],record) for record in records])
+        parent_records = [by_path[p] for p in plan['parent_paths']]
+        post_records = [by_path[p] for p in plan['post_paths']]
+    else:
+        records = _load_metadata(paths)
+        total = len(records)
+        parent_records = records
+        post_records = records
     
     # Store value of public,status for each collection,entity.
     # Values will be used by entities and files to inherit these values from their parent.
-    parents = _parents_status(paths)
+    parents = _parents_status(parent_records)
     
     # Determine if paths are publishable or not
-    successful_paths,bad_paths = _publishable_or_not(paths, parents)
+    successful_records,bad_paths = _publishable_or_not(post_records, parents)
     
     # iterate through paths, storing signature_url for each collection, entity
     # paths listed files first, then entities, then collections
-    signature_files = _choose_signatures(successful_paths)
+    if plan:
+        signature_records,unpublishable = _publishable_or_not(
+            [by_path[p] for p in plan['signature_paths']], parents)
+        signature_files = _choose_signatures(signature_records)
+        # collection only needs reposting if its signature changed
+        if signature_files.get(collection_id, None) != existing_signature:
+            collection_json = os.path.join(collection_path, 'collection.json')
+            successful_records.append(by_path[collection_json])
+            total += 1
+    else:
+        signature_files = _choose_signatures(successful_records)
     print('Signature files')
     keys = signature_files.keys()
     keys.sort()
@@ -1243,44 +2408,468 @@ def index( hosts, index, path, models_dir=models.MODELS_DIR, recursive=False, pu
         print(key, signature_files[key])
     
     successful = 0
-    for path in successful_paths:
-        model = models.model_from_path(path)
-        object_id = models.id_from_path(path)
-        parent_id = models.parent_id(object_id)
-        
-        publicfields = []
-        if public and model:
-            publicfields = public_fields[model]
-        
-        additional_fields = {'parent_id': parent_id}
-        if model == 'collection': additional_fields['organization_id'] = parent_id
-        if model == 'entity': additional_fields['collection_id'] = parent_id
-        if model == 'file': additional_fields['entity_id'] = parent_id
-        if model in ['collection', 'entity']:
-            additional_fields['signature_file'] = signature_files.get(object_id, '')
-        
-        # HERE WE GO!
-        document = load_document_json(path, model, object_id)
-        try:
-            existing = get(hosts, index, model, object_id, fields=[])
-        except:
-            existing = None
-        result = post(hosts, index, document, publicfields, additional_fields)
-        # success: created, or version number incremented
-        if result.get('_id', None):
-            if existing:
-                existing_version = existing.get('version', None)
-                if not existing_version:
-                    existing_version = existing.get('_version', None)
-            else:
-                existing_version = None
-            result_version = result.get('version', None)
-            if not result_version:
-                result_version = result.get('_version', None)
-            if result['created'] or (existing_version and (result_version > existing_version)):
-                successful += 1
+    counts = {'created':0, 'updated':0, 'unchanged':0}
+    def _documents():
+        for n in range(0, len(successful_records), MGET_CHUNK_SIZE):
+            chunk = []
+            for record in successful_records[n:n+MGET_CHUNK_SIZE]:
+                model,object_id,publicfields,additional_fields = _index_fields(
+                    record, public, public_fields, signature_files)
+                # release the parsed document once it's been handed off
+                document = record.pop('document')
+                model,document_id,data,error = _prep_document(
+                    document, publicfields, additional_fields, transforms.get(model, None))
+                if error:
+                    bad_paths.append((record['path'], error['status'], error['response']))
+                else:
+                    chunk.append( (record['path'],model,document_id,data) )
+            # skip documents whose indexed copy is identical
+            existing = {}
+            if not force:
+                existing = _indexed_hashes(hosts, index, [(item[1],item[2]) for item in chunk])
+            for item in chunk:
+                if existing.get(item[2], None) == item[3]['content_hash']:
+                    counts['unchanged'] += 1
+                else:
+                    yield item
+    
+    # HERE WE GO!
+    if bulk:
+        results = bulk_post(hosts, index, _documents(), chunk_size, max_bytes)
+    else:
+        results = (
+            (path,) + _index_document(hosts, index, model, document_id, data)
+            for path,model,document_id,data in _documents()
+        )
+    for path,status,response in results:
+        if status == 201:
+            counts['created'] += 1
+        elif status in SUCCESS_STATUSES:
+            counts['updated'] += 1
         else:
-            bad_paths.append((path, result['status'], result['response']))
-            #print(status_code)
+            bad_paths.append((path, status, str(response)))
+    successful = counts['created'] + counts['updated'] + counts['unchanged']
+    
+    # remove documents whose metadata files were removed
+    if plan:
+        for object_id in plan['removed_ids']:
+            try:
+                delete(hosts, index, object_id)
+                successful += 1
+            except NotFoundError:
+                # already gone
+                successful += 1
+            except Exception as err:
+                bad_paths.append((object_id, 404, 'delete failed: %s' % err))
+    
+    # remember where we left off, unless something went wrong
+    if head:
+        errors = [status for p,status,response in bad_paths if status != 403]
+        if not errors:
+            _write_indexed_commit(collection_path, index, head)
+    logger.debug('INDEXING COMPLETED')
+    results = {'total':total, 'successful':successful, 'bad':bad_paths}
+    results.update(counts)
+    return results
+
+def _collection_paths( path ):
+    """Lists collection directories in path (or path itself, if it is one).
+    
+    @param path: Absolute path to a collection or to a directory of collections.
+    @returns: list of absolute paths
+    """
+    if os.path.exists(os.path.join(path, 'collection.json')):
+        return [path]
+    paths = []
+    for d in os.listdir(path):
+        dpath = os.path.join(path, d)
+        if os.path.isdir(dpath) and os.path.exists(os.path.join(dpath, 'collection.json')):
+            paths.append(dpath)
+    return natural_sort(paths)
+
+def _merge_results( results ):
+    """Combines the output of several index() runs into one.
+    
+    >>> r = _merge_results([{'total':2, 'successful':1, 'bad':[('b',403,'x')]}, {'total':1, 'successful':1, 'created':1, 'bad':[]}])
+    >>> r['total'], r['successful'], r['created'], r['bad']
+    (3, 2, 1, [('b', 403, 'x')])
+    
+    @param results: list of index() output dicts
+    @returns: dict
+    """
+    counts = ['total', 'successful', 'created', 'updated', 'unchanged']
+    merged = dict([(key,0) for key in counts])
+    merged['bad'] = []
+    for result in results:
+        for key in counts:
+            merged[key] += result.get(key, 0)
+        merged['bad'] += result['bad']
+    merged['bad'].sort()
+    return merged
+
+def _index_collection( kwargs ):
+    """Runs index() on a single collection inside an index_collections worker.
+    
+    Takes a single dict so it can be used with Pool.imap_unordered.
+    
+    @param kwargs: dict of index() arguments
+    @returns: index() output dict
+    """
+    return index(**kwargs)
+
+def index_collections( hosts, index, path, workers=1, models_dir=models.MODELS_DIR, public=True, bulk=False, chunk_size=BULK_CHUNK_SIZE, max_bytes=BULK_CHUNK_BYTES, incremental=False, force=False ):
+    """(Re)index a directory of collections using a pool of worker processes.
+    
+    Each collection is indexed separately and recursively by index() in one of the workers.  The parsing and cleaning of metadata is CPU-bound so this lets index runs use more than one core.  Results from the workers are merged.
+    
+    @param hosts: list of dicts containing host information.
+    @param index: Name of the target index.
+    @param path: Absolute path to a directory containing collections.
+    @param workers: int Number of worker processes.
+    @param models_dir: Absolute path to directory containing model JSON files.
+    @param public: For publication (fields not marked public will be ommitted).
+    @param bulk: Use the ElasticSearch _bulk API.
+    @param chunk_size: int Maximum number of documents per bulk request.
+    @param max_bytes: int Maximum size of a bulk request body in bytes.
+    @param incremental: Only index changes since the last indexed commit.
+    @param force: Post documents even if the indexed copy is identical.
+    @returns: number successful,list of paths that didn't work out
+    """
+    logger.debug('index_collections(%s, %s, %s, %s)' % (hosts, index, path, workers))
+    jobs = [
+        {'hosts':hosts, 'index':index, 'path':collection_path,
+         'models_dir':models_dir, 'recursive':True, 'public':public,
+         'bulk':bulk, 'chunk_size':chunk_size, 'max_bytes':max_bytes,
+         'incremental':incremental, 'force':force,}
+        for collection_path in _collection_paths(path)
+    ]
+    if workers < 2:
+        return _merge_results([_index_collection(job) for job in jobs])
+    pool = multiprocessing.Pool(processes=workers)
+    try:
+        results = [result for result in pool.imap_unordered(_index_collection, jobs)]
+    finally:
+        pool.close()
+        pool.join()
     logger.debug('INDEXING COMPLETED')
-    return {'total':len(paths), 'successful':successful, 'bad':bad_paths}
+    return _merge_results(results)
+
+
+# rebuild --------------------------------------------------------------
+
+# Settings that speed up bulk loading a new index, and ES defaults
+# used to restore settings that were not set explicitly.
+BULK_INDEX_SETTINGS = {'refresh_interval':'-1', 'number_of_replicas':0}
+DEFAULT_INDEX_SETTINGS = {'refresh_interval':'1s', 'number_of_replicas':1}
+
+def _index_settings( hosts, index, names ):
+    """Gets current values of the named index settings.
+    
+    @param hosts: list of dicts containing host information.
+    @param index: Name of the target index.
+    @param names: list of setting names (without the 'index.' prefix).
+    @returns: dict
+    """
+    es = _get_connection(hosts)
+    settings = es.indices.get_settings(index=index)[index]['settings']
+    values = {}
+    for name in names:
+        # ES may return settings flat ('index.x') or nested ('index': {'x'})
+        value = settings.get('index', {}).get(name, settings.get('index.%s' % name, None))
+        if value is None:
+            value = DEFAULT_INDEX_SETTINGS[name]
+        values[name] = value
+    return values
+
+def rebuild_index_name( alias, timestamp=None ):
+    """Makes a timestamped name for a new index behind alias.
+    
+    >>> rebuild_index_name('documents', datetime(2015,1,2,3,4,5))
+    'documents-20150102030405'
+    
+    @param alias: Name of the alias
+    @param timestamp: datetime (default: now)
+    @returns: str
+    """
+    if not timestamp:
+        timestamp = datetime.now()
+    return make_index_name('%s-%s' % (alias, timestamp.strftime('%Y%m%d%H%M%S')))
+
+def rebuild( hosts, alias, path, mappings_path=MAPPINGS_PATH, facets_path=FACETS_PATH, models_dir=models.MODELS_DIR, repo_path=None, org_paths=[], public=True, workers=1, chunk_size=BULK_CHUNK_SIZE, max_bytes=BULK_CHUNK_BYTES, delete_old=False ):
+    """Builds a fresh index and switches the alias to it when done.
+    
+    Creates a new timestamped index, adds mappings, facets, and the
+    repository/organization documents, and bulk-indexes the collections
+    in path with refreshes off and no replicas.  Settings are restored
+    afterwards, and the alias is moved to the new index in one atomic
+    request.  Searches against the alias see the old index until then.
+    If indexing raises an exception, or any document failed for a reason
+    other than not being publishable (403), the alias is not moved and
+    the old index is kept; the new index is left for inspection.
+    
+    @param hosts: list of dicts containing host information.
+    @param alias: Name of the alias searches use (e.g. 'documents').
+    @param path: Absolute path to a collection or to a directory of collections.
+    @param mappings_path: Absolute path to mappings JSON.
+    @param facets_path: Absolute path to dir containing facet files.
+    @param models_dir: Absolute path to dir containing model definitions.
+    @param repo_path: (optional) Absolute path to repository.json.
+    @param org_paths: (optional) Absolute paths to organization.json files.
+    @param public: For publication (fields not marked public will be ommitted).
+    @param workers: int Number of worker processes.
+    @param chunk_size: int Maximum number of documents per bulk request.
+    @param max_bytes: int Maximum size of a bulk request body in bytes.
+    @param delete_old: Delete the index the alias pointed to before.
+    @returns: dict with index, old_index, aliased (boolean), and index_collections() results.
+    """
+    alias = make_index_name(alias)
+    old_index = target_index(hosts, alias) or None
+    index = rebuild_index_name(alias)
+    logger.debug('rebuild(%s, %s, %s) %s -> %s' % (hosts, alias, path, old_index, index))
+    es = _get_connection(hosts)
+    
+    create_index(hosts, index)
+    put_mappings(hosts, index, mappings_path, models_dir)
+    put_facets(hosts, index, facets_path)
+    if repo_path:
+        repo(hosts, index, repo_path)
+    for org_path in org_paths:
+        org(hosts, index, org_path)
+    
+    settings = _index_settings(hosts, index, BULK_INDEX_SETTINGS.keys())
+    es.indices.put_settings(index=index, body={'index':BULK_INDEX_SETTINGS})
+    try:
+        results = index_collections(hosts, index, path, workers=workers,
+                                    models_dir=models_dir, public=public, bulk=True,
+                                    chunk_size=chunk_size, max_bytes=max_bytes,
+                                    force=True)
+    finally:
+        es.indices.put_settings(index=index, body={'index':settings})
+    es.indices.refresh(index=index)
+    
+    errors = [status for p,status,response in results['bad'] if status != 403]
+    if errors:
+        logger.error('rebuild: %s errors; %s not moved to %s' % (len(errors), alias, index))
+        return {'index':index, 'old_index':old_index, 'aliased':False, 'results':results}
+    set_alias(hosts, alias, index)
+    if delete_old and old_index and (old_index != index):
+        delete_index(hosts, old_index)
+    return {'index':index, 'old_index':old_index, 'aliased':True, 'results':results}
+
+
+# verify ---------------------------------------------------------------
+
+# Number of (id,hash) pairs sorted in memory before spilling to disk
+SORT_CHUNK_SIZE = 100000
+
+def _external_sort( pairs, chunk_size=SORT_CHUNK_SIZE ):
+    """Sorts (id,hash) pairs using bounded memory.
+    
+    Pairs are sorted in chunks of chunk_size, spilled to temporary
+    files, and merged.  Small inputs never touch the disk.
+    
+    @param pairs: iterable of (id,hash) tuples of strings
+    @param chunk_size: int
+    @returns: generator of (id,hash) tuples, sorted by id
+    """
+    def _read(f):
+        f.seek(0)
+        for line in f:
+            object_id,h = line.decode('utf-8').rstrip('\n').split('\t')
+            yield object_id, (h or None)
+    tmpfiles = []
+    chunk = []
+    try:
+        for pair in pairs:
+            chunk.append(pair)
+            if len(chunk) >= chunk_size:
+                chunk.sort()
+                f = tempfile.TemporaryFile()
+                for object_id,h in chunk:
+                    f.write(('%s\t%s\n' % (object_id, h or '')).encode('utf-8'))
+                tmpfiles.append(f)
+                chunk = []
+        chunk.sort()
+        if not tmpfiles:
+            for pair in chunk:
+                yield pair
+            return
+        for pair in heapq.merge(chunk, *[_read(f) for f in tmpfiles]):
+            yield pair
+    finally:
+        for f in tmpfiles:
+            f.close()
+
+def _diff_sorted( expected, indexed ):
+    """Compares two sorted streams of (id,hash) pairs.
+    
+    >>> list(_diff_sorted([('a','1'), ('b','2'), ('c','3')], [('b','2'), ('c','x'), ('d','4')]))
+    [('missing', 'a'), ('changed', 'c'), ('extra', 'd')]
+    
+    @param expected: sorted (id,hash) pairs from the filesystem
+    @param indexed: sorted (id,hash) pairs from the index
+    @returns: generator of (status,id); status is missing, extra, or changed
+    """
+    expected = iter(expected)
+    indexed = iter(indexed)
+    e = next(expected, None)
+    i = next(indexed, None)
+    while (e is not None) or (i is not None):
+        if (i is None) or ((e is not None) and (e[0] < i[0])):
+            yield 'missing', e[0]
+            e = next(expected, None)
+        elif (e is None) or (i[0] < e[0]):
+            yield 'extra', i[0]
+            i = next(indexed, None)
+        else:
+            if e[1] != i[1]:
+                yield 'changed', e[0]
+            e = next(expected, None)
+            i = next(indexed, None)
+
+def _prepared_documents( path, transforms, public_fields, public=True ):
+    """Prepares the documents index() would post for a collection, without posting.
+    
+    @param path: Absolute path to a collection.
+    @param transforms: Output of _make_transforms
+    @param public_fields: Output of models.public_fields
+    @param public: For publication (fields not marked public will be ommitted).
+    @returns: generator of (path, model, document_id, data) tuples
+    """
+    paths = [p for model,p in models.walk_metadata_files(path, True, files_first=True)]
+    records = _load_metadata(paths)
+    parents = _parents_status(records)
+    successful_records,bad_paths = _publishable_or_not(records, parents)
+    signature_files = _choose_signatures(successful_records)
+    for record in successful_records:
+        model,object_id,publicfields,additional_fields = _index_fields(
+            record, public, public_fields, signature_files)
+        document = record.pop('document')
+        model,document_id,data,error = _prep_document(
+            document, publicfields, additional_fields, transforms.get(model, None))
+        if not error:
+            yield record['path'],model,document_id,data
+
+def _filesystem_hashes( collection_paths, transforms, public_fields, public=True ):
+    for collection_path in collection_paths:
+        for path,model,document_id,data in _prepared_documents(
+                collection_path, transforms, public_fields, public):
+            yield document_id, data['content_hash']
+
+def _unlist( value ):
+    # ElasticSearch wraps field values in lists when you use 'fields'
+    if isinstance(value, list):
+        if value:
+            return value[0]
+        return None
+    return value
+
+def _index_hashes( hosts, index, collection_ids, chunk_size=BULK_CHUNK_SIZE ):
+    """Streams (id,content_hash) of the given collections' documents in the index.
+    
+    Only these collections and their children are listed; documents of
+    other collections in the index (e.g. on drives not mounted here) are
+    never seen.  Entities are found by collection_id.  Files are found by
+    collection_id and by entity_id, since file documents indexed before
+    collection_id was added only have the latter (see _child_ids_from_index).
+    
+    @param hosts: list of dicts containing host information.
+    @param index: Name of the target index.
+    @param collection_ids: list of collection IDs.
+    @param chunk_size: int Number of entity IDs per files query.
+    @returns: generator of (id,hash) tuples; hash is None if not stored.
+    """
+    def _hash(hit):
+        return _unlist(hit.get('fields', {}).get('content_hash', None))
+    documents = [('collection',collection_id) for collection_id in collection_ids]
+    for n in range(0, len(documents), MGET_CHUNK_SIZE):
+        for doc in mget(hosts, index, documents[n:n+MGET_CHUNK_SIZE], fields=['content_hash']):
+            yield doc['_id'], _hash(doc)
+    # one collection at a time keeps the set of seen file IDs small
+    for collection_id in collection_ids:
+        entity_ids = []
+        file_ids = set()
+        for hit in scan(hosts, index, model='entity,file',
+                        filters={'collection_id':collection_id}, fields=['content_hash']):
+            if hit['_type'] == 'entity':
+                entity_ids.append(hit['_id'])
+            elif hit['_type'] == 'file':
+                file_ids.add(hit['_id'])
+            yield hit['_id'], _hash(hit)
+        for n in range(0, len(entity_ids), chunk_size):
+            chunk = entity_ids[n:n+chunk_size]
+            for hit in scan(hosts, index, model='file', filters={'entity_id':chunk}, fields=['content_hash']):
+                if hit['_id'] not in file_ids:
+                    file_ids.add(hit['_id'])
+                    yield hit['_id'], _hash(hit)
+
+def verify( hosts, index, path, models_dir=models.MODELS_DIR, public=True, repair=False, chunk_size=BULK_CHUNK_SIZE, max_bytes=BULK_CHUNK_BYTES ):
+    """Compares collections on disk with the index; optionally fixes differences.
+    
+    Prepares each document as index() would and compares its content_hash
+    with the one stored in the index.  Both sides are streamed and sorted
+    in bounded memory (see _external_sort), then merged, so millions of
+    IDs can be compared on one machine.
+    
+    missing: publishable on disk but not in the index.
+    extra: in the index but not publishable on disk (or gone).
+    changed: in both, but the indexed copy is out of date.
+    
+    Only documents of the collections in path are considered, so other
+    collections in the index (e.g. on drives that are not mounted) are
+    never reported as extra or deleted.  With repair, missing and changed
+    documents are posted and extra ones deleted using the bulk API.
+    
+    @param hosts: list of dicts containing host information.
+    @param index: Name of the target index.
+    @param path: Absolute path to a collection or to a directory of collections.
+    @param models_dir: Absolute path to directory containing model JSON files.
+    @param public: For publication (fields not marked public will be ommitted).
+    @param repair: Post missing/changed documents and delete extra ones.
+    @param chunk_size: int Maximum number of documents per bulk request.
+    @param max_bytes: int Maximum size of a bulk request body in bytes.
+    @returns: dict with missing, extra, changed (lists of IDs), and if repair, posted, deleted, bad
+    """
+    logger.debug('verify(%s, %s, %s, %s)' % (hosts, index, path, repair))
+    public_fields = models.public_fields(models_dir, models.MODELS)
+    transforms = _make_transforms(public_fields, public)
+    collection_paths = _collection_paths(path)
+    # only collections on disk are compared; the rest of the index is left alone
+    collection_ids = [
+        os.path.basename(os.path.normpath(collection_path))
+        for collection_path in collection_paths
+    ]
+    
+    results = {'missing':[], 'extra':[], 'changed':[]}
+    for status,object_id in _diff_sorted(
+            _external_sort(_filesystem_hashes(collection_paths, transforms, public_fields, public)),
+            _external_sort(_index_hashes(hosts, index, collection_ids))):
+        results[status].append(object_id)
+    if not repair:
+        return results
+    
+    results['posted'] = 0
+    results['deleted'] = 0
+    results['bad'] = []
+    post_ids = set(results['missing'] + results['changed'])
+    if post_ids:
+        def _documents():
+            for collection_path in collection_paths:
+                for item in _prepared_documents(collection_path, transforms, public_fields, public):
+                    if item[2] in post_ids:
+                        yield item
+        for key,status,response in bulk_post(hosts, index, _documents(), chunk_size, max_bytes):
+            if status in SUCCESS_STATUSES:
+                results['posted'] += 1
+            else:
+                results['bad'].append((key, status, str(response)))
+    delete_docs = [
+        (models.split_object_id(object_id)[0], object_id)
+        for object_id in results['extra']
+    ]
+    for object_id,status,response in bulk_delete(hosts, index, delete_docs, chunk_size):
+        if status in SUCCESS_STATUSES + [404]:
+            results['deleted'] += 1
+        else:
+            results['bad'].append((object_id, status, str(response)))
+    return results
@@ -376,6 +376,42 @@ def list_committed(repo, commit):
     entry = repo.git.log('-1', '--stat', commit.hexsha)
     return _parse_list_committed(entry)
 
+def head_sha(path):
+    """Returns SHA1 hash of the repository's HEAD commit.
+    
+    @param path: Absolute path to repo.
+    @return: str
+    """
+    repo = git.Repo(path)
+    return repo.head.commit.hexsha
+
+def _parse_diff_name_status( diff ):
+    changes = []
+    for line in diff.strip().split('\n'):
+        if line and ('\t' in line):
+            status,path = line.split('\t', 1)
+            changes.append( (status.strip()[0], path.strip()) )
+    return changes
+
+def diff_name_status(path, commit_a, commit_b='HEAD'):
+    """Lists files that differ between two commits, with change status.
+    
+    Renames are reported as a delete plus an add.
+    
+    $ git diff --name-status --no-renames COMMIT_A COMMIT_B
+    M       collection.json
+    A       files/ddr-testing-123-4/entity.json
+    D       files/ddr-testing-123-2/entity.json
+    
+    @param path: Absolute path to repo.
+    @param commit_a: SHA1 hash of the earlier commit.
+    @param commit_b: SHA1 hash (or ref) of the later commit.
+    @return: list of (status, path) tuples; paths relative to repo.
+    """
+    repo = git.Repo(path)
+    stdout = repo.git.diff('--name-status', '--no-renames', commit_a, commit_b)
+    return _parse_diff_name_status(stdout)
+
 def _parse_list_conflicted( ls_unmerged ):
     files = []
     for line in ls_unmerged.strip().split('\n'):
@@ -800,3 +836,54 @@ def annex_file_targets( repo_dir, relative=False ):
                     target = os.path.realpath(path)
                     paths.append((path, target))
     return paths
+
+# git-annex backends whose keys contain a hash, and the hashlib algorithm.
+# Keys from other backends (WORM, URL) say nothing about file contents.
+ANNEX_HASH_BACKENDS = {
+    'MD5': 'md5',
+    'SHA1': 'sha1',
+    'SHA224': 'sha224',
+    'SHA256': 'sha256',
+    'SHA384': 'sha384',
+    'SHA512': 'sha512',
+}
+
+def annex_key( target ):
+    """Parses the git-annex key at the end of an annex symlink target
+    
+    Keys look like BACKEND-sSIZE[-mMTIME][-SCHUNKSIZE-CCHUNK]--NAME.
+    For hash backends NAME is the hexdigest of the file contents, followed
+    by the file extension for the *E backends (e.g. SHA256E).
+    
+    >>> annex_key('../../.git/annex/objects/Fx/Kq/SHA256E-s1234--a1b2...c3d4.jpg/SHA256E-s1234--a1b2...c3d4.jpg')
+    {'key': 'SHA256E-s1234--a1b2...c3d4.jpg', 'backend': 'SHA256E', 'size': 1234, 'algorithm': 'sha256', 'hash': 'a1b2...c3d4'}
+    
+    @param target: Symlink target (absolute or relative) or key.
+    @returns: dict key,backend,size,algorithm,hash; algorithm and hash are None for non-hash backends. None if target is not a key.
+    """
+    key = os.path.basename(target)
+    if '--' not in key:
+        return None
+    fields,name = key.split('--', 1)
+    fields = fields.split('-')
+    backend = fields[0]
+    size = None
+    for field in fields[1:]:
+        if field.startswith('s') and field[1:].isdigit():
+            size = int(field[1:])
+    base = backend
+    if base.endswith('E'):
+        base = base[:-1]
+    algorithm = ANNEX_HASH_BACKENDS.get(base)
+    digest = None
+    if algorithm:
+        digest = name.split('.', 1)[0].lower()
+        if not re.match('^[0-9a-f]+$', digest):
+            algorithm,digest = None,None
+    return {
+        'key': key,
+        'backend': backend,
+        'size': size,
+        'algorithm': algorithm,
+        'hash': digest,
+    }
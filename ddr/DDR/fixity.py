@@ -0,0 +1,342 @@
+# Fixity audits: verify payload files against checksums in entity control files
+#
+#     from DDR import fixity
+#     report = fixity.audit('/var/www/media/base/ddr-test-123', workers=4, io_limit=2)
+#     fixity.write_report(report, '/tmp/ddr-test-123-fixity.json')
+#
+# Progress is recorded one entity at a time in a journal (by default
+# COLLECTION/.git/ddr/fixity.journal) so an interrupted audit picks up where
+# it left off.  The journal is removed when the audit completes.
+#
+# With keys=True, annexed files whose git-annex key contains a hash that is
+# also in the control file are checked against the key and their size
+# instead of being read:
+#
+#     report = fixity.audit('/var/www/media/base/ddr-test-123', keys=True)
+
+from datetime import datetime
+import json
+import logging
+logger = logging.getLogger(__name__)
+import os
+import time
+
+from DDR import dvcs
+from DDR import models
+
+
+JOURNAL_FILENAME = 'fixity.journal'
+
+# Files hashed per call to models.hash_files; entities are batched until
+# they reach this many files so small entities still keep the pool busy.
+BATCH_FILES = 64
+
+# control file section, algorithm
+CONTROL_SECTIONS = [
+    ('Checksums-SHA1', 'sha1'),
+    ('Checksums-SHA256', 'sha256'),
+    ('Files', 'md5'),
+]
+
+
+def journal_path( collection_path ):
+    return os.path.join(collection_path, '.git', 'ddr', JOURNAL_FILENAME)
+
+def read_journal( path ):
+    """Reads entity results recorded by an earlier, interrupted audit.
+
+    A partly-written last line (e.g. from a power failure) is ignored;
+    that entity is simply audited again.
+
+    @param path: Absolute path to journal file.
+    @returns: list of entity result dicts (see verify_entity)
+    """
+    results = []
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    results.append(json.loads(line))
+                except ValueError:
+                    logger.debug('skipping partial journal line: %s' % line)
+    return results
+
+def _append_journal( f, result ):
+    f.write(json.dumps(result, sort_keys=True))
+    f.write('\n')
+    f.flush()
+    os.fsync(f.fileno())
+
+def control_checksums( control_path ):
+    """Checksums and sizes of payload files listed in an entity control file.
+
+    Checksums-SHA1 and Checksums-SHA256 lines are "CHECKSUM = PATH";
+    Files lines are "MD5 = SIZE ; PATH".  The file is parsed directly
+    because ConfigParser drops the " ; PATH" part as an inline comment.
+
+    >>> control_checksums('/var/www/media/base/ddr-test-123/files/ddr-test-123-1/control')
+    {'ddr-test-123-1-master-a1b2c3d4e5.tif': {'sha1': 'a1b2c3d4e5...', 'sha256': '...', 'md5': '...', 'size': 1234}}
+
+    @param control_path: Absolute path to entity control file.
+    @returns: dict of checksums by path relative to entity files dir.
+    """
+    sections = dict(CONTROL_SECTIONS)
+    files = {}
+    algo = None
+    with open(control_path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('[') and line.endswith(']'):
+                algo = sections.get(line[1:-1])
+            elif algo and ('=' in line):
+                checksum,value = [x.strip() for x in line.split('=', 1)]
+                if algo == 'md5':
+                    size,path = [x.strip() for x in value.split(';', 1)]
+                    files.setdefault(path, {})['size'] = int(size)
+                else:
+                    path = value
+                files.setdefault(path, {})[algo] = checksum
+    return files
+
+def _entity_job( entity, keys=False ):
+    """Lists files to hash for an entity, and problems found without hashing.
+
+    @param entity: models.Entity
+    @param keys: boolean Use annex keys instead of hashing where possible.
+    @returns: dict
+    """
+    job = {
+        'entity': entity.uid,
+        'expected': {},
+        'paths': [],
+        'keys': {},
+        'missing': [],
+        'untracked': [],
+        'errors': [],
+    }
+    if not os.path.exists(entity.control_path):
+        job['errors'].append({'path': 'control', 'error': 'control file missing'})
+        return job
+    try:
+        job['expected'] = control_checksums(entity.control_path)
+    except Exception as e:
+        job['errors'].append({'path': 'control', 'error': 'could not read control file: %s' % e})
+        return job
+    present = set(entity.file_paths())
+    for path in sorted(job['expected'].keys()):
+        if path in present:
+            job['paths'].append(os.path.join(entity.files_path, path))
+        else:
+            job['missing'].append(path)
+    job['untracked'] = [path for path in sorted(present) if path not in job['expected']]
+    # an annex symlink whose content is not present is missing too
+    for abspath in list(job['paths']):
+        if not os.path.exists(abspath):
+            job['paths'].remove(abspath)
+            job['missing'].append(os.path.basename(abspath))
+    if keys:
+        targets = dict(dvcs.annex_file_targets(entity.files_path, relative=True))
+        for abspath in list(job['paths']):
+            path = os.path.basename(abspath)
+            key = None
+            if path in targets:
+                key = dvcs.annex_key(targets[path])
+            # WORM/URL keys, or a hash the control file doesn't have: read file
+            if key and key['algorithm'] and (key['algorithm'] in job['expected'][path]):
+                job['paths'].remove(abspath)
+                job['keys'][abspath] = (key, os.stat(abspath).st_size)
+    return job
+
+def _compare( result, path, expected, actual, algorithms, source ):
+    for algo in algorithms:
+        if (algo in expected) and (algo in actual) and (expected[algo] != actual[algo]):
+            result['mismatches'].append({
+                'path': path,
+                'algorithm': algo,
+                'expected': expected[algo],
+                'actual': actual[algo],
+                'source': source,
+            })
+
+def verify_entity( job, hashes ):
+    """Compares computed hashes with the ones in an entity control file.
+
+    Files checked by annex key are compared on size and the key's hash;
+    mismatches have source 'annex' instead of 'file'.
+
+    @param job: dict (see _entity_job)
+    @param hashes: dict of models.file_hashes dicts (or read errors) by absolute path.
+    @returns: dict entity,files,bytes,files_hashed,bytes_read,missing,untracked,mismatches,errors
+    """
+    algorithms = ['size'] + [algo for section,algo in CONTROL_SECTIONS]
+    result = {
+        'entity': job['entity'],
+        'files': 0,
+        'bytes': 0,
+        'files_hashed': 0,
+        'bytes_read': 0,
+        'missing': job['missing'],
+        'untracked': job['untracked'],
+        'mismatches': [],
+        'errors': list(job['errors']),
+    }
+    for abspath in job['paths']:
+        path = os.path.basename(abspath)
+        actual = hashes[abspath]
+        if isinstance(actual, EnvironmentError):
+            result['errors'].append({'path': path, 'error': str(actual)})
+            continue
+        result['files'] += 1
+        result['bytes'] += actual['size']
+        result['files_hashed'] += 1
+        result['bytes_read'] += actual['size']
+        _compare(result, path, job['expected'][path], actual, algorithms, 'file')
+    for abspath in sorted(job['keys'].keys()):
+        path = os.path.basename(abspath)
+        key,size = job['keys'][abspath]
+        result['files'] += 1
+        result['bytes'] += size
+        if (key['size'] is not None) and (key['size'] != size):
+            _compare(result, path, {'size': key['size']}, {'size': size}, ['size'], 'annex')
+        actual = {'size': size, key['algorithm']: key['hash']}
+        _compare(result, path, job['expected'][path], actual, algorithms, 'annex')
+    return result
+
+def _hash_batch( jobs, algorithms, workers, io_limit ):
+    """Hashes files of several entities in one pool.
+
+    A file that cannot be read gets its error instead of hashes (see
+    models.hash_files); the other files are hashed as usual.
+
+    @returns: dict of hashes or read errors by absolute path
+    """
+    paths = [path for job in jobs for path in job['paths']]
+    return dict(zip(paths, models.hash_files(paths, algorithms, workers, io_limit, errors=True)))
+
+def audit( collection_path, journal=None, restart=False, workers=models.HASH_WORKERS, io_limit=models.HASH_IO_LIMIT, batch_files=BATCH_FILES, keys=False ):
+    """Verifies every payload file in a collection against its control file.
+
+    Payload files are read unless keys is True; the checksum cache is
+    neither used nor updated.  A key check finds files that do not match
+    their control file but not damage to annexed content.  Each entity's
+    result is appended to the journal as soon as it is verified, and
+    entities already in the journal are skipped.
+
+    @param collection_path: Absolute path to collection repo.
+    @param journal: Absolute path to journal file (default: see journal_path).
+    @param restart: boolean Ignore and replace an existing journal.
+    @param workers: int Number of hashing threads (see models.hash_files).
+    @param io_limit: int Max number of files read at once (see models.hash_files).
+    @param batch_files: int Files hashed per batch.
+    @param keys: boolean Check annexed files against their git-annex keys instead of reading them, where possible.
+    @returns: report dict (see make_report)
+    """
+    collection = models.Collection(collection_path)
+    if not journal:
+        journal = journal_path(collection.path)
+    if restart and os.path.exists(journal):
+        os.remove(journal)
+    done = read_journal(journal)
+    done_ids = set([result['entity'] for result in done])
+    if not os.path.exists(os.path.dirname(journal)):
+        os.makedirs(os.path.dirname(journal))
+    algorithms = [algo for section,algo in CONTROL_SECTIONS]
+    started = datetime.now()
+    start = time.time()
+    results = []
+    with open(journal, 'w') as f:
+        # rewrite without any partial last line
+        for result in done:
+            f.write(json.dumps(result, sort_keys=True))
+            f.write('\n')
+
+        def verify_batch(batch):
+            hashes = _hash_batch(batch, algorithms, workers, io_limit)
+            for job in batch:
+                result = verify_entity(job, hashes)
+                _append_journal(f, result)
+                results.append(result)
+                logger.debug('%s %s files' % (result['entity'], result['files']))
+
+        batch = []
+        for entity in collection.entities():
+            if entity.uid in done_ids:
+                continue
+            batch.append(_entity_job(entity, keys))
+            if sum([len(job['paths']) for job in batch]) >= batch_files:
+                verify_batch(batch)
+                batch = []
+        if batch:
+            verify_batch(batch)
+    elapsed = time.time() - start
+    os.remove(journal)
+    return make_report(collection, done, results, started, elapsed)
+
+def make_report( collection, resumed, results, started, elapsed ):
+    """Summarizes entity results.
+
+    Totals include entities from a resumed journal; elapsed time and
+    throughput cover only this run.  bytes_per_second is for files that
+    were actually read.  Journals written before files_hashed and
+    bytes_read were recorded, or when errors were plain strings, are
+    still accepted.
+
+    @param collection: models.Collection
+    @param resumed: list of entity results read from the journal.
+    @param results: list of entity results from this run.
+    @param started: datetime
+    @param elapsed: float Seconds
+    @returns: dict
+    """
+    report = {
+        'collection': collection.uid,
+        'path': collection.path,
+        'started': started.strftime('%Y-%m-%dT%H:%M:%S'),
+        'finished': datetime.now().strftime('%Y-%m-%dT%H:%M:%S'),
+        'entities': len(resumed) + len(results),
+        'entities_resumed': len(resumed),
+        'files': 0,
+        'bytes': 0,
+        'files_hashed': 0,
+        'bytes_read': 0,
+        'elapsed': round(elapsed, 3),
+        'files_per_second': 0,
+        'bytes_per_second': 0,
+        'missing': [],
+        'untracked': [],
+        'mismatches': [],
+        'errors': [],
+    }
+    for result in resumed + results:
+        for key in ['files', 'bytes', 'files_hashed', 'bytes_read']:
+            report[key] += result.get(key, 0)
+        for key in ['missing', 'untracked']:
+            report[key].extend([
+                {'entity': result['entity'], 'path': path} for path in result[key]
+            ])
+        for mismatch in result['mismatches']:
+            mismatch = dict(mismatch)
+            mismatch['entity'] = result['entity']
+            report['mismatches'].append(mismatch)
+        for error in result['errors']:
+            if isinstance(error, basestring):
+                error = {'path': None, 'error': error}
+            error = dict(error)
+            error['entity'] = result['entity']
+            report['errors'].append(error)
+    if elapsed:
+        report['files_per_second'] = round(sum([r['files'] for r in results]) / elapsed, 1)
+        report['bytes_per_second'] = int(sum([r.get('bytes_read', 0) for r in results]) / elapsed)
+    report['ok'] = not (report['missing'] or report['mismatches'] or report['errors'])
+    return report
+
+def write_report( report, path=None ):
+    """Writes report as JSON to path, or to stdout.
+    """
+    text = json.dumps(report, indent=4, separators=(',', ': '), sort_keys=True)
+    if path:
+        with open(path, 'w') as f:
+            f.write(text)
+            f.write('\n')
+    else:
+        print(text)
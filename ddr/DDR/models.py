@@ -1,8 +1,23 @@
 import ConfigParser
+import copy
 import hashlib
 import json
+import logging
+from multiprocessing.pool import ThreadPool
 import os
 import re
+import sqlite3
+import tempfile
+import threading
+import time
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 from DDR import CONFIG_FILES, NoConfigError
 from DDR import natural_order_string, natural_sort
@@ -28,73 +43,507 @@ MODELS_DIR = '/usr/local/src/ddr-cmdln/ddr/DDR/models'
 
 
 
+# Read files in large blocks when hashing; 1 KB reads mean a syscall per KB
+HASH_BLOCK_SIZE = 1024 * 1024
+HASH_ALGORITHMS = ['md5', 'sha1', 'sha256']
+
+# Threads used to hash payload files, and max number of files read at once
+# (0: no limit).  hashlib releases the GIL so threads hash concurrently;
+# keep hash_io_limit low for spinning disks so they are not made to seek.
+HASH_WORKERS = 1
+HASH_IO_LIMIT = 0
+if config.has_option('cmdln', 'hash_workers'):
+    HASH_WORKERS = config.getint('cmdln', 'hash_workers')
+if config.has_option('cmdln', 'hash_io_limit'):
+    HASH_IO_LIMIT = config.getint('cmdln', 'hash_io_limit')
+
 def file_hash(path, algo='sha1'):
-    if algo == 'sha256':
-        h = hashlib.sha256()
-    elif algo == 'md5':
-        h = hashlib.md5()
+    if algo not in HASH_ALGORITHMS:
+        algo = 'sha1'
+    return file_hashes(path, [algo])[algo]
+
+def file_hashes( path, algorithms=HASH_ALGORITHMS, block_size=HASH_BLOCK_SIZE ):
+    """Computes several digests of a file while reading it only once.
+    
+    >>> file_hashes('/tmp/hash')
+    {'md5': '0800fc...', 'sha1': '2346ad...', 'sha256': 'd04b98...', 'size': 4}
+    
+    @param path: Absolute path to file.
+    @param algorithms: list of hashlib algorithm names
+    @param block_size: int Number of bytes per read.
+    @returns: dict of hexdigests by algorithm name, plus size in bytes
+    """
+    hashes = [(algo, hashlib.new(algo)) for algo in algorithms]
+    size = 0
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(block_size)
+            if not data:
+                break
+            size += len(data)
+            for algo,h in hashes:
+                h.update(data)
+    digests = dict([(algo, h.hexdigest()) for algo,h in hashes])
+    digests['size'] = size
+    return digests
+
+def hash_files( paths, algorithms=HASH_ALGORITHMS, workers=HASH_WORKERS, io_limit=HASH_IO_LIMIT, errors=False ):
+    """Computes digests of several files, optionally in a pool of threads.
+    
+    Each file is read by one thread from start to finish.  No more than
+    io_limit files are read at the same time.  With errors=True a file that
+    cannot be read gets its IOError/OSError in place of its digests so the
+    other files' results are not lost.
+    
+    >>> hash_files(['/tmp/hash', '/tmp/hashes'], ['sha1'], workers=4, io_limit=2)
+    [{'sha1': '2346ad...', 'size': 4}, {'sha1': 'ea27c1...', 'size': 6}]
+    
+    @param paths: list of absolute paths to files.
+    @param algorithms: list of hashlib algorithm names
+    @param workers: int Number of threads.
+    @param io_limit: int Max number of files read at once (0: no limit).
+    @param errors: boolean Return read errors instead of raising them.
+    @returns: list of dicts (see file_hashes), in the same order as paths.
+    """
+    def hash_one(path):
+        if not errors:
+            return file_hashes(path, algorithms)
+        try:
+            return file_hashes(path, algorithms)
+        except (IOError, OSError) as e:
+            return e
+    if (workers < 2) or (len(paths) < 2):
+        return [hash_one(path) for path in paths]
+    semaphore = None
+    if io_limit:
+        semaphore = threading.BoundedSemaphore(io_limit)
+    def hash_file(path):
+        if semaphore:
+            with semaphore:
+                return hash_one(path)
+        return hash_one(path)
+    pool = ThreadPool(processes=min(workers, len(paths)))
+    try:
+        return pool.map(hash_file, paths)
+    finally:
+        pool.close()
+        pool.join()
+
+# Hashes of payload files are kept in a per-collection SQLite database
+# and reused until the file's inode, size, or mtime changes.
+CHECKSUM_CACHE_FILENAME = 'checksums.sqlite'
+CHECKSUM_CACHE_TIMEOUT = 30
+
+def checksum_cache_path( collection_path ):
+    return os.path.join(collection_path, '.git', 'ddr', CHECKSUM_CACHE_FILENAME)
+
+def _file_signature( path ):
+    """Returns the values that must be unchanged for a cached hash to be used.
+    
+    Payload files are usually git-annex symlinks so the stat follows links;
+    the signature is that of the annexed content.
+    
+    @param path: Absolute path to file.
+    @returns: inode,size,mtime_ns
+    """
+    st = os.stat(path)
+    return st.st_ino, st.st_size, int(round(st.st_mtime * 1000000000))
+
+def _open_checksum_cache( cache_path ):
+    """Opens (and creates if necessary) a checksum cache.
+    
+    @param cache_path: Absolute path to cache file.
+    @returns: sqlite3.Connection or None if cache cannot be opened.
+    """
+    try:
+        if not os.path.exists(os.path.dirname(cache_path)):
+            os.makedirs(os.path.dirname(cache_path))
+        conn = sqlite3.connect(cache_path, timeout=CHECKSUM_CACHE_TIMEOUT)
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS checksums ('
+            ' path TEXT PRIMARY KEY, inode INTEGER, size INTEGER, mtime_ns INTEGER,'
+            ' md5 TEXT, sha1 TEXT, sha256 TEXT)'
+        )
+        return conn
+    except (OSError, sqlite3.Error) as e:
+        logging.error('could not open checksum cache %s: %s' % (cache_path, e))
+        return None
+
+def cached_file_hashes( collection_path, paths, algorithms=HASH_ALGORITHMS, verify=False, prune=None, workers=HASH_WORKERS, io_limit=HASH_IO_LIMIT ):
+    """Hashes of files in a collection, from the checksum cache if possible.
+    
+    The cache lives in .git/ddr/ so it is neither committed nor copied by
+    clones.  An entry is used only if the file's (path, inode, size, mtime)
+    match the ones recorded when it was hashed.  Entries for files modified
+    within MTIME_RESOLUTION seconds of hashing are never reused, since a
+    later change in the same tick would not alter the mtime.
+    
+    Files that are not in the cache are hashed with all of HASH_ALGORITHMS
+    so later requests for a different algorithm are also served from it.
+    Files are hashed with hash_files, after the cache has been read.
+    If the cache cannot be used the files are simply hashed.
+    
+    >>> cached_file_hashes('/var/www/media/base/ddr-test-123', ['/var/www/media/base/ddr-test-123/files/ddr-test-123-1/files/ddr-test-123-1-master-a1b2c3d4e5.jpg'])
+    [('/var/www/media/base/ddr-test-123/files/ddr-test-123-1/files/ddr-test-123-1-master-a1b2c3d4e5.jpg', {'sha1': 'a1b2c3...', 'md5': '...', 'sha256': '...', 'size': 1234})]
+    
+    @param collection_path: Absolute path to collection repo.
+    @param paths: list of absolute paths to files in the collection.
+    @param algorithms: list of hashlib algorithm names (see HASH_ALGORITHMS)
+    @param verify: boolean Ignore cached hashes; rehash and refresh cache.
+    @param prune: (optional) Absolute path to a directory; cache entries for files under it that are not in paths are removed.
+    @param workers: int Number of hashing threads (see hash_files).
+    @param io_limit: int Max number of files read at once (see hash_files).
+    @returns: list of (path, hashes) tuples; see file_hashes.
+    """
+    conn = None
+    if os.path.exists(os.path.join(collection_path, '.git')):
+        conn = _open_checksum_cache(checksum_cache_path(collection_path))
+    if not conn:
+        return zip(paths, hash_files(paths, algorithms, workers, io_limit))
+    prefix = '%s/' % os.path.normpath(collection_path)
+    now = time.time()
+    results = []
+    try:
+        # look up all files, then hash the ones that are missing or changed
+        entries = []
+        for path in paths:
+            key = os.path.normpath(path).replace(prefix, '', 1)
+            inode,size,mtime_ns = _file_signature(path)
+            row = conn.execute(
+                'SELECT inode, size, mtime_ns, md5, sha1, sha256 FROM checksums WHERE path=?',
+                (key,)
+            ).fetchone()
+            cached = None
+            if row and (tuple(row[:3]) == (inode,size,mtime_ns)):
+                cached = {'md5': row[3], 'sha1': row[4], 'sha256': row[5], 'size': size}
+            entries.append((path, key, inode, size, mtime_ns, cached))
+        stale = [entry[0] for entry in entries if verify or not entry[5]]
+        hashed = dict(zip(stale, hash_files(stale, HASH_ALGORITHMS, workers, io_limit)))
+        for path,key,inode,size,mtime_ns,cached in entries:
+            if path in hashed:
+                hashes = hashed[path]
+                if cached and (cached != hashes):
+                    logging.warning('cached checksums do not match file: %s' % path)
+                if mtime_ns >= (now - MTIME_RESOLUTION) * 1000000000:
+                    mtime_ns = 0
+                conn.execute(
+                    'INSERT OR REPLACE INTO checksums VALUES (?,?,?,?,?,?,?)',
+                    (key, inode, size, mtime_ns, hashes['md5'], hashes['sha1'], hashes['sha256'])
+                )
+            else:
+                hashes = cached
+            digests = dict([(algo, hashes[algo]) for algo in algorithms])
+            digests['size'] = hashes['size']
+            results.append((path, digests))
+        if prune:
+            keys = set([os.path.normpath(path).replace(prefix, '', 1) for path in paths])
+            directory = '%s/' % os.path.normpath(prune).replace(prefix, '', 1)
+            stale = [
+                key for (key,) in conn.execute(
+                    'SELECT path FROM checksums WHERE substr(path, 1, ?)=?',
+                    (len(directory), directory)
+                )
+                if key not in keys
+            ]
+            conn.executemany('DELETE FROM checksums WHERE path=?', [(key,) for key in stale])
+        conn.commit()
+    except sqlite3.Error as e:
+        logging.error('checksum cache error: %s' % e)
+        return zip(paths, hash_files(paths, algorithms, workers, io_limit))
+    finally:
+        conn.close()
+    return results
+
+METADATA_EXCLUDE_DIRS = ['.git', 'tmp']
+
+def _list_dir( path ):
+    """Lists the entries in a directory, sorted by name.
+    
+    Uses scandir if available, which on most filesystems can tell files
+    from directories without a stat() per entry.  Like os.walk,
+    symlinks to directories are not treated as directories.
+    
+    @param path: Absolute path to directory.
+    @returns: list of (name, is_dir) tuples
+    """
+    if scandir:
+        entries = [(entry.name, entry.is_dir(follow_symlinks=False)) for entry in scandir(path)]
     else:
-        h = hashlib.sha1()
-    block_size=1024
-    f = open(path, 'rb')
-    while True:
-        data = f.read(block_size)
-        if not data:
+        entries = []
+        for name in os.listdir(path):
+            p = os.path.join(path, name)
+            entries.append((name, os.path.isdir(p) and not os.path.islink(p)))
+    entries.sort()
+    return entries
+
+def walk_metadata_files( basedir, recursive=False, files_first=False, excludes=METADATA_EXCLUDE_DIRS, mtimes=None ):
+    """Yields (model, path) for .json files in basedir as they are found.
+    
+    Directories named in excludes (.git, tmp) are not entered, and nothing
+    is yielded if basedir is itself inside one.  Directories that can't be
+    read are skipped, as with os.walk.
+    Entries are sorted within each directory.
+    
+    With files_first, files are yielded as soon as they are found, while
+    entities and then collections are held back until the walk is done.
+    This is the order docstore.index needs.  Other .json files (e.g.
+    organization.json) are yielded with the files, with a model of None.
+    
+    @param basedir: Absolute path
+    @param recursive: Whether or not to recurse into subdirectories.
+    @param files_first: If True, list files,entities,collections
+    @param excludes: Names of directories to skip.
+    @param mtimes: (optional) dict; the mtime of each directory walked is added to it.
+    @returns: generator of (model, path) tuples
+    """
+    for name in os.path.abspath(basedir).split(os.sep):
+        if name in excludes:
+            return
+    entities = []
+    collections = []
+    dirs = [basedir]
+    while dirs:
+        dirpath = dirs.pop()
+        try:
+            # stat before listing, so changes made during the listing are seen next time
+            if mtimes is not None:
+                mtimes[dirpath] = os.stat(dirpath).st_mtime
+            entries = _list_dir(dirpath)
+        except OSError:
+            continue
+        subdirs = []
+        for name,is_dir in entries:
+            if is_dir:
+                if recursive and (name not in excludes):
+                    subdirs.append(os.path.join(dirpath, name))
+            elif name.endswith('.json'):
+                path = os.path.join(dirpath, name)
+                model = model_from_path(name)
+                if files_first and (model == 'entity'):
+                    entities.append(path)
+                elif files_first and (model == 'collection'):
+                    collections.append(path)
+                else:
+                    yield model,path
+        # depth-first, in name order
+        subdirs.reverse()
+        dirs.extend(subdirs)
+    for path in entities:
+        yield 'entity',path
+    for path in collections:
+        yield 'collection',path
+
+METADATA_CACHE_FILENAME = '.metadata_files'
+
+# Directories modified this recently (seconds) when the cache is written
+# are rewalked next time, since a change in the same tick would not alter
+# their mtime.  2 seconds covers FAT-formatted USB drives.
+MTIME_RESOLUTION = 2
+
+def _dir_mtime( path ):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+def _read_metadata_cache( cache_path ):
+    """Reads a .metadata_files cache.
+    
+    The header records the HEAD commit, whether the walk was recursive,
+    and the mtime of each directory walked:
+        # head 1a2b3c...
+        # recursive 1
+        # dir 1413456789.123 /var/www/media/base/ddr-test-123
+    followed by one path per line.
+    
+    @param cache_path: Absolute path to cache file.
+    @returns: head,recursive,mtimes,paths; None if file has no header.
+    """
+    head = None
+    recursive = None
+    mtimes = {}
+    paths = []
+    with open(cache_path, 'r') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if line.startswith('# head '):
+                head = line[7:].strip() or None
+            elif line.startswith('# recursive '):
+                recursive = bool(int(line[12:]))
+            elif line.startswith('# dir '):
+                mtime,path = line[6:].split(' ', 1)
+                mtimes[path] = float(mtime)
+            elif line.startswith('#'):
+                pass
+            elif line.strip():
+                paths.append(line.strip())
+    # caches written by older versions have no header and can't be validated
+    if recursive is None:
+        return None
+    return head,recursive,mtimes,paths
+
+def _write_metadata_cache( cache_path, head, recursive, mtimes, paths ):
+    """Writes a .metadata_files cache atomically.
+    
+    See _read_metadata_cache for the format.
+    
+    @param cache_path: Absolute path to cache file.
+    @param head: SHA1 of HEAD commit, or None.
+    @param recursive: Whether the walk was recursive.
+    @param mtimes: dict of directory mtimes.
+    @param paths: list of paths
+    """
+    now = time.time()
+    lines = [
+        '# head %s' % (head or ''),
+        '# recursive %s' % int(bool(recursive)),
+    ]
+    for path in sorted(mtimes.keys()):
+        mtime = mtimes[path]
+        if mtime >= (now - MTIME_RESOLUTION):
+            mtime = 0
+        lines.append('# dir %r %s' % (mtime, path))
+    lines.extend(paths)
+    fd,tmp_path = tempfile.mkstemp(prefix=METADATA_CACHE_FILENAME, dir=os.path.dirname(cache_path))
+    with os.fdopen(fd, 'w') as f:
+        f.write('\n'.join(lines))
+        f.write('\n')
+    os.chmod(tmp_path, 0o644)
+    os.rename(tmp_path, cache_path)
+
+def _nearest_dir( path, mtimes, basedir ):
+    """Returns path or its nearest ancestor that is in mtimes.
+    """
+    while path not in mtimes:
+        if (len(path) <= len(basedir)) or (path == os.path.dirname(path)):
+            return basedir
+        path = os.path.dirname(path)
+    return path
+
+def _under( path, dirs, basedir ):
+    """Indicates whether path is one of dirs or is inside one of them.
+    """
+    while len(path) >= len(basedir):
+        if path in dirs:
+            return True
+        parent = os.path.dirname(path)
+        if parent == path:
             break
-        h.update(data)
-    f.close()
-    return h.hexdigest()
+        path = parent
+    return False
 
-def metadata_files( basedir, recursive=False, files_first=False, force_read=False, save=False ):
+def _refresh_metadata_cache( basedir, cached, head, excludes=METADATA_EXCLUDE_DIRS ):
+    """Rewalks the parts of a cached tree that have changed.
+    
+    A directory's mtime changes when entries are added to or removed
+    from it, so only directories whose mtimes differ from the cached
+    ones (and their subdirectories) are walked again.
+    If HEAD has moved, directories with files added or removed by the
+    intervening commits are rewalked too, in case the mtimes can't be
+    trusted.
+    
+    @param basedir: Absolute path
+    @param cached: Output of _read_metadata_cache
+    @param head: SHA1 of current HEAD commit, or None.
+    @param excludes: Names of directories to skip.
+    @returns: mtimes,paths,changed; None if a full walk is needed.
+    """
+    cached_head,recursive,mtimes,paths = cached
+    # Writing the cache changes basedir's mtime, so basedir is listed
+    # and compared with the cache instead.
+    stale = [
+        path for path,mtime in mtimes.iteritems()
+        if (path != basedir) and (_dir_mtime(path) != mtime)
+    ]
+    if head and cached_head and (head != cached_head):
+        try:
+            changes = dvcs.diff_name_status(basedir, cached_head, head)
+        except:
+            return None
+        for status,relpath in changes:
+            if status in ['A','D']:
+                dirpath = os.path.dirname(os.path.join(basedir, relpath))
+                stale.append(_nearest_dir(dirpath, mtimes, basedir))
+    elif head != cached_head:
+        return None
+    try:
+        entries = _list_dir(basedir)
+    except OSError:
+        return None
+    subdirs = set()
+    toplevel = []
+    for name,is_dir in entries:
+        path = os.path.join(basedir, name)
+        if is_dir and recursive and (name not in excludes):
+            subdirs.add(path)
+        elif (not is_dir) and name.endswith('.json'):
+            toplevel.append(path)
+    cached_subdirs = set([
+        path for path in mtimes.iterkeys()
+        if (path != basedir) and (os.path.dirname(path) == basedir)
+    ])
+    cached_toplevel = [path for path in paths if os.path.dirname(path) == basedir]
+    # added or removed subdirectories
+    stale.extend(subdirs.symmetric_difference(cached_subdirs))
+    stale = [path for path in stale if path != basedir]
+    if (not stale) and (sorted(toplevel) == sorted(cached_toplevel)):
+        return mtimes,paths,False
+    paths = [path for path in paths if os.path.dirname(path) != basedir] + toplevel
+    # walk each changed subtree once
+    stale.sort(key=lambda path: path + os.sep)
+    tops = []
+    for path in stale:
+        if not (tops and (path + os.sep).startswith(tops[-1] + os.sep)):
+            tops.append(path)
+    topset = set(tops)
+    mtimes = dict([
+        (path,mtime) for path,mtime in mtimes.iteritems()
+        if not _under(path, topset, basedir)
+    ])
+    paths = [path for path in paths if not _under(os.path.dirname(path), topset, basedir)]
+    for top in tops:
+        paths.extend([
+            path for model,path in walk_metadata_files(top, recursive, excludes=excludes, mtimes=mtimes)
+        ])
+    return mtimes,paths,True
+
+def metadata_files( basedir, recursive=False, files_first=False, force_read=False, save=False, excludes=METADATA_EXCLUDE_DIRS ):
     """Lists absolute paths to .json files in basedir; saves copy if requested.
     
-    Skips/excludes .git directories.
+    Skips/excludes .git and tmp directories.  See walk_metadata_files.
+    
+    A saved copy is only used if it matches the current state of basedir.
+    It records the HEAD commit and the mtime of each directory, and
+    directories that changed since it was written are walked again.
     
     @param basedir: Absolute path
     @param recursive: Whether or not to recurse into subdirectories.
     @param files_first: If True, list files,entities,collections; otherwise sort.
     @param force_read: If True, always searches for files instead of using cache.
     @param save: Write a copy to basedir.
+    @param excludes: Names of directories to skip.
     @returns: list of paths
     """
-    CACHE_FILENAME = '.metadata_files'
+    basedir = os.path.normpath(basedir)
+    CACHE_FILENAME = METADATA_CACHE_FILENAME
     CACHE_PATH = os.path.join(basedir, CACHE_FILENAME)
-    paths = []
+    head = None
+    if os.path.exists(os.path.join(basedir, '.git')):
+        try:
+            head = dvcs.head_sha(basedir)
+        except:
+            head = None
+    refreshed = None
     if os.path.exists(CACHE_PATH) and not force_read:
-        with open(CACHE_PATH, 'r') as f:
-            paths = [line.strip() for line in f.readlines() if '#' not in line]
-    else:
-        excludes = ['.git', 'tmp', '*~']
-        if recursive:
-            for root, dirs, files in os.walk(basedir):
-                # don't go down into .git directory
-                if '.git' in dirs:
-                    dirs.remove('.git')
-                for f in files:
-                    if f.endswith('.json'):
-                        path = os.path.join(root, f)
-                        exclude = [1 for x in excludes if x in path]
-                        if not exclude:
-                            paths.append(path)
-        else:
-            for f in os.listdir(basedir):
-                if f.endswith('.json'):
-                    path = os.path.join(basedir, f)
-                    exclude = [1 for x in excludes if x in path]
-                    if not exclude:
-                        paths.append(path)
-    # files_first is useful for docstore.index
-    if files_first:
-        collections = []
-        entities = []
-        files = []
-        for f in paths:
-            if f.endswith('collection.json'): collections.append(f)
-            elif f.endswith('entity.json'): entities.append(f)
-            elif f.endswith('.json'): files.append(f)
-        paths = files + entities + collections
+        cached = _read_metadata_cache(CACHE_PATH)
+        if cached and (cached[1] == bool(recursive)):
+            refreshed = _refresh_metadata_cache(basedir, cached, head, excludes)
+    if refreshed:
+        mtimes,paths,changed = refreshed
     else:
-        paths.sort()
+        mtimes = {}
+        paths = [path for model,path in walk_metadata_files(basedir, recursive, excludes=excludes, mtimes=mtimes)]
+    paths.sort()
     # write paths to {basedir}/{CACHE_FILENAME}
     if save:
         # add CACHE_PATH to .gitignore
@@ -108,8 +557,17 @@ def metadata_files( basedir, recursive=False, files_first=False, force_read=Fals
                 with open(gitignore_path, 'a') as giff:
                     giff.write('%s\n' % CACHE_FILENAME)
         # write
-        with open(CACHE_PATH, 'w') as f:
-            f.write('\n'.join(paths))
+        _write_metadata_cache(CACHE_PATH, head, recursive, mtimes, paths)
+    # files_first is useful for docstore.index
+    if files_first:
+        collections = []
+        entities = []
+        files = []
+        for f in paths:
+            if f.endswith('collection.json'): collections.append(f)
+            elif f.endswith('entity.json'): entities.append(f)
+            elif f.endswith('.json'): files.append(f)
+        paths = files + entities + collections
     return paths
 
 class Path( object ):
@@ -309,24 +767,132 @@ def parent_id( object_id ):
     elif len(parts) == 6: return '-'.join([ parts[0], parts[1], parts[2], parts[3] ])
     return None
 
+# Model definitions and things made from them, see model_definitions
+_MODEL_DEFINITIONS = {}
+
+def _file_mtimes( paths ):
+    """
+    @param paths: list of absolute paths
+    @returns: tuple of (path,mtime) tuples; mtime is None if file is missing.
+    """
+    mtimes = []
+    for path in paths:
+        try:
+            mtimes.append( (path, os.path.getmtime(path)) )
+        except OSError:
+            mtimes.append( (path, None) )
+    return tuple(mtimes)
+
+def _model_definitions_entry( models_dir, model_names ):
+    key = (models_dir, tuple(model_names))
+    paths = [os.path.join(models_dir, '%s.json' % model) for model in model_names]
+    mtimes = _file_mtimes(paths)
+    entry = _MODEL_DEFINITIONS.get(key, None)
+    if (not entry) or (entry['mtimes'] != mtimes):
+        definitions = {}
+        for model,(path,mtime) in zip(model_names, mtimes):
+            if mtime is not None:
+                with open(path, 'r') as f:
+                    definitions[model] = json.loads(f.read())
+        entry = {'mtimes':mtimes, 'definitions':definitions, 'derived':{}}
+        _MODEL_DEFINITIONS[key] = entry
+    return entry
+
+def model_definitions( models_dir=MODELS_DIR, model_names=MODELS ):
+    """Loads model definition (*.json) files, rereading them only when they change.
+    
+    Models whose files are missing are left out.
+    
+    @param models_dir: Absolute path to directory containing model files
+    @param model_names: List of model names
+    @returns: dict of lists of field dicts, keyed by model name
+    """
+    return copy.deepcopy(_model_definitions_entry(models_dir, model_names)['definitions'])
+
+def derived_from_models( name, make, models_dir=MODELS_DIR, model_names=MODELS, paths=[] ):
+    """Memoizes something made from the model definitions.
+    
+    The value is made again when a model file, or one of the other
+    files it depends on, changes.  Callers get a copy they can modify.
+    
+    >>> derived_from_models('mappings', make_mappings, paths=[MAPPINGS_PATH])
+    
+    @param name: Unique name for the value
+    @param make: function(definitions) where definitions is output of model_definitions
+    @param models_dir: Absolute path to directory containing model files
+    @param model_names: List of model names
+    @param paths: (optional) Other files the value depends on.
+    @returns: Whatever make returns
+    """
+    entry = _model_definitions_entry(models_dir, model_names)
+    mtimes = _file_mtimes(paths)
+    derived = entry['derived'].get(name, None)
+    if (not derived) or (derived[0] != mtimes):
+        derived = (mtimes, make(entry['definitions']))
+        entry['derived'][name] = derived
+    return copy.deepcopy(derived[1])
+
+def _public_fields( definitions ):
+    public = {}
+    for model,fields in definitions.items():
+        public[model] = [
+            field['name'] for field in fields
+            if field.get('elasticsearch',None) and field['elasticsearch'].get('public',None)
+        ]
+    # add dynamically created fields
+    if 'file' in public:
+        public['file'].append('path_rel')
+        public['file'].append('id')
+    return public
+
+def public_fields( models_dir=MODELS_DIR, model_names=MODELS ):
+    """Lists fields marked public for each model.
+    
+    IMPORTANT: Adds certain dynamically-created fields
+    
+    @param models_dir: Absolute path to directory containing model files
+    @param model_names: List of model names
+    @returns: dict of lists of field names, keyed by model name
+    """
+    return derived_from_models('public_fields', _public_fields, models_dir, model_names)
+
+def inheritable_fields( model, models_dir=MODELS_DIR ):
+    """Lists fields of model that can inherit or grant values.
+    
+    @param model: Model name
+    @param models_dir: Absolute path to directory containing model files
+    @returns: list of field names
+    """
+    return derived_from_models(
+        'inheritable_fields',
+        lambda definitions: dict([
+            (name, _inheritable_fields(fields)) for name,fields in definitions.items()
+        ]),
+        models_dir).get(model, [])
+
+def _list_fields( definitions ):
+    listed = {}
+    for model,fields in definitions.items():
+        listed[model] = []
+        for field in fields:
+            f = {'name':field['name'],}
+            if field.get('form',None) and field['form'].get('label',None):
+                f['label'] = field['form']['label']
+            listed[model].append(f)
+    return listed
+
 def model_fields( model ):
     """
     THIS FUNCTION IS A PLACEHOLDER.
     It's a step on the way to refactoring (COLLECTION|ENTITY|FILE)_FIELDS.
     It gives ddr-public a way to know the order of fields until we have a better solution.
+    
+    @param model: Model name
+    @returns: list of {'name','label'} dicts in model file order
     """
     # TODO model .json files should live in /etc/ddr/models
     if model in ['collection', 'entity', 'file']:
-        json_path = os.path.join(MODELS_DIR, '%s.json' % model)
-        with open(json_path, 'r') as f:
-            data = json.loads(f.read())
-        fields = []
-        for field in data:
-            f = {'name':field['name'],}
-            if field.get('form',None) and field['form'].get('label',None):
-                f['label'] = field['form']['label']
-            fields.append(f)
-        return fields
+        return derived_from_models('list_fields', _list_fields).get(model, [])
     return []
 
 def module_function(module, function_name, value):
@@ -713,15 +1279,38 @@ class Entity( object ):
     
     @staticmethod
     def checksum_algorithms():
-        return ['md5', 'sha1', 'sha256']
+        return list(HASH_ALGORITHMS)
     
-    def checksums( self, algo ):
+    def checksums( self, algo, verify=False, workers=HASH_WORKERS, io_limit=HASH_IO_LIMIT ):
+        """Checksums of payload files, from the collection's checksum cache.
+        
+        @param algo: Name of algorithm (see checksum_algorithms).
+        @param verify: boolean Ignore cached checksums and rehash files.
+        @param workers: int Number of hashing threads (see hash_files).
+        @param io_limit: int Max number of files read at once (see hash_files).
+        @returns: list of (checksum, path) tuples
+        """
         checksums = []
         if algo not in Entity.checksum_algorithms():
             raise Error('BAD ALGORITHM CHOICE: {}'.format(algo))
-        for f in self.file_paths():
-            fpath = os.path.join(self.files_path, f)
-            cs = file_hash(fpath, algo)
+        for fpath,hashes in self.file_hashes(verify=verify, workers=workers, io_limit=io_limit):
+            cs = hashes[algo]
             if cs:
                 checksums.append( (cs, fpath) )
         return checksums
+    
+    def file_hashes( self, verify=False, workers=HASH_WORKERS, io_limit=HASH_IO_LIMIT ):
+        """Computes all checksums of each payload file, reading each file once.
+        
+        Unchanged files are not read again; see models.cached_file_hashes.
+        
+        @param verify: boolean Ignore cached checksums and rehash files.
+        @param workers: int Number of hashing threads (see hash_files).
+        @param io_limit: int Max number of files read at once (see hash_files).
+        @returns: list of (path, hashes) tuples; see models.file_hashes.
+        """
+        paths = [os.path.join(self.files_path, f) for f in self.file_paths()]
+        return cached_file_hashes(
+            self.parent_path, paths, Entity.checksum_algorithms(),
+            verify=verify, prune=self.files_path,
+            workers=workers, io_limit=io_limit)
@@ -6,6 +6,10 @@ def test_natural_sort():
     DDR.natural_sort(l)
     assert l == ['1', '2', '3', '11', '12', '13']
 
+def test_natural_sort_key():
+    assert DDR.natural_sort_key('ddr-test-123-10') == ['ddr-test-', 123, '-', 10, '']
+    assert DDR.natural_sort_key('abc') == ['abc']
+
 def test_natural_order_string():
     assert DDR.natural_order_string('ddr-testing-123') == '123'
     assert DDR.natural_order_string('ddr-testing-123-1') == '1'
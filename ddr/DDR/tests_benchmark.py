@@ -0,0 +1,47 @@
+import json
+import os
+import tempfile
+
+from nose.tools import assert_raises
+
+import benchmark
+import docstore
+import models
+
+
+def test_make_document():
+    modelfields = docstore._model_fields(models.MODELS_DIR, models.MODELS)
+    document = benchmark.make_document(modelfields['entity'], 'ddr-bench-1-2', 2)
+    assert document[0] == benchmark.APP_FIELD
+    assert len(document) == len(modelfields['entity']) + 1
+    data = docstore.make_transform()(document)
+    assert data['id'] == 'ddr-bench-1-2'
+    assert data['parent'] == {'href':'', 'uuid':'', 'label':'ddr-bench-1'}
+    document = benchmark.make_document(
+        modelfields['file'], 'ddr-bench-1-2-master-a1b2c3d4e5', 0,
+        {'path_rel': 'ddr-bench-1-2-master-a1b2c3d4e5.tif'})
+    model,document_id,data,error = docstore._prep_document(document)
+    assert model == 'file'
+    assert document_id == 'ddr-bench-1-2-master-a1b2c3d4e5'
+    assert error == None
+
+def test_generate_collection():
+    # metadata in tmp dirs is ignored, so don't generate anything there
+    basedir = tempfile.mkdtemp()
+    assert_raises(Exception, benchmark.generate_collection, basedir)
+    os.rmdir(basedir)
+
+def test_stub_server():
+    server = benchmark.start_stub_server()
+    hosts = benchmark.stub_hosts(server)
+    try:
+        documents = [
+            ('a', 'entity', 'ddr-bench-1-1', {'id':'ddr-bench-1-1'}),
+            ('b', 'entity', 'ddr-bench-1-2', {'id':'ddr-bench-1-2'}),
+        ]
+        results = list(docstore.bulk_post(hosts, 'benchmark', documents))
+        assert [(key,status) for key,status,response in results] == [('a',201), ('b',201)]
+        assert server.requests == 1
+        assert server.documents == 2
+    finally:
+        benchmark.stop_stub_server(server)
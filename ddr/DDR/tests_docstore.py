@@ -1,5 +1,10 @@
 from datetime import datetime
 import json
+import copy
+import os
+import shutil
+import StringIO
+import tempfile
 
 from nose.tools import assert_raises
 from nose.plugins.attrib import attr
@@ -24,10 +29,172 @@ def test_get_connection():
     assert es
     assert es.cat.client.ping() == True
 
+def test_hosts_key():
+    assert docstore._hosts_key(HOSTS) == ((('host', '127.0.0.1'), ('port', 9200)),)
+    assert docstore._hosts_key('127.0.0.1:9200') == ('127.0.0.1:9200',)
+
+def test_connection_cache():
+    docstore.reset_connections()
+    es0 = docstore._get_connection(HOSTS)
+    es1 = docstore._get_connection([{'port':9200, 'host':'127.0.0.1'}])
+    es2 = docstore._get_connection([{'host':'127.0.0.2', 'port':9200}])
+    assert es0 is es1
+    assert es0 is not es2
+    docstore.close_connections(HOSTS)
+    assert len(docstore._CONNECTIONS) == 1
+    assert docstore._get_connection(HOSTS) is not es0
+    docstore.close_connections()
+    assert docstore._CONNECTIONS == {}
+
+def test_query_cache():
+    cache = docstore.QueryCache(maxsize=2, ttl=60)
+    hosts_key = docstore._hosts_key(HOSTS)
+    key0 = cache.key('get', hosts_key, {'index':'ddr', 'document_id':'ddr-test-1'})
+    key1 = cache.key('get', hosts_key, {'document_id':'ddr-test-1', 'index':'ddr'})
+    key2 = cache.key('get', hosts_key, {'index':'ddr', 'document_id':'ddr-test-2'})
+    assert key0 == key1
+    assert cache.get(key0) == (False,None)
+    value = {'_id':'ddr-test-1'}
+    cache.set(key0, value)
+    value['_id'] = 'changed'
+    assert cache.get(key0) == (True,{'_id':'ddr-test-1'})
+    # least recently used entry is dropped
+    cache.set(key2, 2)
+    cache.set('whatever', 3)
+    assert cache.get(key0) == (False,None)
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 2
+    assert cache.stats()['size'] == 2
+    # writes make existing keys unreachable
+    cache.invalidate(HOSTS)
+    assert cache.key('get', hosts_key, {'index':'ddr', 'document_id':'ddr-test-2'}) != key2
+    # expired entries are misses
+    cache = docstore.QueryCache(maxsize=2, ttl=-1)
+    cache.set(key0, 1)
+    assert cache.get(key0) == (False,None)
+
+def test_cached_query():
+    calls = []
+    def query(hosts, index, model=None):
+        calls.append(index)
+        return {'index':index}
+    cached = docstore._cached_query(query)
+    docstore.configure_query_cache(10)
+    try:
+        assert cached(HOSTS, 'ddr') == {'index':'ddr'}
+        assert cached(HOSTS, index='ddr') == {'index':'ddr'}
+        assert calls == ['ddr']
+        docstore.QUERY_CACHE.invalidate(HOSTS)
+        cached(HOSTS, 'ddr')
+        assert calls == ['ddr', 'ddr']
+    finally:
+        docstore.configure_query_cache(0)
+    cached(HOSTS, 'ddr')
+    assert calls == ['ddr', 'ddr', 'ddr']
+
+class WriteES(object):
+    """Records the query cache generation while each write is in progress."""
+    def __init__(self):
+        self.indices = self
+        self.cat = self
+        self.generations = []
+    def _generation(self):
+        return docstore.QUERY_CACHE._generations.get(docstore._hosts_key(HOSTS), 0)
+    def aliases(self, h):
+        return u'documents-old documents \n'
+    def exists(self, index):
+        return True
+    def update_aliases(self, body):
+        self.generations.append(self._generation())
+    def delete(self, index, doc_type=None, id=None):
+        self.generations.append(self._generation())
+
+def test_invalidate_after_write():
+    es = WriteES()
+    get_connection = docstore._get_connection
+    try:
+        docstore._get_connection = lambda hosts: es
+        before = es._generation()
+        docstore.set_alias(HOSTS, 'documents', 'documents-new')
+        assert es.generations == [before]
+        assert es._generation() == before + 1
+        docstore.delete_index(HOSTS, 'documents-old')
+        assert es.generations[-1] == before + 1
+        assert es._generation() == before + 2
+        docstore.delete(HOSTS, 'documents', 'ddr-test-1-1')
+        assert es.generations[-1] == before + 2
+        assert es._generation() == before + 3
+    finally:
+        docstore._get_connection = get_connection
+
 def test_make_index_name():
     assert docstore.make_index_name('abc-def_ghi.jkl/mno\\pqr stu') == 'abc-def_ghi.jkl-mno-pqrstu'
     assert docstore.make_index_name('qnfs/kinkura/gold') == 'qnfs-kinkura-gold'
 
+def test_rebuild_index_name():
+    timestamp = datetime(2015,1,2,3,4,5)
+    assert docstore.rebuild_index_name('Documents', timestamp) == 'documents-20150102030405'
+
+class SettingsES(object):
+    def __init__(self, settings):
+        self.indices = self
+        self.settings = settings
+    def get_settings(self, index):
+        return {index: {'settings': self.settings}}
+
+def test_index_settings():
+    names = ['refresh_interval', 'number_of_replicas']
+    get_connection = docstore._get_connection
+    try:
+        docstore._get_connection = lambda hosts: SettingsES({'index': {'number_of_replicas':'2'}})
+        assert docstore._index_settings(HOSTS, 'documents', names) == {
+            'refresh_interval':'1s', 'number_of_replicas':'2'}
+        docstore._get_connection = lambda hosts: SettingsES({'index.refresh_interval':'30s'})
+        assert docstore._index_settings(HOSTS, 'documents', names) == {
+            'refresh_interval':'30s', 'number_of_replicas':1}
+    finally:
+        docstore._get_connection = get_connection
+
+class RebuildES(object):
+    def __init__(self):
+        self.indices = self
+    def put_settings(self, index, body):
+        pass
+    def refresh(self, index):
+        pass
+
+def test_rebuild_errors():
+    calls = []
+    bad = []
+    names = ['_get_connection', 'target_index', 'create_index', 'put_mappings',
+             'put_facets', '_index_settings', 'index_collections', 'set_alias', 'delete_index']
+    saved = dict([(name, getattr(docstore, name)) for name in names])
+    try:
+        docstore._get_connection = lambda hosts: RebuildES()
+        docstore.target_index = lambda hosts, alias: 'documents-old'
+        docstore.create_index = lambda hosts, index: None
+        docstore.put_mappings = lambda *args: None
+        docstore.put_facets = lambda *args: None
+        docstore._index_settings = lambda *args: {}
+        docstore.index_collections = lambda *args, **kwargs: {'total':2, 'successful':1, 'bad':list(bad)}
+        docstore.set_alias = lambda hosts, alias, index: calls.append(('set_alias', index))
+        docstore.delete_index = lambda hosts, index: calls.append(('delete_index', index))
+        # unpublishable documents don't stop the alias from moving
+        bad[:] = [('/path/a', 403, 'not publishable')]
+        rebuilt = docstore.rebuild(HOSTS, 'documents', '/path', delete_old=True)
+        assert rebuilt['aliased'] == True
+        assert calls == [('set_alias', rebuilt['index']), ('delete_index', 'documents-old')]
+        # other errors leave the alias and the old index alone
+        del calls[:]
+        bad[:] = [('/path/a', 500, 'error')]
+        rebuilt = docstore.rebuild(HOSTS, 'documents', '/path', delete_old=True)
+        assert rebuilt['aliased'] == False
+        assert rebuilt['old_index'] == 'documents-old'
+        assert calls == []
+    finally:
+        for name,value in saved.items():
+            setattr(docstore, name, value)
+
 # index_exists
 # index_names
 # create_index
@@ -65,6 +232,35 @@ def test_parse_cataliases():
 # list_facets
 # facet_terms
 
+def test_facets_aggs():
+    aggs = docstore._facets_aggs(['genre', 'topics'], order='count', all_terms=False)
+    assert sorted(aggs.keys()) == ['genre', 'genre__missing', 'topics', 'topics__missing']
+    assert aggs['genre']['terms'] == {
+        'field':'genre', 'size':0, 'order':{'_count':'desc'}, 'min_doc_count':1}
+    assert aggs['topics__missing'] == {'missing': {'field':'topics'}}
+
+def test_aggs_facet():
+    aggregations = {
+        'genre': {
+            'sum_other_doc_count': 0,
+            'buckets': [
+                {'key':'photograph', 'doc_count':14},
+                {'key':'ephemera', 'doc_count':6},
+            ]
+        },
+        'genre__missing': {'doc_count':203},
+    }
+    assert docstore._aggs_facet(aggregations, 'genre') == {
+        '_type': 'terms',
+        'missing': 203,
+        'total': 20,
+        'other': 0,
+        'terms': [
+            {'term':'photograph', 'count':14},
+            {'term':'ephemera', 'count':6},
+        ]
+    }
+
 def test_is_publishable():
     data0 = [{'id': 'ddr-testing-123-1'}]
     data1 = [{'id': 'ddr-testing-123-1'}, {'public':0}, {'status':'inprogress'}]
@@ -173,7 +369,164 @@ def test_clean_payload():
     ]
     assert data == expected
 
+def test_prep_document():
+    document = [
+        {'app_commit': 'abc123'},
+        {'id': 'ddr-testing-123-1'},
+        {'title': 'Title'},
+        {'secret': 'this is a secret'},
+        {'public': 1},
+        {'status': 'completed'},
+    ]
+    public_fields = ['id', 'title', 'public', 'status']
+    additional_fields = {'parent_id': 'ddr-testing-123'}
+    model,document_id,data,error = docstore._prep_document(
+        document, public_fields, additional_fields)
+    assert model == 'entity'
+    assert document_id == 'ddr-testing-123-1'
+    assert error == None
+    assert data == {
+        'app_commit': 'abc123',
+        'id': 'ddr-testing-123-1', 'title': 'Title', 'public': 1, 'status': 'completed',
+        'repo': 'ddr', 'org': 'testing', 'cid': 123, 'eid': 1,
+        'parent_id': 'ddr-testing-123',
+        'content_hash': docstore.content_hash(data),
+    }
+    unpublishable = [{'app_commit': 'abc123'}, {'id': 'ddr-testing-123-1'}, {'public': 0}]
+    model,document_id,data,error = docstore._prep_document(unpublishable)
+    assert error == {'status':403, 'response':'object not publishable'}
+
+def test_content_hash():
+    data = {'id': 'ddr-testing-123-1', 'title': 'Title'}
+    h = docstore.content_hash(data)
+    assert len(h) == 40
+    # ignores existing hash, sensitive to content
+    assert docstore.content_hash(dict(data, content_hash=h)) == h
+    assert docstore.content_hash(dict(data, title='Other')) != h
+
+def test_make_transform():
+    document = [
+        {'app_commit': 'abc123', 'empty': ''},
+        {'id': 'ddr-testing-123-1'},
+        {'title': ''},
+        {'creators': [{'namepart': 'Boyle, Rob', 'role': 'author'}]},
+        {'facility': 'Tule Lake [10]'},
+        {'parent': 'ddr-testing-123'},
+        {'topics': ['Topics [123]']},
+        {'secret': 'this is a secret'},
+        {'public': 1},
+        {'status': 'completed'},
+    ]
+    original = json.dumps(document)
+    data = docstore.make_transform()(document)
+    assert data == {
+        'app_commit': 'abc123', 'empty': '',
+        'id': 'ddr-testing-123-1',
+        'creators': ['Boyle, Rob'],
+        'facility': ['10'],
+        'parent': {'href':'', 'uuid':'', 'label':'ddr-testing-123'},
+        'topics': ['123'],
+        'secret': 'this is a secret',
+        'public': 1, 'status': 'completed',
+    }
+    # document is not modified
+    assert json.dumps(document) == original
+    # same results as the old filter/clean functions
+    expected = json.loads(original)
+    docstore._filter_payload(expected, ['id', 'title', 'topics', 'public', 'status'])
+    docstore._clean_payload(expected)
+    expected = dict([(k,v) for field in expected for k,v in field.iteritems()])
+    transform = docstore.make_transform(['id', 'title', 'topics', 'public', 'status'])
+    assert transform(document) == expected
+    # stages
+    def add_stage(data):
+        data['stage'] = 'added'
+        return data
+    transform = docstore.make_transform(['id', 'public', 'status'], stages=[add_stage])
+    assert transform(document)['stage'] == 'added'
+    # not publishable
+    assert transform([{'app_commit': 'abc123'}, {'id': 'ddr-testing-123-1'}, {'public': 0}]) == None
+
+def test_bulk_chunks():
+    actions = [
+        ('a', '{"index":{}}', '{"x":"1"}'),
+        ('b', '{"index":{}}', '{"x":"22"}'),
+        ('c', '{"index":{}}', '{"x":"333"}'),
+    ]
+    def keys(chunks):
+        return [[key for key,action,data in chunk] for chunk in chunks]
+    assert keys(docstore._bulk_chunks(actions)) == [['a','b','c']]
+    assert keys(docstore._bulk_chunks(actions, chunk_size=2)) == [['a','b'], ['c']]
+    # each action is ~23-25 bytes
+    assert keys(docstore._bulk_chunks(actions, max_bytes=50)) == [['a','b'], ['c']]
+    assert keys(docstore._bulk_chunks(actions, max_bytes=10)) == [['a'], ['b'], ['c']]
+    assert keys(docstore._bulk_chunks([])) == []
+
+class BulkES(object):
+    def __init__(self):
+        self.bodies = []
+    def bulk(self, body):
+        self.bodies.append(body)
+        lines = [json.loads(line) for line in body.strip().split('\n')]
+        return {'items': [
+            {'delete': {'status': 404 if line['delete']['_id'].endswith('2') else 200}}
+            for line in lines
+        ]}
+
+def test_bulk_delete():
+    es = BulkES()
+    get_connection = docstore._get_connection
+    docstore._get_connection = lambda hosts: es
+    try:
+        results = list(docstore.bulk_delete(
+            HOSTS, 'fakeindex',
+            [('file','ddr-test-1-1-master-a1'), ('entity','ddr-test-1-2'), ('collection','ddr-test-1')],
+            chunk_size=2))
+    finally:
+        docstore._get_connection = get_connection
+    assert [(object_id,status) for object_id,status,response in results] == [
+        ('ddr-test-1-1-master-a1', 200), ('ddr-test-1-2', 404), ('ddr-test-1', 200)]
+    # delete actions have no data lines
+    assert len(es.bodies) == 2
+    assert es.bodies[1].endswith('}\n')
+    assert json.loads(es.bodies[1]) == {
+        'delete': {'_index':'fakeindex', '_type':'collection', '_id':'ddr-test-1'}}
+
+def test_scan_filter():
+    assert docstore._scan_filter({'collection_id':'ddr-test-1'}) == {
+        'term': {'collection_id':'ddr-test-1'}}
+    assert docstore._scan_filter({'entity_id':['ddr-test-1-1', 'ddr-test-1-2']}) == {
+        'terms': {'entity_id':['ddr-test-1-1', 'ddr-test-1-2']}}
+    assert docstore._scan_filter({'entity_id':['ddr-test-1-1'], 'public':1}) == {
+        'and': [{'terms': {'entity_id':['ddr-test-1-1']}}, {'term': {'public':1}}]}
+
 # post
+# bulk_post
+class FacetsES(object):
+    def __init__(self):
+        self.bodies = []
+    def search(self, index, doc_type, body, search_type):
+        self.bodies.append(body)
+        return {'aggregations': {
+            'genre': {'sum_other_doc_count': 0, 'buckets': []},
+            'genre__missing': {'doc_count': 0},
+        }}
+
+def test_facets_terms_filters():
+    es = FacetsES()
+    get_connection = docstore._get_connection
+    try:
+        docstore._get_connection = lambda hosts: es
+        filters = {'genre': 'photograph', 'topics': ''}
+        docstore.facets_terms(HOSTS, 'ddr', ['genre'], filters=filters)
+        assert es.bodies[-1]['query']['filtered']['filter'] == {'term': {'genre': 'photograph'}}
+        # caller's dict is not modified
+        assert filters == {'genre': 'photograph', 'topics': ''}
+        docstore.facets_terms(HOSTS, 'ddr', ['genre'], filters={'topics': ''})
+        assert es.bodies[-1]['query'] == {'match_all': {}}
+    finally:
+        docstore._get_connection = get_connection
+
 # exists
 # get
 
@@ -191,6 +544,13 @@ def test_validate_number():
     assert_raises(docstore.EmptyPage, docstore._validate_number, 0, 10)
     assert_raises(docstore.EmptyPage, docstore._validate_number, 11, 10)
 
+def test_validate_page():
+    assert_raises(docstore.PageNotAnInteger, docstore._validate_page, None)
+    assert_raises(docstore.PageNotAnInteger, docstore._validate_page, 'x')
+    assert_raises(docstore.EmptyPage, docstore._validate_page, 0)
+    assert docstore._validate_page('2') == 2
+    assert docstore._validate_page(1000) == 1000
+
 def test_page_bottom_top():
     # _page_bottom_top(total, index, page_size) -> bottom,top,num_pages
     # index within bounds
@@ -286,6 +646,89 @@ def test_massage_query_results():
     assert objects0 == MASSAGE_EXPECTED0
     assert objects1 == MASSAGE_EXPECTED1
 
+def test_hit_object():
+    hit = copy.deepcopy(MASSAGE_QUERY_RESULTS['hits']['hits'][2])
+    hit['_source']['title'] = ['TITLE TEXT']
+    o = docstore._hit_object(hit, list_fields=['title'])
+    assert o['id'] == 'ddr-test-123-1-master-a1b2c3'
+    assert o['model'] == 'file'
+    assert o['title'] == 'TITLE TEXT'
+
+def test_search_results():
+    results = docstore.SearchResults(
+        [{'host':'127.0.0.1', 'port':9200}], 'fakeindex', {'query':'whatever'}, 0,
+        copy.deepcopy(MASSAGE_QUERY_RESULTS))
+    assert results.count() == 7
+    assert len(results) == 7
+    assert [o['id'] for o in results] == [
+        'ddr-test-123', 'ddr-test-123-1',
+        'ddr-test-123-1-master-a1b2c3', 'ddr-test-123-2']
+    assert [o['id'] for o in results[1:3]] == [
+        'ddr-test-123-1', 'ddr-test-123-1-master-a1b2c3']
+    assert results[3]['id'] == 'ddr-test-123-2'
+
+class MgetES(object):
+    def __init__(self):
+        self.requests = []
+    def mget(self, index, body):
+        self.requests.append(body)
+        return {'docs': [
+            {'_type':doc['_type'], '_id':doc['_id'], 'found':(doc['_id'] != 'ddr-test-2'), '_version':1}
+            for doc in body['docs']
+        ]}
+
+def test_mget():
+    es = MgetES()
+    get_connection = docstore._get_connection
+    docstore._get_connection = lambda hosts: es
+    try:
+        assert docstore.mget(HOSTS, 'fakeindex', []) == []
+        assert es.requests == []
+        found = docstore.mget(
+            HOSTS, 'fakeindex',
+            [('entity','ddr-test-1'), ('entity','ddr-test-2'), ('file','ddr-test-3')],
+            fields=[])
+        assert [doc['_id'] for doc in found] == ['ddr-test-1', 'ddr-test-3']
+        assert len(es.requests) == 1
+        assert es.requests[0]['docs'][2] == {'_type':'file', '_id':'ddr-test-3', 'fields':[]}
+    finally:
+        docstore._get_connection = get_connection
+
+class ScrollES(object):
+    """Just enough of an Elasticsearch client to exercise scan()."""
+    def __init__(self, batches):
+        self.batches = batches
+        self.cleared = []
+    def search(self, **kwargs):
+        assert kwargs['search_type'] == 'scan'
+        return {'_scroll_id': '0', 'hits': {'total': 3, 'hits': []}}
+    def scroll(self, scroll_id, scroll):
+        n = int(scroll_id)
+        hits = []
+        if n < len(self.batches):
+            hits = self.batches[n]
+        return {'_scroll_id': str(n + 1), 'hits': {'hits': hits}}
+    def clear_scroll(self, scroll_id):
+        self.cleared.append(scroll_id)
+
+def test_scan():
+    es = ScrollES([
+        [{'_id':'ddr-test-1', '_score':0}, {'_id':'ddr-test-2', '_score':0}],
+        [{'_id':'ddr-test-3', '_score':0}],
+    ])
+    get_connection = docstore._get_connection
+    docstore._get_connection = lambda hosts: es
+    try:
+        ids = [hit['_id'] for hit in docstore.scan(HOSTS, 'fakeindex', size=2)]
+        assert ids == ['ddr-test-1', 'ddr-test-2', 'ddr-test-3']
+        assert es.cleared == ['2']
+        output = StringIO.StringIO()
+        assert docstore.dump(HOSTS, 'fakeindex', output) == 3
+        lines = output.getvalue().strip().split('\n')
+        assert json.loads(lines[2]) == {'_id':'ddr-test-3'}
+    finally:
+        docstore._get_connection = get_connection
+
 def test_clean_sort():
     data0 = 'whatever'
     data1 = [['a', 'asc'], ['b', 'asc'], 'whatever']
@@ -315,7 +758,62 @@ def test_public_fields():
     data = json.loads(PUBLIC_FIELDS)
     assert docstore._public_fields(data) == PUBLIC_FIELDS_EXPECTED
 
-# _parents_status
+def test_metadata_record():
+    path = '/BASE/ddr-test-123/files/ddr-test-123-1/entity.json'
+    document = [{'app_commit': 'abc123'}, {'id': 'ddr-test-123-1'}, {'public': '1'}, {'status': 'inprocess'}]
+    expected = {
+        'path': path,
+        'model': 'entity',
+        'id': 'ddr-test-123-1',
+        'parent_ids': ['ddr-test-123'],
+        'public': '1',
+        'status': 'inprocess',
+        'access': False,
+        'document': document,
+    }
+    assert docstore._metadata_record(path, document) == expected
+    path = '/BASE/ddr-test-123/files/ddr-test-123-1/files/ddr-test-123-1-master-96c.json'
+    record = docstore._metadata_record(path, access=True)
+    assert record['model'] == 'file'
+    assert record['id'] == 'ddr-test-123-1-master-96c'
+    assert record['parent_ids'] == ['ddr-test-123', 'ddr-test-123-1']
+    assert record['access'] == True
+    assert record['document'] == None
+
+def test_load_metadata():
+    tmp = tempfile.mkdtemp()
+    edir = os.path.join(tmp, 'ddr-test-123', 'files', 'ddr-test-123-1')
+    fdir = os.path.join(edir, 'files')
+    os.makedirs(fdir)
+    def write(path, data):
+        with open(path, 'w') as f:
+            f.write(json.dumps(data))
+    fjson0 = os.path.join(fdir, 'ddr-test-123-1-master-96c.json')
+    fjson1 = os.path.join(fdir, 'ddr-test-123-1-mezzanine-a1b.json')
+    ejson = os.path.join(edir, 'entity.json')
+    write(fjson0, [{'app_commit': 'abc'}, {'sort': 1}])
+    write(fjson1, [{'app_commit': 'abc'}, {'sort': 2}])
+    write(ejson, [{'app_commit': 'abc'}, {'id': 'ddr-test-123-1'}, {'public': '1'}, {'status': 'completed'}])
+    open(os.path.join(fdir, 'ddr-test-123-1-master-96c-a.jpg'), 'w').close()
+    try:
+        records = docstore._load_metadata([fjson0, fjson1, ejson], parse=set([fjson0, ejson]))
+        assert [r['path'] for r in records] == [fjson0, fjson1, ejson]
+        assert [r['access'] for r in records] == [True, False, False]
+        # files get their id appended
+        assert records[0]['document'] == [{'app_commit': 'abc'}, {'sort': 1}, {'id': 'ddr-test-123-1-master-96c'}]
+        # not in parse
+        assert records[1]['document'] == None
+        assert records[2]['public'] == '1'
+        assert records[2]['status'] == 'completed'
+        parents = docstore._parents_status(records)
+        assert parents == {'ddr-test-123-1': {'public': '1', 'status': 'completed'}}
+        signatures = docstore._choose_signatures(records)
+        assert signatures == {
+            'ddr-test-123': 'ddr-test-123-1-master-96c',
+            'ddr-test-123-1': 'ddr-test-123-1-master-96c',
+        }
+    finally:
+        shutil.rmtree(tmp)
 
 def test_file_parent_ids():
     case0 = ('collection', '.../ddr-testing-123/collection.json', [])
@@ -362,17 +860,163 @@ def test_publishable_or_not():
         ('/BASE/ddr-test-124/files/ddr-test-124-2/files/ddr-test-124-2-master-46c.json',
          403, "parent unpublishable: ['ddr-test-124-2']")
        ]
-    successful_paths,bad_paths = docstore._publishable_or_not(PATHS, PARENTS)
-    assert successful_paths == EXPECTED_SUCCESSFUL
+    records = [docstore._metadata_record(path) for path in PATHS]
+    successful_records,bad_paths = docstore._publishable_or_not(records, PARENTS)
+    assert [r['path'] for r in successful_records] == EXPECTED_SUCCESSFUL
     assert bad_paths == EXPECTED_BAD
 
-# _has_access_file
-# _store_signature_file
+def test_has_access_file():
+    path = '/BASE/ddr-test-123/files/ddr-test-123-1/files/ddr-test-123-1-master-96c.json'
+    listing = set(['ddr-test-123-1-master-96c.json', 'ddr-test-123-1-master-96c-a.jpg'])
+    assert docstore._has_access_file(path, listing=listing) == True
+    assert docstore._has_access_file(path, listing=set()) == False
+    assert docstore._has_access_file(path.replace('.json', '.tif'), listing=listing) == False
+
+def test_select_signatures():
+    file_ids = [
+        'ddr-test-123-10-master-e5f6',
+        'ddr-test-123-2-master-a1b2',
+        'ddr-test-123-10-mezzanine-c3d4',
+        'ddr-test-123-2-master-0000',
+    ]
+    expected = {
+        'ddr-test-123': 'ddr-test-123-2-master-0000',
+        'ddr-test-123-2': 'ddr-test-123-2-master-0000',
+        'ddr-test-123-10': 'ddr-test-123-10-mezzanine-c3d4',
+    }
+    assert docstore.select_signatures(file_ids) == expected
+    assert docstore.select_signatures([]) == {}
+
 # _choose_signatures
+# signatures
 # load_document_json
 
+INCREMENTAL_PATHS = [
+    '/BASE/ddr-test-123/files/ddr-test-123-1/files/ddr-test-123-1-master-96c.json',
+    '/BASE/ddr-test-123/files/ddr-test-123-1/files/ddr-test-123-1-mezzanine-a1b.json',
+    '/BASE/ddr-test-123/files/ddr-test-123-2/files/ddr-test-123-2-master-c46.json',
+    '/BASE/ddr-test-123/files/ddr-test-123-3/files/ddr-test-123-3-master-d57.json',
+    '/BASE/ddr-test-123/files/ddr-test-123-1/entity.json',
+    '/BASE/ddr-test-123/files/ddr-test-123-2/entity.json',
+    '/BASE/ddr-test-123/files/ddr-test-123-3/entity.json',
+    '/BASE/ddr-test-123/collection.json',
+]
+
+def test_incremental_paths():
+    cpath = '/BASE/ddr-test-123'
+    # collection.json changed: full index
+    changes = [('M', 'collection.json')]
+    assert docstore._incremental_paths(cpath, INCREMENTAL_PATHS, changes, 'ddr-test-123-1-master-96c') == None
+    # file changed, file removed
+    changes = [
+        ('M', 'files/ddr-test-123-2/files/ddr-test-123-2-master-c46.json'),
+        ('D', 'files/ddr-test-123-3/files/ddr-test-123-3-master-e68.json'),
+        ('D', 'files/ddr-test-123-3/files/ddr-test-123-3-master-e68-a.jpg'),
+        ('M', 'files/ddr-test-123-3/changelog'),
+    ]
+    plan = docstore._incremental_paths(cpath, INCREMENTAL_PATHS, changes, 'ddr-test-123-1-master-96c')
+    assert plan['post_paths'] == [
+        '/BASE/ddr-test-123/files/ddr-test-123-2/files/ddr-test-123-2-master-c46.json',
+        '/BASE/ddr-test-123/files/ddr-test-123-2/entity.json',
+        '/BASE/ddr-test-123/files/ddr-test-123-3/entity.json',
+    ]
+    assert plan['parent_paths'] == [
+        '/BASE/ddr-test-123/files/ddr-test-123-2/entity.json',
+        '/BASE/ddr-test-123/files/ddr-test-123-3/entity.json',
+        '/BASE/ddr-test-123/collection.json',
+    ]
+    assert plan['signature_paths'] == [
+        '/BASE/ddr-test-123/files/ddr-test-123-1/files/ddr-test-123-1-master-96c.json',
+        '/BASE/ddr-test-123/files/ddr-test-123-2/files/ddr-test-123-2-master-c46.json',
+        '/BASE/ddr-test-123/files/ddr-test-123-3/files/ddr-test-123-3-master-d57.json',
+    ]
+    assert plan['removed_ids'] == ['ddr-test-123-3-master-e68']
+    # entity changed: repost its files; signature entity touched: use all files
+    changes = [('M', 'files/ddr-test-123-1/entity.json')]
+    plan = docstore._incremental_paths(cpath, INCREMENTAL_PATHS, changes, 'ddr-test-123-1-master-96c')
+    assert plan['post_paths'] == [
+        '/BASE/ddr-test-123/files/ddr-test-123-1/files/ddr-test-123-1-master-96c.json',
+        '/BASE/ddr-test-123/files/ddr-test-123-1/files/ddr-test-123-1-mezzanine-a1b.json',
+        '/BASE/ddr-test-123/files/ddr-test-123-1/entity.json',
+    ]
+    assert plan['parent_paths'] == INCREMENTAL_PATHS[4:]
+    assert plan['signature_paths'] == INCREMENTAL_PATHS[:4]
+    assert plan['removed_ids'] == []
+
+def test_external_sort():
+    pairs = [('ddr-test-%s' % n, 'hash%s' % n) for n in [5, 3, 9, 1, 7, 2]]
+    pairs.append(('ddr-test-4', None))
+    expected = sorted(pairs)
+    assert list(docstore._external_sort(pairs)) == expected
+    # spills chunks to temp files and merges them
+    assert list(docstore._external_sort(pairs, chunk_size=2)) == expected
+    assert list(docstore._external_sort([], chunk_size=2)) == []
+
+def test_index_hashes():
+    # ddr-test-1-1-master-a has collection_id; ddr-test-1-1-master-b predates it
+    # ddr-test-2 is in the index but not being verified
+    docs = [
+        {'_type':'collection', '_id':'ddr-test-1'},
+        {'_type':'collection', '_id':'ddr-test-2'},
+        {'_type':'entity', '_id':'ddr-test-2-1', 'collection_id':'ddr-test-2'},
+        {'_type':'file', '_id':'ddr-test-2-1-master-a', 'collection_id':'ddr-test-2', 'entity_id':'ddr-test-2-1'},
+        {'_type':'entity', '_id':'ddr-test-1-1', 'collection_id':'ddr-test-1'},
+        {'_type':'file', '_id':'ddr-test-1-1-master-a', 'collection_id':'ddr-test-1', 'entity_id':'ddr-test-1-1'},
+        {'_type':'file', '_id':'ddr-test-1-1-master-b', 'entity_id':'ddr-test-1-1'},
+    ]
+    def scan(hosts, index, model=None, filters={}, fields=[]):
+        for doc in docs:
+            if doc['_type'] not in model.split(','):
+                continue
+            for key,value in filters.items():
+                if isinstance(value, list):
+                    if doc.get(key) not in value:
+                        break
+                elif doc.get(key) != value:
+                    break
+            else:
+                yield {'_type':doc['_type'], '_id':doc['_id'], 'fields':{'content_hash':[doc['_id']]}}
+    def mget(hosts, index, documents, fields=None):
+        ids = [doc['_id'] for doc in docs]
+        return [
+            {'_id':object_id, 'fields':{'content_hash':[object_id]}}
+            for model,object_id in documents if object_id in ids
+        ]
+    saved = docstore.scan,docstore.mget
+    try:
+        docstore.scan,docstore.mget = scan,mget
+        pairs = list(docstore._index_hashes(HOSTS, 'documents', ['ddr-test-1', 'ddr-test-3']))
+    finally:
+        docstore.scan,docstore.mget = saved
+    assert sorted([object_id for object_id,h in pairs]) == [
+        'ddr-test-1', 'ddr-test-1-1', 'ddr-test-1-1-master-a', 'ddr-test-1-1-master-b']
+    assert ('ddr-test-1-1-master-b', 'ddr-test-1-1-master-b') in pairs
+
+def test_diff_sorted():
+    expected = [('a','1'), ('b','2'), ('c','3'), ('e','5')]
+    indexed = [('b','2'), ('c','x'), ('d','4'), ('e',None)]
+    assert list(docstore._diff_sorted(expected, indexed)) == [
+        ('missing','a'), ('changed','c'), ('extra','d'), ('changed','e')]
+    assert list(docstore._diff_sorted([], indexed[:1])) == [('extra','b')]
+    assert list(docstore._diff_sorted(expected[:1], [])) == [('missing','a')]
+
+def test_merge_results():
+    results = [
+        {'total':3, 'successful':2, 'bad':[('/b/file.json', 403, 'parent unpublishable')]},
+        {'total':2, 'successful':1, 'bad':[('/a/file.json', 2, 'no id')]},
+        {'total':0, 'successful':0, 'bad':[]},
+    ]
+    expected = {
+        'total':5, 'successful':3, 'created':0, 'updated':0, 'unchanged':0,
+        'bad':[('/a/file.json', 2, 'no id'), ('/b/file.json', 403, 'parent unpublishable')]
+    }
+    assert docstore._merge_results(results) == expected
+
 def test_indexer():
     hosts = [{'host': '127.0.0.1', 'port': 9999}]
     index = 'fakeindex'
     results = docstore.index(hosts, index, '/tmp', recursive=True, public=True)
-    assert results == {'successful': 0, 'bad': [], 'total': 0}
+    assert results == {
+        'successful': 0, 'bad': [], 'total': 0,
+        'created': 0, 'updated': 0, 'unchanged': 0,
+    }
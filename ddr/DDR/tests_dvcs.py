@@ -134,6 +134,20 @@ GITOLITE_INFO_OK = """hello ddr, this is git@mits running gitolite3 v3.2-19-gb9b
 """
 GITOLITE_ORGS_EXPECTED = ['ddr-densho', 'ddr-testing']
 
+def test_annex_key():
+    sha256 = 'd04b98f48e8f8bcc15c6ae5ac050801cd6dcfd428fb5f9e65c4e16e7807340fa'
+    key = 'SHA256E-s4--%s.jpg' % sha256
+    target = '../../../.git/annex/objects/Fx/Kq/%s/%s' % (key, key)
+    assert dvcs.annex_key(target) == {
+        'key': key, 'backend': 'SHA256E', 'size': 4, 'algorithm': 'sha256', 'hash': sha256,
+    }
+    assert dvcs.annex_key('MD5-s4--0800fc577294c34e0b28ad2839435945')['algorithm'] == 'md5'
+    worm = dvcs.annex_key('WORM-s4-m1413456789--ddr-test-123-1-master-a1b2c3d4e5.jpg')
+    assert worm['size'] == 4
+    assert worm['algorithm'] == None
+    assert worm['hash'] == None
+    assert dvcs.annex_key('ddr-test-123-1-master-a1b2c3d4e5.jpg') == None
+
 def test_gitolite_info_authorized():
     assert dvcs._gitolite_info_authorized(
         status=0, lines=GITOLITE_INFO_OK.split('\n')
@@ -183,6 +197,25 @@ def test_parse_list_committed():
 
 # list_committed
 
+# head_sha
+
+SAMPLE_DIFF_NAME_STATUS = """M\tcollection.json
+A\tfiles/ddr-testing-123-4/entity.json
+D\tfiles/ddr-testing-123-2/files/ddr-testing-123-2-master-a1b2c3d4e5.json
+M100\tfiles/ddr-testing-123-1/entity.json
+"""
+SAMPLE_DIFF_NAME_STATUS_PARSED = [
+    ('M', 'collection.json'),
+    ('A', 'files/ddr-testing-123-4/entity.json'),
+    ('D', 'files/ddr-testing-123-2/files/ddr-testing-123-2-master-a1b2c3d4e5.json'),
+    ('M', 'files/ddr-testing-123-1/entity.json'),
+]
+def test_parse_diff_name_status():
+    assert dvcs._parse_diff_name_status(SAMPLE_DIFF_NAME_STATUS) == SAMPLE_DIFF_NAME_STATUS_PARSED
+    assert dvcs._parse_diff_name_status('') == []
+
+# diff_name_status
+
 SAMPLE_CONFLICTED_0 = """
 100755 a1b2c3d4e5f6a1b2c3d4e5f6a1b2c3d4e5f6a1b2 1\tpath/to/conflicted_file/01
 100755 1b2c3d4e5f6a1b2c3d4e5f6a1b2c3d4e5f6a1b2a 2\tpath/to/conflicted_file/02
@@ -0,0 +1,163 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import fixity
+import models
+
+
+# payload filenames must be valid DDR IDs
+A = 'ddr-test-123-1-master-aaaaaaaaaa.jpg'
+B = 'ddr-test-123-1-master-bbbbbbbbbb.jpg'
+C = 'ddr-test-123-2-master-cccccccccc.jpg'
+D = 'ddr-test-123-1-master-dddddddddd.jpg'
+
+def _make_collection( basedir ):
+    collection_path = os.path.join(basedir, 'ddr-test-123')
+    os.makedirs(os.path.join(collection_path, '.git'))
+    for eid,files in [('ddr-test-123-1', [A, B]), ('ddr-test-123-2', [C])]:
+        entity = models.Entity(os.path.join(collection_path, 'files', eid))
+        os.makedirs(entity.files_path)
+        for name in files:
+            with open(os.path.join(entity.files_path, name), 'w') as f:
+                f.write(name)
+        control = entity.control()
+        control.update_checksums(entity)
+        control.write()
+    return collection_path
+
+def test_control_checksums():
+    basedir = tempfile.mkdtemp()
+    collection_path = _make_collection(basedir)
+    entity_path = os.path.join(collection_path, 'files', 'ddr-test-123-1')
+    expected = models.file_hashes(os.path.join(entity_path, 'files', A))
+    checksums = fixity.control_checksums(os.path.join(entity_path, 'control'))
+    assert sorted(checksums.keys()) == [A, B]
+    assert checksums[A] == expected
+    shutil.rmtree(basedir)
+
+def test_audit():
+    basedir = tempfile.mkdtemp()
+    collection_path = _make_collection(basedir)
+    journal = fixity.journal_path(collection_path)
+    report = fixity.audit(collection_path, workers=2, batch_files=2)
+    assert report['ok']
+    assert report['entities'] == 2
+    assert report['files'] == 3
+    assert report['bytes'] == 108
+    assert not os.path.exists(journal)
+    # damage payload
+    files_path = os.path.join(collection_path, 'files', 'ddr-test-123-1', 'files')
+    with open(os.path.join(files_path, A), 'w') as f:
+        f.write(A.upper())
+    os.remove(os.path.join(files_path, B))
+    with open(os.path.join(files_path, D), 'w') as f:
+        f.write(D)
+    report = fixity.audit(collection_path)
+    assert not report['ok']
+    assert sorted([m['algorithm'] for m in report['mismatches']]) == ['md5', 'sha1', 'sha256']
+    assert report['mismatches'][0]['entity'] == 'ddr-test-123-1'
+    assert report['mismatches'][0]['path'] == A
+    assert report['missing'] == [{'entity': 'ddr-test-123-1', 'path': B}]
+    assert report['untracked'] == [{'entity': 'ddr-test-123-1', 'path': D}]
+    shutil.rmtree(basedir)
+
+def test_audit_unreadable():
+    basedir = tempfile.mkdtemp()
+    collection_path = _make_collection(basedir)
+    # a directory can't be read as a file, even by root
+    path = os.path.join(collection_path, 'files', 'ddr-test-123-1', 'files', B)
+    os.remove(path)
+    os.makedirs(path)
+    report = fixity.audit(collection_path, workers=2)
+    assert not report['ok']
+    # the other files in the entity and batch are still verified
+    assert report['files'] == 2
+    assert report['mismatches'] == []
+    assert len(report['errors']) == 1
+    assert report['errors'][0]['entity'] == 'ddr-test-123-1'
+    assert report['errors'][0]['path'] == B
+    assert 'Is a directory' in report['errors'][0]['error']
+    shutil.rmtree(basedir)
+
+def test_audit_resume():
+    basedir = tempfile.mkdtemp()
+    collection_path = _make_collection(basedir)
+    journal = fixity.journal_path(collection_path)
+    # journal from an interrupted run; the last line was cut off
+    done = {'entity': 'ddr-test-123-1', 'files': 2, 'bytes': 72, 'files_hashed': 2, 'bytes_read': 72,
+            'missing': [], 'untracked': [], 'mismatches': [], 'errors': []}
+    with open(journal, 'w') as f:
+        f.write(json.dumps(done) + '\n')
+        f.write('{"entity": "ddr-test-123-2", "fi')
+    report = fixity.audit(collection_path)
+    assert report['ok']
+    assert report['entities'] == 2
+    assert report['entities_resumed'] == 1
+    assert report['files'] == 3
+    assert not os.path.exists(journal)
+    shutil.rmtree(basedir)
+
+def test_audit_resume_old_journal():
+    basedir = tempfile.mkdtemp()
+    collection_path = _make_collection(basedir)
+    journal = fixity.journal_path(collection_path)
+    # written before files_hashed/bytes_read, when errors were strings
+    done = {'entity': 'ddr-test-123-1', 'files': 1, 'bytes': 36,
+            'missing': [], 'untracked': [], 'mismatches': [], 'errors': ['control file missing']}
+    with open(journal, 'w') as f:
+        f.write(json.dumps(done) + '\n')
+    report = fixity.audit(collection_path)
+    assert report['entities_resumed'] == 1
+    assert report['files'] == 2
+    assert report['files_hashed'] == 1
+    assert report['bytes_read'] == 36
+    assert report['errors'] == [{'entity': 'ddr-test-123-1', 'path': None, 'error': 'control file missing'}]
+    shutil.rmtree(basedir)
+
+def _annex( entity_path, name, content, backend='SHA256E' ):
+    """Replaces a payload file with a git-annex style symlink.
+    """
+    if backend == 'WORM':
+        key = 'WORM-s%s-m1413456789--%s' % (len(content), name)
+    else:
+        key = '%s-s%s--%s.jpg' % (backend, len(content), hashlib.sha256(content).hexdigest())
+    collection_path = os.path.dirname(os.path.dirname(entity_path))
+    objects = os.path.join(collection_path, '.git', 'annex', 'objects', 'Xx', 'Yy', key)
+    os.makedirs(objects)
+    with open(os.path.join(objects, key), 'w') as f:
+        f.write(content)
+    path = os.path.join(entity_path, 'files', name)
+    os.remove(path)
+    os.symlink(os.path.relpath(os.path.join(objects, key), os.path.dirname(path)), path)
+    return os.path.join(objects, key)
+
+def test_audit_keys():
+    basedir = tempfile.mkdtemp()
+    collection_path = _make_collection(basedir)
+    entity_path = os.path.join(collection_path, 'files', 'ddr-test-123-1')
+    object_a = _annex(entity_path, A, A)
+    _annex(entity_path, B, B, backend='WORM')
+    report = fixity.audit(collection_path, keys=True)
+    assert report['ok']
+    assert report['files'] == 3
+    # A is checked by its key; B (WORM) and C (not annexed) are read
+    assert report['files_hashed'] == 2
+    assert report['bytes_read'] == 72
+    # damaged content with the same size is only found by reading it
+    os.chmod(object_a, 0o644)
+    with open(object_a, 'w') as f:
+        f.write(A.upper())
+    assert fixity.audit(collection_path, keys=True)['ok']
+    assert not fixity.audit(collection_path)['ok']
+    # control file that does not match the key
+    control_path = os.path.join(entity_path, 'control')
+    with open(control_path, 'r') as f:
+        text = f.read()
+    with open(control_path, 'w') as f:
+        f.write(text.replace(hashlib.sha256(A).hexdigest(), '0' * 64))
+    report = fixity.audit(collection_path, keys=True)
+    assert [(m['path'], m['algorithm'], m['source']) for m in report['mismatches']] == [(A, 'sha256', 'annex')]
+    shutil.rmtree(basedir)
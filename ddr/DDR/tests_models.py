@@ -1,5 +1,12 @@
 from datetime import datetime
+import json
 import os
+import shutil
+import sqlite3
+import tempfile
+import time
+
+from nose.tools import assert_raises
 
 import models
 
@@ -17,6 +24,78 @@ def test_file_hash():
     assert models.file_hash(path, 'md5') == md5
     os.remove(path)
 
+def test_file_hashes():
+    path = '/tmp/test-hashes-%s' % datetime.now().strftime('%Y%m%dT%H%M%S')
+    with open(path, 'w') as f:
+        f.write('hash')
+    expected = {
+        'md5': '0800fc577294c34e0b28ad2839435945',
+        'sha1': '2346ad27d7568ba9896f1b7da6b5991251debdf2',
+        'sha256': 'd04b98f48e8f8bcc15c6ae5ac050801cd6dcfd428fb5f9e65c4e16e7807340fa',
+        'size': 4,
+    }
+    assert models.file_hashes(path) == expected
+    # same digests when read in several blocks
+    assert models.file_hashes(path, block_size=3) == expected
+    assert models.file_hashes(path, ['md5']) == {'md5': expected['md5'], 'size': 4}
+    os.remove(path)
+
+def test_hash_files():
+    dirname = tempfile.mkdtemp()
+    paths = []
+    for n in range(10):
+        path = os.path.join(dirname, 'hash%s' % n)
+        with open(path, 'w') as f:
+            f.write('hash' * n)
+        paths.append(path)
+    expected = [models.file_hashes(path, ['sha1']) for path in paths]
+    assert models.hash_files(paths, ['sha1']) == expected
+    # same order regardless of which thread finishes first
+    assert models.hash_files(paths, ['sha1'], workers=4) == expected
+    assert models.hash_files(paths, ['sha1'], workers=4, io_limit=1) == expected
+    assert models.hash_files([], workers=4) == []
+    # unreadable files
+    results = models.hash_files(paths + [dirname], ['sha1'], workers=4, errors=True)
+    assert results[:-1] == expected
+    assert isinstance(results[-1], IOError)
+    assert_raises(IOError, models.hash_files, [dirname], ['sha1'])
+    shutil.rmtree(dirname)
+
+def test_cached_file_hashes():
+    collection_path = tempfile.mkdtemp()
+    os.makedirs(os.path.join(collection_path, '.git'))
+    files_path = os.path.join(collection_path, 'files')
+    os.makedirs(files_path)
+    path = os.path.join(files_path, 'hash')
+    with open(path, 'w') as f:
+        f.write('hash')
+    # older than MTIME_RESOLUTION so the entry can be reused
+    os.utime(path, (time.time() - 60, time.time() - 60))
+    sha1 = '2346ad27d7568ba9896f1b7da6b5991251debdf2'
+    assert models.cached_file_hashes(collection_path, [path], ['sha1']) == [(path, {'sha1': sha1, 'size': 4})]
+    cache_path = models.checksum_cache_path(collection_path)
+    assert os.path.exists(cache_path)
+    # unchanged file is not reread
+    conn = sqlite3.connect(cache_path)
+    conn.execute("UPDATE checksums SET sha1='cached' WHERE path='files/hash'")
+    conn.commit()
+    conn.close()
+    assert models.cached_file_hashes(collection_path, [path], ['sha1']) == [(path, {'sha1': 'cached', 'size': 4})]
+    # verify ignores and refreshes cache
+    assert models.cached_file_hashes(collection_path, [path], ['sha1'], verify=True) == [(path, {'sha1': sha1, 'size': 4})]
+    assert models.cached_file_hashes(collection_path, [path], ['sha1']) == [(path, {'sha1': sha1, 'size': 4})]
+    # changed file is rehashed
+    with open(path, 'w') as f:
+        f.write('hashes')
+    os.utime(path, (time.time() - 30, time.time() - 30))
+    assert models.cached_file_hashes(collection_path, [path], ['md5']) == [(path, {'md5': 'ad13e3e85208780288a2389c791b5c03', 'size': 6})]
+    # entries for removed files are pruned
+    assert models.cached_file_hashes(collection_path, [], prune=files_path) == []
+    conn = sqlite3.connect(cache_path)
+    assert conn.execute('SELECT COUNT(*) FROM checksums').fetchone()[0] == 0
+    conn.close()
+    shutil.rmtree(collection_path)
+
 def test_metadata_files():
     basedir = '/tmp'
     cachedir = '.metadata_files'
@@ -30,6 +109,92 @@ def test_metadata_files():
     paths1 = models.metadata_files('/tmp', recursive=True, force_read=True, save=True)
     print('paths: %s' % paths1)
 
+def test_metadata_files_cache():
+    basedir = tempfile.mkdtemp()
+    excludes = ['.git']
+    cache_path = os.path.join(basedir, models.METADATA_CACHE_FILENAME)
+    e1 = os.path.join(basedir, 'files', 'ddr-test-123-1')
+    e2 = os.path.join(basedir, 'files', 'ddr-test-123-2')
+    for d in [e1, e2]:
+        os.makedirs(d)
+    paths = [
+        os.path.join(basedir, 'collection.json'),
+        os.path.join(e1, 'entity.json'),
+        os.path.join(e2, 'entity.json'),
+    ]
+    for path in paths:
+        open(path, 'w').close()
+    def age(dirs):
+        # make dirs look older than the cache's mtime resolution
+        for d in dirs:
+            os.utime(d, (1000000000, 1000000000))
+    try:
+        age([basedir, os.path.dirname(e1), e1, e2])
+        assert models.metadata_files(basedir, True, save=True, excludes=excludes) == paths
+        head,recursive,mtimes,cached = models._read_metadata_cache(cache_path)
+        assert head == None
+        assert recursive == True
+        assert mtimes[e1] == 1000000000
+        assert cached == paths
+        # cached copy is used while nothing has changed
+        with open(cache_path, 'a') as f:
+            f.write('%s\n' % os.path.join(e2, 'bogus.json'))
+        assert os.path.join(e2, 'bogus.json') in models.metadata_files(basedir, True, excludes=excludes)
+        # only the changed directory is rewalked
+        added = os.path.join(e1, 'ddr-test-123-1-master-a1b2c3.json')
+        open(added, 'w').close()
+        refreshed = models.metadata_files(basedir, True, save=True, excludes=excludes)
+        assert added in refreshed
+        assert os.path.join(e2, 'bogus.json') in refreshed
+        # force_read ignores the cache
+        assert models.metadata_files(basedir, True, force_read=True, excludes=excludes) == sorted(paths + [added])
+        # caches without a header are not used
+        with open(cache_path, 'w') as f:
+            f.write('\n'.join(paths[:1]))
+        assert models._read_metadata_cache(cache_path) == None
+        assert models.metadata_files(basedir, True, excludes=excludes) == sorted(paths + [added])
+    finally:
+        shutil.rmtree(basedir)
+
+def test_walk_metadata_files():
+    basedir = tempfile.mkdtemp()
+    cpath = os.path.join(basedir, 'ddr-test-123')
+    epath = os.path.join(cpath, 'files', 'ddr-test-123-1')
+    fpath = os.path.join(epath, 'files')
+    for d in [fpath, os.path.join(cpath, '.git'), os.path.join(cpath, 'tmp')]:
+        os.makedirs(d)
+    paths = [
+        os.path.join(cpath, 'collection.json'),
+        os.path.join(epath, 'entity.json'),
+        os.path.join(fpath, 'ddr-test-123-1-master-a1b2c3.json'),
+        os.path.join(fpath, 'ddr-test-123-1-master-a1b2c3.tif'),
+        os.path.join(cpath, '.git', 'ignored.json'),
+        os.path.join(cpath, 'tmp', 'ignored.json'),
+    ]
+    for path in paths:
+        open(path, 'w').close()
+    try:
+        # basedir is in /tmp
+        assert list(models.walk_metadata_files(basedir, recursive=True)) == []
+        excludes = ['.git']
+        files_first = list(models.walk_metadata_files(basedir, True, True, excludes))
+        assert files_first == [
+            ('file', paths[2]),
+            (None, paths[5]),
+            ('entity', paths[1]),
+            ('collection', paths[0]),
+        ]
+        walked = list(models.walk_metadata_files(basedir, True, False, excludes))
+        assert walked == [
+            ('collection', paths[0]),
+            ('entity', paths[1]),
+            ('file', paths[2]),
+            (None, paths[5]),
+        ]
+        assert list(models.walk_metadata_files(cpath, excludes=excludes)) == [('collection', paths[0])]
+    finally:
+        shutil.rmtree(basedir)
+
 def test_dissect_path():
     c0 = models.dissect_path('/base/ddr-test-123/collection.json')
     c1 = models.dissect_path('/base/ddr-test-123')
@@ -212,6 +377,41 @@ MODEL_FIELDS_INHERITABLE = [
 def test_inheritable_fields():
     assert models._inheritable_fields(MODEL_FIELDS_INHERITABLE) == ['status','public']
 
+def test_model_definitions():
+    models_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(models_dir, 'entity.json')
+        def write(fields):
+            with open(path, 'w') as f:
+                f.write(json.dumps(fields))
+        write([
+            {'name':'id', 'form':{'label':'Object ID'}, 'elasticsearch':{'public':True}},
+            {'name':'status', 'inheritable':True, 'elasticsearch':{'public':False}},
+        ])
+        definitions = models.model_definitions(models_dir, ['entity', 'file'])
+        assert definitions.keys() == ['entity']
+        assert models.public_fields(models_dir, ['entity']) == {'entity': ['id']}
+        assert models.inheritable_fields('entity', models_dir) == ['status']
+        # made once, then served from the registry
+        calls = []
+        def make(definitions):
+            calls.append(1)
+            return len(definitions['entity'])
+        assert models.derived_from_models('count', make, models_dir, ['entity']) == 2
+        assert models.derived_from_models('count', make, models_dir, ['entity']) == 2
+        assert len(calls) == 1
+        # callers can't modify the registry
+        definitions['entity'].append({'name':'whatever'})
+        assert len(models.model_definitions(models_dir, ['entity', 'file'])['entity']) == 2
+        # changed files are reread
+        write([{'name':'id', 'elasticsearch':{'public':True}}])
+        mtime = os.path.getmtime(path) + 10
+        os.utime(path, (mtime, mtime))
+        assert models.derived_from_models('count', make, models_dir, ['entity']) == 1
+        assert len(calls) == 2
+    finally:
+        shutil.rmtree(models_dir)
+
 # TODO _inherit
 
 # lock